@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+
+from . import jobstore, pool, ready, util, volumes
+from .appconf import config as cfg
+from .applog import log
+
+
+class AsyncLXDError(Exception):
+    " LXD API error response "
+    def __init__(self, status, error):
+        self.status = status
+        super().__init__(f"LXD {status}: {error}")
+
+
+def socket_path(addr):
+    " Return unix socket path for remote addr, local LXD if addr is empty "
+    if addr:
+        return urllib.parse.unquote(addr[len("http+unix://"):])
+    if "LXD_DIR" in os.environ:
+        return os.path.join(os.environ["LXD_DIR"], "unix.socket")
+    if os.path.exists("/var/snap/lxd/common/lxd/unix.socket"):
+        return "/var/snap/lxd/common/lxd/unix.socket"
+    return "/var/lib/lxd/unix.socket"
+
+
+class AsyncLXDClient:
+    """ Minimal asyncio client for the LXD REST API
+
+    Talks to the local unix socket or to https remotes using the client
+    certificate from cfg.key_pair_paths(). Only the calls needed to launch
+    runners are implemented.
+    """
+    def __init__(self, rname="main", verify=False):
+        remote = cfg.remotes.get(rname)
+        self.addr = remote.addr
+        self.verify = verify
+        self.session = None
+
+    def connector(self):
+        if self.addr and self.addr.startswith("https://"):
+            ctx = ssl.create_default_context()
+            if not self.verify:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            ctx.load_cert_chain(*map(str, cfg.key_pair_paths()))
+            self.base = self.addr.rstrip("/")
+            return aiohttp.TCPConnector(ssl=ctx, limit=0)
+        self.base = "http://lxd"
+        return aiohttp.UnixConnector(path=socket_path(self.addr), limit=0)
+
+    async def open(self):
+        if not self.session:
+            # Operation waits can take as long as an image download
+            self.session = aiohttp.ClientSession(
+                connector=self.connector(),
+                timeout=aiohttp.ClientTimeout(total=None)
+            )
+        return self
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, path, raw=False, **kwargs):
+        " Send request, return response metadata ( or body if raw ) "
+        await self.open()
+        async with self.session.request(
+            method, self.base + path, **kwargs
+        ) as resp:
+            if raw:
+                body = await resp.read()
+                if resp.status >= 400:
+                    raise AsyncLXDError(resp.status, body)
+                return body
+            data = await resp.json(content_type=None)
+        if data.get("type") == "error":
+            raise AsyncLXDError(data.get("error_code"), data.get("error"))
+        if data.get("type") == "async":
+            return data["operation"]
+        return data.get("metadata")
+
+    async def wait(self, operation, timeout=-1):
+        " Wait for operation, raise if it failed "
+        meta = await self.request(
+            "GET", f"{operation}/wait", params=dict(timeout=timeout)
+        )
+        if meta.get("status_code") != 200:
+            raise AsyncLXDError(meta.get("status_code"), meta.get("err"))
+        return meta
+
+    async def create_instance(self, config, target=None):
+        params = dict(target=target) if target else {}
+        return await self.wait(
+            await self.request(
+                "POST", "/1.0/instances", json=config, params=params
+            )
+        )
+
+    async def set_state(self, name, action, force=False):
+        return await self.wait(
+            await self.request(
+                "PUT",
+                f"/1.0/instances/{name}/state",
+                json=dict(action=action, force=force, timeout=30)
+            )
+        )
+
+    async def update_config(self, name, config):
+        return await self.request(
+            "PATCH", f"/1.0/instances/{name}", json=dict(config=config)
+        )
+
+    async def instance(self, name):
+        return await self.request("GET", f"/1.0/instances/{name}")
+
+    async def state(self, name):
+        return await self.request("GET", f"/1.0/instances/{name}/state")
+
+    async def mk_dir(self, name, path, mode="0755"):
+        headers = {"X-LXD-type": "directory", "X-LXD-mode": mode}
+        return await self.request(
+            "POST",
+            f"/1.0/instances/{name}/files",
+            params=dict(path=str(path)),
+            headers=headers
+        )
+
+    async def put_file(self, name, path, data, mode="0644"):
+        " Push data, bytes or an open file which is streamed "
+        headers = {"X-LXD-type": "file", "X-LXD-mode": mode}
+        return await self.request(
+            "POST",
+            f"/1.0/instances/{name}/files",
+            params=dict(path=str(path)),
+            headers=headers,
+            data=data
+        )
+
+    async def execute(self, name, command, environment=None):
+        " Run command, return (exitcode, stdout, stderr) "
+        operation = await self.request(
+            "POST",
+            f"/1.0/instances/{name}/exec",
+            json={
+                "command": command,
+                "environment": environment or {},
+                "wait-for-websocket": False,
+                "interactive": False,
+                "record-output": True,
+            }
+        )
+        meta = (await self.wait(operation))["metadata"]
+        output = meta.get("output", {})
+        logs = []
+        for fd in ("1", "2"):
+            if fd in output:
+                body = await self.request("GET", output[fd], raw=True)
+                logs.append(body.decode("utf-8", "replace"))
+            else:
+                logs.append("")
+        return (meta.get("return"), *logs)
+
+
+class AsyncLauncher:
+    """ Launch runners on an asyncio event loop
+
+    Each launch is a coroutine instead of a blocked thread, so in-flight
+    launches are bounded only by the worker semaphores. The loop runs in a
+    background thread and LXDRunner.launch() submits events to it. Warm
+    pool, image and template builds stay on the thread pool.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.loop = None
+        self.client = None
+        # Clients of other placement hosts by remote name
+        self.clients = dict()
+        self.waiters = dict()
+        self.started = threading.Event()
+        lxdr.readiness.listeners.append(self.notify)
+
+    def start(self):
+        if self.loop:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncLXDClient("main")
+        util.threadit(self._run, name="AsyncLaunch")
+        self.started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.started.set)
+        self.loop.run_forever()
+
+    def submit(self, evt):
+        " Schedule launch from any thread, returns concurrent Future "
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.launch(evt), self.loop)
+
+    def client_for(self, host):
+        " Async client for placement host, main if host is None "
+        if not host or host.remote == "main":
+            return self.client
+        if host.remote not in self.clients:
+            self.clients[host.remote] = AsyncLXDClient(host.remote)
+        return self.clients[host.remote]
+
+    def notify(self, instname):
+        " Wake readiness wait on instance event, called from any thread "
+        waiter = self.waiters.get(instname)
+        if waiter and self.loop:
+            self.loop.call_soon_threadsafe(waiter.set)
+
+    async def is_ready(self, client, name, path):
+        try:
+            state = await client.state(name)
+            if (
+                state.get("status_code") != ready.RUNNING
+                or not (state.get("processes") or 0) > 0
+            ):
+                return False
+            await client.mk_dir(name, path)
+        except AsyncLXDError as exc:
+            return "exists" in str(exc)
+        except aiohttp.ClientError:
+            return False
+        return True
+
+    async def wait_ready(self, client, name, itype, path):
+        " Async counterpart of Readiness.wait "
+        if itype == "virtual-machine":
+            timeout = cfg.ready_timeout_vm
+        else:
+            timeout = cfg.ready_timeout_container
+        deadline = time.monotonic() + timeout
+        delay = ready.MIN_DELAY
+        waiter = self.waiters[name] = asyncio.Event()
+        try:
+            while not await self.is_ready(client, name, path):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                waiter.clear()
+                try:
+                    await asyncio.wait_for(
+                        waiter.wait(), timeout=min(delay, remaining)
+                    )
+                    delay = ready.MIN_DELAY
+                except asyncio.TimeoutError:
+                    delay = min(delay * 2, ready.MAX_DELAY)
+        finally:
+            self.waiters.pop(name, None)
+        return True
+
+    async def run_setup_script(
+        self, client, name, script_dst, *args, environment
+    ):
+        log.info(f"Executing: {script_dst} {' '.join(args)}")
+        (exitcode, stdout, stderr) = await client.execute(
+            name, [str(script_dst), *args], environment=environment
+        )
+        if exitcode:
+            log.error("===STDOUT====\n%s", stdout)
+            log.error("===STDERR====\n%s", stderr)
+            raise Exception(f"Provisioner exit code: {exitcode}")
+
+    async def launch(self, evt):
+        " Launch GHA runner for event, mirrors LXDRunner._launch "
+        # Imported here, lxd imports this module
+        from .lxd import INSTALLDIR, LaunchCancelled
+
+        lxdr = self.lxdr
+        loop = asyncio.get_running_loop()
+        rc = evt.rc
+        name = evt.instname
+
+        client = self.client_for(lxdr.placement.host_for(name))
+        lxdr.workers[name] = evt
+        if not await loop.run_in_executor(None, lxdr.verify_launch, evt):
+            if evt.prewarmed:
+                # Claimed pool instance, its deleted event frees the slot
+                await self.cleanup(client, name)
+            else:
+                lxdr.forget_worker(name)
+            return False
+
+        script_dst = INSTALLDIR.joinpath(rc.setup_script.name)
+        vars_dst = INSTALLDIR.joinpath("setupvars.conf")
+
+        provisioned = False
+        try:
+            lxdr.check_cancelled(evt)
+            await loop.run_in_executor(None, lxdr.prepare_launch, evt)
+            environment = lxdr.script_env(evt, name)
+            if evt.prewarmed:
+                await client.update_config(name, {pool.IDLE_KEY: "claimed"})
+            else:
+                placed = await loop.run_in_executor(
+                    None, lxdr.place_instance, name, rc, evt.pkg
+                )
+                host, source, provisioned, devices = placed
+                client = self.client_for(host)
+                log.warning("Launching instance %s", name)
+                await client.create_instance(
+                    dict(
+                        name=name,
+                        ephemeral=True,
+                        profiles=rc.profiles,
+                        source=source,
+                        type=rc.type,
+                        devices=devices
+                    ),
+                    target=host.target if host else None
+                )
+                await client.set_state(name, "start")
+                if not await self.wait_ready(
+                    client, name, rc.type, INSTALLDIR
+                ):
+                    raise Exception(f"Runner start timeout {name}")
+            lxdr.check_cancelled(evt)
+
+            phase = ()
+            if evt.prewarmed or provisioned:
+                phase = ("register", )
+            else:
+                with open(rc.setup_script, "rb") as fp:
+                    await client.put_file(name, script_dst, fp, "0755")
+                inst = await client.instance(name)
+                if volumes.DEVICE not in (inst.get("devices") or {}):
+                    pkg_src = os.path.join(
+                        str(cfg.dirs.pkgdir), evt.pkg.linkname
+                    )
+                    with open(pkg_src, "rb") as fp:
+                        await client.put_file(
+                            name, INSTALLDIR / "actions-runner.tgz", fp,
+                            "0755"
+                        )
+
+            lxdr.check_cancelled(evt)
+            await client.put_file(
+                name, vars_dst, util.env_str(environment).encode(), "0755"
+            )
+            await self.run_setup_script(
+                client, name, script_dst, *phase, environment=environment
+            )
+        except LaunchCancelled as exc:
+            log.warning(exc)
+            await self.cleanup(client, name)
+            return False
+        except Exception as exc:
+            log.exception(exc)
+            await self.cleanup(client, name)
+            return False
+
+        evt.provisioned = True
+        lxdr.jobs.record(evt, jobstore.PROVISIONED)
+        log.info("Provision sucesssful %s", name)
+        return True
+
+    async def cleanup(self, client, name):
+        if not cfg.cleanup:
+            log.error("Runner start failed, CLEANUP DISABLED")
+            return False
+        log.error("Runner start failed, destroying %s", name)
+        try:
+            await client.set_state(name, "stop", force=True)
+            await client.request("DELETE", f"/1.0/instances/{name}")
+        except (AsyncLXDError, aiohttp.ClientError):
+            # No instance, no deleted event to free its resources
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.lxdr.release_volume, name
+            )
+            self.lxdr.placement.release(name)
+            self.lxdr.forget_worker(name)
+            return False
+        return True
@@ -34,12 +34,37 @@ class RunnerConf(BaseModel):
     setup_script: pathlib.Path = def_script
     max_workers: int = 10
     worksem: threading.BoundedSemaphore = None
+    # Warm pool of provisioned instances waiting for jobs
+    min_idle: int = 0
+    max_idle: typing.Optional[int] = None
+    # Runner version to use instead of the latest release, like 2.277.1
+    runner_version: typing.Optional[str] = None
+    # Size warm pool between min_idle and max_idle from forecast demand
+    autoscale: bool = False
+    # Launch from locally built image with runner already provisioned
+    prebake: bool = False
+    # Attach copy-on-write clone of extracted runner volume
+    runner_volume: bool = False
+    # Copy instances from a provisioned, stopped template instance
+    template: bool = False
+    template_instance_only: bool = True
 
     @validator('worksem', always=True)
     def set_worksemaphore(cls, v, *, values):
         out = threading.BoundedSemaphore(values['max_workers'])
         return out
 
+    @validator('max_idle', always=True)
+    def check_idle_limits(cls, v, *, values):
+        min_idle = values.get('min_idle', 0)
+        if v is None:
+            v = min_idle
+        if v < min_idle:
+            raise ValueError("max_idle must be >= min_idle")
+        if v > values.get('max_workers', 0):
+            raise ValueError("max_idle must be <= max_workers")
+        return v
+
     class Config:
         extra = 'allow'
         arbitrary_types_allowed = True
@@ -85,6 +110,8 @@ class AppConfig(GoodConf):
     prefix: str
     remotes: typing.Dict[str, Remote]
     runnermap: typing.List[RunnerConf]
+    # Remotes runner instances are placed on, clusters expand to members
+    hosts: typing.List[str] = ['main']
 
     web_host: IPvAnyAddress = ipaddress.IPv4Address('0.0.0.0')
     web_port: int = 5000
@@ -92,6 +119,59 @@ class AppConfig(GoodConf):
 
     cleanup: bool = True
 
+    # Storage pool for runner volumes
+    storage_pool: str = "default"
+    # Hours between refreshes of locally cached remote images
+    image_refresh: int = 6
+
+    # Launch engine: threads ( ThreadPoolExecutor ) or async ( asyncio )
+    launch_engine: typing.Literal['threads', 'async'] = 'threads'
+
+    # Seconds instances launched ahead of jobs from workflow_run requested
+    # events wait for a job, 0 disables prewarming
+    prewarm_window: int = 0
+
+    # Seconds of forecast job arrivals autoscaled warm pools keep ready,
+    # about the time to launch and provision a runner
+    forecast_lead: int = 120
+
+    # Duplicate workflow job ids are dropped for dedup_ttl seconds, at most
+    # dedup_size ids are remembered
+    dedup_ttl: int = 3600
+    dedup_size: int = 10000
+
+    # Hours queued jobs and unfinished launches are resumed after a
+    # restart, GitHub drops jobs queued for a day
+    resume_max_age: int = 24
+
+    # Concurrent repos scanned for queued jobs at startup. Repos without
+    # pushes for discovery_max_age hours are skipped, 0 scans all
+    discovery_workers: int = 8
+    discovery_max_age: int = 168
+
+    # Runner package versions kept per os / arch for rollback, pinned
+    # versions are kept in addition
+    runner_versions_kept: int = 2
+
+    # Keep-alive connections per host for GitHub traffic, 0 uses
+    # max_workers
+    http_pool_size: int = 0
+
+    # Concurrent GitHub requests of runner cleanup and deregistration
+    cleanup_workers: int = 8
+
+    # Register runners centrally with just in time configs instead of
+    # config.sh inside the instance. JIT runners join runner_group_id
+    jitconfig: bool = False
+    runner_group_id: int = 1
+
+    # Seconds a successful launch verification is reused
+    verify_ttl: int = 300
+
+    # Seconds to wait for a launched instance to become reachable
+    ready_timeout_container: int = 60
+    ready_timeout_vm: int = 300
+
     # For testing
     activecfg: typing.FrozenSet[str] = frozenset()
     max_workers: int
@@ -114,6 +194,17 @@ class AppConfig(GoodConf):
             raise ValueError(error)
         return values
 
+    @root_validator
+    def check_hosts(cls, values):
+        remotes = values.get("remotes") or {}
+        for rname in values.get("hosts", []):
+            remote = remotes.get(rname)
+            if not remote:
+                raise ValueError(f"Host remote '{rname}' is undefined")
+            if remote.protocol != "lxd":
+                raise ValueError(f"Host remote '{rname}' is not an LXD server")
+        return values
+
     def key_pair_paths(self):
         return (
             self.config_home / "client.crt", self.config_home / "client.key"
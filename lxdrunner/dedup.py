@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import time
+
+
+class SeenIndex:
+    """ Bounded, expiring index of seen workflow job ids
+
+    Entries expire ttl seconds after they were last seen and the oldest
+    are evicted beyond maxsize. With a fixed ttl insertion order is expiry
+    order, so expired entries are always at the front and every operation
+    is O(1) amortized.
+    """
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # job id -> expiry
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, job_id):
+        " Record job id, return True if it was already seen "
+        now = time.monotonic()
+        with self.lock:
+            expiry = self.entries.get(job_id)
+            if expiry and expiry > now:
+                self.hits += 1
+                # Expiry counts from the last delivery
+                self.entries[job_id] = now + self.ttl
+                self.entries.move_to_end(job_id)
+                return True
+            self.misses += 1
+            self.entries[job_id] = now + self.ttl
+            self.entries.move_to_end(job_id)
+            self._evict(now)
+        return False
+
+    def _evict(self, now):
+        entries = self.entries
+        while entries:
+            job_id, expiry = next(iter(entries.items()))
+            if expiry > now and len(entries) <= self.maxsize:
+                break
+            entries.popitem(last=False)
+
+    def __contains__(self, job_id):
+        with self.lock:
+            expiry = self.entries.get(job_id)
+        return bool(expiry and expiry > time.monotonic())
+
+    def forget(self, job_id):
+        with self.lock:
+            self.entries.pop(job_id, None)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return dict(
+                size=len(self.entries),
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=round(self.hits / total, 3) if total else 0.0
+            )
@@ -21,6 +21,9 @@ class RunnerPackage(BaseModel):
     download_url: str
     filename: str
     linkname: str
+    version: str = ""
+    # Published in the release notes
+    sha256: str = ""
 
 
 class RunnerEvent(BaseModel):
@@ -32,7 +35,14 @@ class RunnerEvent(BaseModel):
     rc: RunnerConf
     pkg: typing.Any
     token: str = ""
+    # Encoded just in time runner config and id of its runner
+    jitconfig: str = ""
+    runner_id: int = 0
     wf_job_id: str = ""
+    prewarmed: bool = False
+    cancelled: bool = False
+    # Runner started, set once the launch succeeded
+    provisioned: bool = False
     instname: str = Field(default_factory=util.make_name)
 
     @validator('target', always=True)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import json
+import math
+import threading
+import time
+
+from . import util
+from .appconf import config as cfg
+
+# Time constant of the recent arrival rate, seconds
+TAU = 900.0
+# Weight of the latest day in hour of day averages
+SEASON_ALPHA = 0.3
+# Look ahead so warm capacity is ready when a busy hour starts
+LOOKAHEAD = 900
+
+
+def hour_of_day(ts):
+    return time.localtime(ts).tm_hour
+
+
+class Forecast:
+    """ Online job arrival rate per label set
+
+    Combines an exponentially weighted recent rate with per hour of day
+    averages across days, the higher of the two is used. The rate times
+    cfg.forecast_lead ( about the time to launch and provision a runner )
+    gives the number of warm instances needed so jobs don't wait on a
+    launch. State is persisted as JSON under cfg.cache_home.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = dict()
+
+    @staticmethod
+    def key(labels):
+        return ",".join(sorted(labels))
+
+    def _get(self, labels, now):
+        state = self.state.setdefault(
+            self.key(labels),
+            dict(ewma=0.0, last=now, hour=int(now // 3600), count=0,
+                 hours=[0.0] * 24)
+        )
+        self._roll(state, now)
+        return state
+
+    @staticmethod
+    def _roll(state, now):
+        " Fold finished hours into hour of day averages "
+        hour = int(now // 3600)
+        # Hours without arrivals count as zero, at most one day of them
+        for absolute in range(max(state['hour'], hour - 24), hour):
+            slot = hour_of_day(absolute * 3600)
+            count = state['count'] if absolute == state['hour'] else 0
+            state['hours'][slot] += SEASON_ALPHA * (
+                count - state['hours'][slot]
+            )
+        if hour != state['hour']:
+            state['hour'] = hour
+            state['count'] = 0
+
+    def record(self, labels, now=None):
+        " Record job arrival for label set "
+        now = now or time.time()
+        with self.lock:
+            state = self._get(labels, now)
+            decay = math.exp(-(now - state['last']) / TAU)
+            state['ewma'] = state['ewma'] * decay + 1 / TAU
+            state['last'] = now
+            state['count'] += 1
+
+    def rate(self, labels, now=None):
+        " Expected arrivals per second for label set "
+        now = now or time.time()
+        with self.lock:
+            state = self._get(labels, now)
+            recent = state['ewma'] * math.exp(-(now - state['last']) / TAU)
+            season = max(
+                state['hours'][hour_of_day(now)],
+                state['hours'][hour_of_day(now + LOOKAHEAD)]
+            ) / 3600
+        return max(recent, season)
+
+    def target(self, rc, now=None):
+        " Warm instances needed for runner config, before pool limits "
+        return math.ceil(self.rate(rc.labels, now) * cfg.forecast_lead)
+
+    def load(self):
+        self.path = util.state_path(self.path, "forecast.json")
+        state = util.load_state(self.path)
+        if state is not None:
+            self.state = state
+
+    def save(self):
+        " Write state atomically "
+        self.path = util.state_path(self.path, "forecast.json")
+        with self.lock:
+            data = json.dumps(self.state)
+        util.save_state(self.path, data)
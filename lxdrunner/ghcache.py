@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import threading
+import urllib.error
+import urllib.parse
+
+from fastcore.net import ExceptionsHTTP
+from fastcore.xtras import dict2obj, obj2dict
+from ghapi.all import GH_HOST, GhApi
+
+from . import httppool, ratelimit, util
+
+# Cached responses kept, least recently used are dropped
+MAX_ENTRIES = 5000
+
+
+class ResponseCache:
+    """ GitHub GET responses with their ETag / Last-Modified validators
+
+    Persisted as JSON under cfg.cache_home so conditional requests work
+    across restarts.
+    """
+    def __init__(self, path=None, maxsize=MAX_ENTRIES):
+        self.path = path
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # key -> dict(etag, modified, body)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, route=None, query=None):
+        if route:
+            path = path.format(**route)
+        return json.dumps([path, sorted((query or {}).items())], default=str)
+
+    def validators(self, key):
+        " Conditional request headers for cached response "
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return {}
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['modified']:
+            headers['If-Modified-Since'] = entry['modified']
+        return headers
+
+    def hit(self, key):
+        " Cached body for not modified response, None if dropped since "
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry['body']
+
+    def store(self, key, headers, body):
+        headers = {name.lower(): val for name, val in headers.items()}
+        etag = headers.get('etag')
+        modified = headers.get('last-modified')
+        with self.lock:
+            self.misses += 1
+            if not (etag or modified):
+                self.entries.pop(key, None)
+                return
+            self.entries[key] = dict(etag=etag, modified=modified, body=body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return dict(
+                size=len(self.entries),
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=round(self.hits / total, 3) if total else 0.0,
+                # Not modified responses don't count against the rate limit
+                saved=self.hits
+            )
+
+    def load(self):
+        self.path = util.state_path(self.path, "ghcache.json")
+        entries = util.load_state(self.path)
+        if entries is not None:
+            self.entries = collections.OrderedDict(entries)
+
+    def save(self):
+        " Write entries atomically "
+        self.path = util.state_path(self.path, "ghcache.json")
+        with self.lock:
+            data = json.dumps(list(self.entries.items()))
+        util.save_state(self.path, data)
+
+
+class CachedGhApi(GhApi):
+    """ GhApi sending conditional GET requests
+
+    Responses carrying an ETag or Last-Modified header are cached, later
+    calls send them back as If-None-Match / If-Modified-Since. A 304 Not
+    Modified is answered from the cache and costs no rate limit.
+    Rate limit headers of every response feed the budget. Requests go
+    through the shared keep-alive connection pool.
+    """
+    def __init__(self, *args, cache=None, budget=None, http=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache or ResponseCache()
+        self.budget = budget or ratelimit.RateBudget()
+        self.http = http or httppool.HTTPPool()
+
+    def send(self, path, verb, headers, route, query, data):
+        """ GhApi.__call__ over the connection pool, raising the same
+        errors as fastcore urlsend. Returns (result, response headers),
+        the instance is shared by threads so headers are not read back
+        from recv_hdrs.
+        """
+        headers = {**self.headers, **(headers or {})}
+        if not path.startswith(('http://', 'https://')):
+            path = GH_HOST + path
+        if route:
+            path = path.format(
+                **{k: urllib.parse.quote(str(v)) for k, v in route.items()}
+            )
+        # Like GhApi, requests without data go out without a body
+        body = dict()
+        if data and isinstance(data, dict):
+            body = dict(json=data)
+        elif data:
+            body = dict(data=data)
+        resp = self.http.request(
+            verb, path, headers=headers, params=query or None, **body
+        )
+        recv_hdrs = self.recv_hdrs = dict(resp.headers)
+        self.budget.update(recv_hdrs)
+        self.limit_rem = recv_hdrs.get('X-RateLimit-Remaining', self.limit_rem)
+
+        if resp.status_code in ExceptionsHTTP:
+            raise ExceptionsHTTP[resp.status_code](path, resp.headers, None)
+        if resp.status_code >= 300:
+            raise urllib.error.HTTPError(
+                path, resp.status_code, resp.reason, resp.headers, None
+            )
+        if route and route.get('archive_format'):
+            return resp.content, recv_hdrs
+        return dict2obj(resp.json() if resp.content else {}), recv_hdrs
+
+    def __call__(
+        self, path, verb=None, headers=None, route=None, query=None, data=None
+    ):
+        verb = (verb or ('POST' if data else 'GET')).upper()
+        if verb != 'GET' or (route and route.get('archive_format')):
+            return self.send(path, verb, headers, route, query, data)[0]
+
+        key = self.cache.key(path, route, query)
+        headers = {**self.cache.validators(key), **(headers or {})}
+        try:
+            res, recv_hdrs = self.send(
+                path, verb, headers, route, query, data
+            )
+        except urllib.error.HTTPError as exc:
+            body = self.cache.hit(key) if exc.code == 304 else None
+            if body is None:
+                raise
+            return dict2obj(body)
+        self.cache.store(key, recv_hdrs, obj2dict(res))
+        return res
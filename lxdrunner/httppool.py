@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+
+import requests
+import requests.adapters
+
+from . import util
+from .appconf import config as cfg
+
+# Seconds to connect and between received bytes
+TIMEOUT = (10, 60)
+CHUNK_SIZE = 1 << 20
+
+
+class HTTPPool:
+    """ Shared keep-alive HTTP/1.1 connections for GitHub traffic
+
+    One requests session with a pool of up to cfg.http_pool_size
+    connections per host ( default max_workers ), so API calls and
+    downloads from all threads reuse TLS connections instead of a
+    handshake per request.
+    """
+    def __init__(self, size=None):
+        self.size = size or cfg.http_pool_size or cfg.max_workers
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.size
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def request(self, verb, url, **kwargs):
+        kwargs.setdefault("timeout", TIMEOUT)
+        return self.session.request(verb, url, **kwargs)
+
+    def download(self, url, path, sha256=None):
+        """ Stream url to path, resuming a partial download left in
+        path.part. path only appears once complete and, if given,
+        matching sha256.
+        """
+        part = f"{path}.part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.request("GET", url, headers=headers, stream=True) as resp:
+            # 416: Nothing left past offset, partial file is complete
+            if resp.status_code != 416:
+                resp.raise_for_status()
+                # Server ignoring the range sends the whole file
+                mode = "ab" if resp.status_code == 206 else "wb"
+                with open(part, mode) as fp:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        fp.write(chunk)
+        if sha256 and util.file_sha256(part) != sha256:
+            os.unlink(part)
+            raise ValueError(f"Checksum mismatch {url}")
+        os.replace(part, path)
+        return os.path.getsize(path)
+
+    def stats(self):
+        " Requests and new connections of open host pools "
+        pools = self.adapter.poolmanager.pools
+        hosts = list(filter(None, map(pools.get, pools.keys())))
+        sent = sum(pool.num_requests for pool in hosts)
+        opened = sum(pool.num_connections for pool in hosts)
+        return dict(
+            requests=sent,
+            connections=opened,
+            reused=max(0, sent - opened),
+            reuse_rate=round(1 - opened / sent, 3) if sent else 0.0
+        )
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import re
+import threading
+
+import pylxd.exceptions
+
+from . import util
+from .appconf import config as cfg
+from .applog import log
+
+
+class ImageCache:
+    """ Local copies of remote images used by the runnermap
+
+    Remote images ( <remote>:<image> ) are pulled once into a local alias
+    with auto update enabled, launches then resolve locally without a
+    remote metadata lookup. Cached images are refreshed in the background
+    while launches keep using the current copy.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.lock = threading.Lock()
+        self.cached = dict()
+        self.pulling = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def alias(image, itype):
+        " Local alias for remote image and instance type "
+        name = re.sub(r"[^A-Za-z0-9.-]+", "-", image)
+        suffix = "-vm" if itype == "virtual-machine" else ""
+        return f"{cfg.prefix}-cache-{name}{suffix}"
+
+    def local_alias(self, rc):
+        " Return local alias for runner config image, None if not cached "
+        if ":" not in rc.image:
+            return None
+        return self.cached.get((rc.image, rc.type))
+
+    def source(self, rc):
+        " Return local image source for runner config, None on cache miss "
+        if ":" not in rc.image:
+            return None
+        alias = self.local_alias(rc)
+        with self.lock:
+            if alias:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if alias:
+            return dict(type="image", alias=alias)
+
+        log.info("Image cache miss: %s ( %s )", rc.image, rc.type)
+        self.pull_async(rc.image, rc.type)
+        return None
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses)
+
+    def exists(self, alias):
+        try:
+            return self.lxdr.client.images.get_by_alias(alias)
+        except pylxd.exceptions.NotFound:
+            return None
+
+    def pull_async(self, image, itype):
+        with self.lock:
+            if (image, itype) in self.pulling:
+                return
+            self.pulling.add((image, itype))
+        util.threadit(self.pull, args=(image, itype), name="ImageCache")
+
+    def pull(self, image, itype):
+        " Pull remote image into local alias, refresh if already cached "
+        alias = self.alias(image, itype)
+        remote_name, remote_alias = image.split(":", 1)
+        remote = cfg.remotes.get(remote_name)
+
+        try:
+            cached = self.exists(alias)
+            if cached:
+                self.refresh(cached)
+            else:
+                log.warning("Caching image %s as %s", image, alias)
+                response = self.lxdr.client.api.images.post(
+                    json=dict(
+                        auto_update=True,
+                        aliases=[dict(name=alias)],
+                        source=dict(
+                            type="image",
+                            mode="pull",
+                            server=remote.addr,
+                            protocol=remote.protocol,
+                            alias=remote_alias,
+                            image_type=itype
+                        )
+                    )
+                )
+                self.lxdr.client.operations.wait_for_operation(
+                    response.json()["operation"]
+                )
+            self.cached[(image, itype)] = alias
+        except Exception as exc:
+            log.error("Image cache pull failed %s", image)
+            log.exception(exc)
+        finally:
+            with self.lock:
+                self.pulling.discard((image, itype))
+
+    def refresh(self, image):
+        " Ask LXD to refresh a cached image from its source "
+        log.info("Refreshing cached image %s", image.fingerprint)
+        response = self.lxdr.client.api.images[image.fingerprint
+                                               ].refresh.post()
+        self.lxdr.client.operations.wait_for_operation(
+            response.json()["operation"]
+        )
+
+    def wanted(self):
+        return sorted(
+            {(rc.image, rc.type)
+             for rc in cfg.runnermap if ":" in rc.image}
+        )
+
+    def load(self):
+        " Record remote images already cached locally "
+        for (image, itype) in self.wanted():
+            alias = self.alias(image, itype)
+            if self.exists(alias):
+                self.cached[(image, itype)] = alias
+        log.info("Image cache: %s images cached", len(self.cached))
+
+    def refresh_all(self):
+        " Pull or refresh every remote image referenced in the runnermap "
+        for (image, itype) in self.wanted():
+            with self.lock:
+                if (image, itype) in self.pulling:
+                    continue
+                self.pulling.add((image, itype))
+            self.pull(image, itype)
+        stats = self.stats()
+        log.warning(
+            "Image cache: %s images, hits=%s misses=%s", len(self.cached),
+            stats['hits'], stats['misses']
+        )
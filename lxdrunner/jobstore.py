@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from . import util
+from .appconf import config as cfg
+from .applog import log
+
+QUEUED = "queued"
+LAUNCHING = "launching"
+PROVISIONED = "provisioned"
+DELETED = "deleted"
+
+# Max state changes written per transaction
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id   TEXT PRIMARY KEY,
+    state    TEXT NOT NULL,
+    instname TEXT,
+    event    TEXT NOT NULL,
+    created  REAL NOT NULL,
+    updated  REAL NOT NULL
+)
+"""
+
+UPSERT = """
+INSERT INTO jobs (job_id, state, instname, event, created, updated)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(job_id) DO UPDATE SET
+    state=excluded.state, instname=excluded.instname, event=excluded.event,
+    updated=excluded.updated
+"""
+
+
+def job_key(evt):
+    return evt.wf_job_id or evt.instname
+
+
+class JobStore:
+    """ Durable record of runner events and their state
+
+    Every state change of a RunnerEvent ( queued, launching, provisioned,
+    deleted ) is kept in SQLite under cfg.cache_home, so queued and running
+    jobs are resumed from local state after a restart. Writes go through a
+    background thread that commits them in batches, webhook handlers only
+    enqueue. The database runs in WAL mode.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.conn = None
+        self.writes = queue.Queue()
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.conn:
+            return
+        self.path = self.path or cfg.cache_home / "jobs.db"
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the database consistent, only the last commits are at
+        # risk on power loss
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+        util.threadit(self.writer, name="JobStore")
+
+    def record(self, evt, state):
+        " Queue state change of event for writing "
+        if not self.conn:
+            return
+        now = time.time()
+        event = dict(
+            owner=evt.owner,
+            repo=evt.repo,
+            org=evt.org,
+            wf_job_id=evt.wf_job_id,
+            runner_id=evt.runner_id,
+            labels=sorted(evt.rc.labels)
+        )
+        self.writes.put(
+            (job_key(evt), state, evt.instname, json.dumps(event), now, now)
+        )
+
+    def writer(self):
+        " Write queued state changes, one transaction per batch "
+        while True:
+            rows = [self.writes.get()]
+            while len(rows) < BATCH_SIZE:
+                try:
+                    rows.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.lock, self.conn:
+                    self.conn.executemany(UPSERT, rows)
+            except sqlite3.Error as exc:
+                log.error("Job store write failed: %s", exc)
+            for row in rows:
+                self.writes.task_done()
+
+    def flush(self):
+        " Wait until queued state changes are written "
+        self.writes.join()
+
+    def jobs(self, *states):
+        """ Return [(state, instname, event, updated)] in given states,
+        oldest first
+        """
+        marks = ",".join("?" * len(states))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT state, instname, event, updated FROM jobs "
+                f"WHERE state IN ({marks}) ORDER BY created",
+                states
+            ).fetchall()
+        return [
+            (state, name, json.loads(event), updated)
+            for state, name, event, updated in rows
+        ]
+
+    def known(self, job_id):
+        " Check if job is queued or running "
+        if not self.conn:
+            return False
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM jobs WHERE job_id=?", (str(job_id), )
+            ).fetchone()
+        return bool(row and row[0] != DELETED)
+
+    def prune(self, age=86400):
+        " Drop deleted jobs older than age seconds "
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM jobs WHERE state=? AND updated<?",
+                (DELETED, time.time() - age)
+            )
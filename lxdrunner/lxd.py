@@ -14,12 +14,21 @@ import pylxd
 import pylxd.exceptions
 import urllib3
 
-from . import util
+from . import (
+    alxd, imagecache, jobstore, placement, pool, prebake, ready, template,
+    util, volumes
+)
 from .appconf import config as cfg
 from .applog import log
 
 urllib3.disable_warnings()
 
+INSTALLDIR = pathlib.Path("/opt/runner")
+
+
+class LaunchCancelled(Exception):
+    " Job was cancelled or taken by another runner during launch "
+
 
 def get_client(rname="main", verify=False):
     cert = None
@@ -34,104 +43,303 @@ def get_client(rname="main", verify=False):
 class LXDRunner:
     def __init__(self, connect=True):
         self.client = None
-        if connect:
-            self.connect()
+        # Remote name -> client for cfg.hosts
+        self.clients = dict()
 
         self.workers = dict()
+        # Set when events are queued or worker slots are released
+        self.wakeup = threading.Event()
+        # Called with RunnerEvent of each worker whose instance is gone
+        self.deleted_listeners = []
+        # Called with RunnerEvent in the launch task before the instance
+        # is set up, may block on GitHub
+        self.launch_listeners = []
         self.pool = ThreadPoolExecutor(cfg.max_workers)
+        self.warmpool = pool.WarmPool(self)
+        self.images = prebake.ImageBuilder(self)
+        self.readiness = ready.Readiness()
+        self.volumes = volumes.RunnerVolumes(self)
+        self.templates = template.Templates(self)
+        self.imagecache = imagecache.ImageCache(self)
+        # Runner configs that passed verify_launch, labels -> timestamp
+        self.verified = dict()
+        self.aio = alxd.AsyncLauncher(self)
+        self.placement = placement.Scheduler(self)
+        self.jobs = jobstore.JobStore()
+        if connect:
+            self.connect()
 
     def connect(self):
         self.client = get_client("main")
+        self.clients = {
+            rname: self.client if rname == "main" else get_client(rname)
+            for rname in cfg.hosts
+        }
+        self.placement.discover()
 
     def pushfile(self, src, instance, dst, **exargs):
-        " Push file into instance "
+        " Push file into instance, streamed from disk "
         log.info("Pushing: %s to %s", src, dst)
         with open(src, "rb") as fp:
-            instance.files.put(dst, fp.read(), **exargs)
+            # requests streams file objects in blocks instead of holding
+            # the whole package in memory
+            instance.files.put(dst, fp, **exargs)
 
     def get_workers(self):
-        " Return LXD instances that are workers "
+        " Return LXD instances that are workers, from all hosts "
+        clients = list(self.clients.values()) or [self.client]
         return [
-            wrkr for wrkr in self.client.instances.all()
+            wrkr for client in clients for wrkr in client.instances.all()
             if util.has_prefix(wrkr.name)
         ]
 
+    def instance(self, inst_name):
+        " Get instance from the host it was placed on "
+        return self.placement.client_for(inst_name).instances.get(inst_name)
+
     def worker_count(self):
         return len(self.workers)
 
     def status(self):
-        return f"{ len(self.workers) } workers"
+        idle = sum(self.warmpool.status().values())
+        return f"{ len(self.workers) } workers, { idle } idle"
 
     def script_env(self, evt, instname: str):
         "Setup environment variables for runner script"
 
-        return dict(
-            GHA_TOKEN=evt.token,
+        env = dict(
             GHA_URL=evt.target_url,
             GHA_NAME=instname,
             GHA_EXTRA_LABELS=",".join(evt.rc.labels),
         )
-
-    def launch_instance(self, inst_name: str, rc):
-        " Launch container/vm instance with given name and config "
+        # Runner registered centrally, instance only starts it
+        if evt.jitconfig:
+            env['GHA_JITCONFIG'] = evt.jitconfig
+        else:
+            env['GHA_TOKEN'] = evt.token
+        return env
+
+    def image_fingerprint(self, rc):
+        """ Fingerprint of runner config image, or image name for remote
+        images which can't be resolved without pulling.
+        """
+        alias = self.imagecache.local_alias(rc)
+        if alias:
+            return self.client.images.get_by_alias(alias).fingerprint
+        if ":" in rc.image:
+            return rc.image
+        return self.client.images.get_by_alias(rc.image).fingerprint
+
+    def image_source(self, rc):
+        " Return image source for runner config, local cache if possible "
+        return self.imagecache.source(rc) or util.image_to_source(rc.image)
+
+    def instance_source(self, rc, host=None):
+        """ Return (source, provisioned) for new instances of runner config.
+        Provisioned instances only need runner registration.
+        """
+        if host and not host.shared:
+            # Templates, baked and cached images only exist on main
+            return util.image_to_source(rc.image), False
+        source = self.templates.source(rc)
+        if source:
+            return source, True
+        alias = self.images.source(rc)
+        if alias:
+            return dict(type="image", alias=alias), True
+        return self.image_source(rc), False
+
+    def launch_instance(
+        self,
+        inst_name: str,
+        rc,
+        config=None,
+        source=None,
+        ephemeral=True,
+        devices=None,
+        host=None
+    ):
+        """ Launch container/vm instance with given name and config.
+        Instances go to main unless a placement host is given.
+        """
 
         instcfg = dict(
             name=inst_name,
-            ephemeral=True,
+            ephemeral=ephemeral,
             profiles=rc.profiles,
-            source=util.image_to_source(rc.image),
+            source=source or self.image_source(rc),
             type=rc.type
         )
+        if config:
+            instcfg['config'] = config
+        if devices:
+            instcfg['devices'] = devices
+        client, target = self.client, None
+        if host:
+            client, target = host.client, host.target
         log.warning("Launching instance %s", inst_name)
-        inst = self.client.instances.create(instcfg, wait=True)
+        inst = client.instances.create(instcfg, wait=True, target=target)
         inst.start(wait=True)
         return inst
 
+    def wait_agent(self, inst, installdir):
+        " Wait for instance agent, return False on timeout "
+
+        if inst.type == "virtual-machine":
+            timeout = cfg.ready_timeout_vm
+        else:
+            timeout = cfg.ready_timeout_container
+        return self.readiness.wait(inst, installdir, timeout)
+
+    def run_setup_script(self, inst, script_dst, *args, environment=None):
+        " Execute runner setup script in instance "
+        log.info(f"Executing: {script_dst} {' '.join(args)}")
+        (exitcode, stdout, stderr) = inst.execute(
+            [str(script_dst), *args], environment=environment
+        )
+        if exitcode or log.level <= logging.DEBUG:
+            log.error("===STDOUT====\n%s", stdout)
+            log.error("===STDERR====\n%s", stderr)
+        if exitcode:
+            raise Exception(f"Provisioner exit code: {exitcode}")
+
+    @staticmethod
+    def has_runner_volume(inst):
+        " Check if instance has runner package volume attached "
+        return volumes.DEVICE in (inst.devices or {})
+
     def start_gha_runner(self, inst, evt):
 
         pkg = evt.pkg
 
-        installdir = pathlib.Path("/opt/runner")
         pkg_src = os.path.join(str(cfg.dirs.pkgdir), pkg.linkname)
-        pkg_dst = os.path.join(installdir, "actions-runner.tgz")
-        script_dst = installdir.joinpath(evt.rc.setup_script.name)
-        vars_dst = installdir.joinpath("setupvars.conf")
+        pkg_dst = os.path.join(INSTALLDIR, "actions-runner.tgz")
+        script_dst = INSTALLDIR.joinpath(evt.rc.setup_script.name)
+        vars_dst = INSTALLDIR.joinpath("setupvars.conf")
         # Setup env vars for script
         environment = self.script_env(evt, inst.name)
 
-        # VMs are slow to become available. Retry until
-        # agent responds.
-        for num in range(15):
-            try:
-                inst.files.mk_dir(installdir, mode="0755")
-                log.info("Make dir: %s", installdir)
-                break
-            except Exception:
-                time.sleep(5)
-
-            if num >= 14:
-                log.warning("Runner start timeout, destroying %s", inst.name)
-                inst.stop(force=True)
-                return
+        if not self.wait_agent(inst, INSTALLDIR):
+            raise Exception(f"Runner start timeout {inst.name}")
+        self.check_cancelled(evt)
 
         # Push runner setup script to instance
         self.pushfile(evt.rc.setup_script, inst, script_dst, mode="0755")
         inst.files.put(vars_dst, util.env_str(environment), mode="0755")
-        self.pushfile(pkg_src, inst, pkg_dst, mode="0755")
+        if not self.has_runner_volume(inst):
+            self.pushfile(pkg_src, inst, pkg_dst, mode="0755")
 
         # Execute runner setup script
-        log.info(f"Executing: {script_dst}")
-        (exitcode, stdout,
-         stderr) = inst.execute([str(script_dst)], environment=environment)
-        if exitcode or log.level <= logging.DEBUG:
-            log.error("===STDOUT====\n%s", stdout)
-            log.error("===STDERR====\n%s", stderr)
-        if exitcode:
-            raise Exception(f"Provisioner exit code: {exitcode}")
+        self.run_setup_script(inst, script_dst, environment=environment)
 
         log.info("Provision sucesssful")
 
+    def provision_runner(self, inst, rc, pkg):
+        " Create runner user and unpack runner package, without registering "
+
+        pkg_src = os.path.join(str(cfg.dirs.pkgdir), pkg.linkname)
+        pkg_dst = os.path.join(INSTALLDIR, "actions-runner.tgz")
+        script_dst = INSTALLDIR.joinpath(rc.setup_script.name)
+
+        if not self.wait_agent(inst, INSTALLDIR):
+            raise Exception(f"Runner start timeout {inst.name}")
+
+        self.pushfile(rc.setup_script, inst, script_dst, mode="0755")
+        if not self.has_runner_volume(inst):
+            self.pushfile(pkg_src, inst, pkg_dst, mode="0755")
+        self.run_setup_script(inst, script_dst, "prepare")
+
+        log.info("Prepare sucesssful")
+
+    def build_instance(self, inst_name: str, rc, pkg, config=None):
+        """ Launch, provision and stop a persistent instance to build
+        templates or images from. Deleted again if any step fails.
+        """
+        try:
+            inst = self.launch_instance(
+                inst_name, rc, config=config, ephemeral=False
+            )
+            self.provision_runner(inst, rc, pkg)
+            inst.stop(wait=True)
+        except Exception:
+            try:
+                self.client.instances.get(inst_name).delete(wait=True)
+            except pylxd.exceptions.LXDAPIException:
+                pass
+            raise
+        return inst
+
+    def build_configs(self, flag, pkg_for, build, what):
+        """ Call build(rc, pkg) for each runner config with flag set.
+        pkg_for(rc) returns the runner package for a config. Failures are
+        logged per config and don't stop the others. Returns results.
+        """
+        results = []
+        for rc in cfg.runnermap:
+            if not getattr(rc, flag):
+                continue
+            try:
+                results.append(build(rc, pkg_for(rc)))
+            except Exception as exc:
+                log.error("%s failed for %s", what, rc.name)
+                log.exception(exc)
+        return results
+
+    def register_runner(self, inst, evt):
+        " Register and start runner in a provisioned instance "
+
+        script_dst = INSTALLDIR.joinpath(evt.rc.setup_script.name)
+        vars_dst = INSTALLDIR.joinpath("setupvars.conf")
+        environment = self.script_env(evt, inst.name)
+
+        if not self.wait_agent(inst, INSTALLDIR):
+            raise Exception(f"Runner start timeout {inst.name}")
+        self.check_cancelled(evt)
+
+        inst.files.put(vars_dst, util.env_str(environment), mode="0755")
+        self.run_setup_script(
+            inst, script_dst, "register", environment=environment
+        )
+
+        log.info("Registration sucesssful")
+
+    def place_instance(self, inst_name: str, rc, pkg):
+        """ Choose host and source for a new runner instance.
+        Returns (host, source, provisioned, devices)
+        """
+        host = self.placement.place(inst_name, rc)
+        source, provisioned = self.instance_source(rc, host)
+        devices = {}
+        if not provisioned and (not host or host.shared):
+            devices = self.volumes.devices(rc, pkg, inst_name)
+        return host, source, provisioned, devices
+
+    def prepare_instance(self, inst_name: str, rc, pkg, config=None):
+        " Launch instance and provision it up to runner registration "
+        host, source, provisioned, devices = self.place_instance(
+            inst_name, rc, pkg
+        )
+        inst = self.launch_instance(
+            inst_name,
+            rc,
+            config=config,
+            source=source,
+            devices=devices,
+            host=host
+        )
+        if provisioned:
+            if not self.wait_agent(inst, INSTALLDIR):
+                raise Exception(f"Runner start timeout {inst.name}")
+        else:
+            self.provision_runner(inst, rc, pkg)
+        return inst
+
     def verify_launch(self, evt):
+        " Verify image, profiles and script exist, cached per runner config "
+        verified = self.verified.get(evt.rc.labels)
+        if verified and time.monotonic() - verified < cfg.verify_ttl:
+            return True
+
         errs = []
         try:
             if ":" not in evt.rc.image:
@@ -147,6 +355,7 @@ class LXDRunner:
             for err in errs:
                 log.error("Error: %s", err)
             return False
+        self.verified[evt.rc.labels] = time.monotonic()
         return True
 
     def _cleanup_instance(self, inst_name):
@@ -156,13 +365,48 @@ class LXDRunner:
         log.error("Runner start failed, destroying %s", inst_name)
 
         try:
-            inst = self.client.instances.get(inst_name)
+            inst = self.instance(inst_name)
             inst.stop()
             inst.delete()
         except pylxd.exceptions.LXDAPIException:
+            # No instance, no deleted event to free its resources
+            self.release_volume(inst_name)
+            self.placement.release(inst_name)
+            self.forget_worker(inst_name)
             return False
         return True
 
+    @staticmethod
+    def check_cancelled(evt):
+        if evt.cancelled:
+            raise LaunchCancelled(
+                f"Job {evt.wf_job_id} no longer needs {evt.instname}"
+            )
+
+    def cancel(self, job_id):
+        " Abort launches for job id, returns number of launches marked "
+        marked = 0
+        for evt in list(self.workers.values()):
+            if evt.wf_job_id == job_id and not evt.cancelled:
+                log.warning("Cancelling launch %s", evt.instname)
+                evt.cancelled = True
+                marked += 1
+        return marked
+
+    def prepare_launch(self, evt):
+        " Run launch listeners for event, in the launch task "
+        for listener in self.launch_listeners:
+            listener(evt)
+
+    def release_volume(self, inst_name):
+        " Delete runner volume clone of instance "
+        if not any(rc.runner_volume for rc in cfg.runnermap):
+            return
+        try:
+            self.volumes.release(inst_name)
+        except pylxd.exceptions.LXDAPIException as exc:
+            log.error("Runner volume release failed %s: %s", inst_name, exc)
+
     def _launch(self, evt):
         " Launch GHA Runner, main method "
 
@@ -171,17 +415,50 @@ class LXDRunner:
 
         self.workers[evt.instname] = evt
         if not self.verify_launch(evt):
+            if evt.prewarmed:
+                # Claimed pool instance, its deleted event frees the slot
+                self._cleanup_instance(evt.instname)
+            else:
+                self.forget_worker(evt.instname)
             return False
         # Any error here needs instance cleanup
         noerror = True
         try:
-            inst = self.launch_instance(evt.instname, evt.rc)
-            self.start_gha_runner(inst, evt)
+            self.check_cancelled(evt)
+            self.prepare_launch(evt)
+            if evt.prewarmed:
+                inst = self.instance(evt.instname)
+                inst.config[pool.IDLE_KEY] = "claimed"
+                inst.save(wait=True)
+                self.register_runner(inst, evt)
+            else:
+                host, source, provisioned, devices = self.place_instance(
+                    evt.instname, evt.rc, evt.pkg
+                )
+                inst = self.launch_instance(
+                    evt.instname,
+                    evt.rc,
+                    source=source,
+                    devices=devices,
+                    host=host
+                )
+                self.check_cancelled(evt)
+                if provisioned:
+                    self.register_runner(inst, evt)
+                else:
+                    self.start_gha_runner(inst, evt)
+        except LaunchCancelled as exc:
+            log.warning(exc)
+            self._cleanup_instance(evt.instname)
+            noerror = False
         except Exception as exc:
             log.exception(exc)
             self._cleanup_instance(evt.instname)
             noerror = False
 
+        if noerror:
+            evt.provisioned = True
+            self.jobs.record(evt, jobstore.PROVISIONED)
         return noerror
 
     def launch(self, evt, wait=False):
@@ -193,17 +470,70 @@ class LXDRunner:
                 return
             raise err
 
-        if not wait:
+        # Track worker right away, claimed pool instances may be deleted
+        # before the launch task runs.
+        self.workers[evt.instname] = evt
+
+        if cfg.launch_engine == "async":
+            futr = self.aio.submit(evt)
+            if wait:
+                return futr.result()
+            futr.add_done_callback(handle_done)
+        elif not wait:
             self.pool.submit(self._launch, evt).add_done_callback(handle_done)
         else:
             self._launch(evt)
 
     def start_tasks(self):
-        util.threadit(self.watch_lxd_events, name='LXD-Events')
+        for rname in dict.fromkeys(["main", *cfg.hosts]):
+            util.threadit(
+                self.watch_lxd_events,
+                args=(rname, ),
+                name=f'LXD-Events-{rname}'
+            )
+
+    def process_event(self, message):
+        " Handle LXD lifecycle event "
+        if message.is_text:
+            message = json.loads(message.data)
+        action = message["metadata"]["action"]
+        if action.startswith(("image-", "profile-")):
+            # Image or profile changed, verify again on next launch
+            self.verified.clear()
+        instname = message["metadata"]["source"].split("/")[-1]
+        if util.has_prefix(instname):
+            self.readiness.notify(instname)
+        if action == "instance-deleted":
+            if not util.has_prefix(instname):
+                return
+            self.pool.submit(self.release_volume, instname)
+            self.placement.release(instname)
+            if self.warmpool.discard(instname):
+                return
+            self.forget_worker(instname)
+
+    def forget_worker(self, instname):
+        " Drop worker whose instance is gone and free its slot "
+        job = self.workers.pop(instname, None)
+        log.info(f"Removing {instname} {self.status()}")
+        if job:
+            self.jobs.record(job, jobstore.DELETED)
+            self.release_slot(job.rc)
+            for listener in self.deleted_listeners:
+                listener(job)
+
+    def release_slot(self, rc):
+        " Return worker slot of runner config and wake the dispatcher "
+        try:
+            rc.worksem.release()
+        except ValueError:
+            log.error("Semaphore release fail %s", rc.name)
+        self.wakeup.set()
 
-    def watch_lxd_events(self):
+    def watch_lxd_events(self, rname="main"):
+        " Follow lifecycle events of one remote, clusters report all members "
 
-        client = get_client('main')
+        client = get_client(rname)
 
         ## Workaround for bug in pylxd 2.3.0 : WSS not using certs
         ssl_options = {}
@@ -221,26 +551,10 @@ class LXDRunner:
 
         ## END workaround
 
-        def process_message(message):
-            if message.is_text:
-                message = json.loads(message.data)
-            if message["metadata"]["action"] == "instance-deleted":
-                instname = message["metadata"]["source"].split("/")[-1]
-                if not util.has_prefix(instname):
-                    return
-                try:
-                    job = self.workers.pop(instname, None)
-                    log.info(f"Removing {instname} {self.status()}")
-                    if job:
-                        job.rc.worksem.release()
-                except ValueError:
-                    log.error("Semaphore release fail", instname)
-            pass
-
         evfilter = set([pylxd.EventType.Lifecycle])
         ws_client = client.events(
             event_types=evfilter, websocket_client=FixedWSClient
         )
-        ws_client.received_message = process_message
+        ws_client.received_message = self.process_event
         ws_client.connect()
         ws_client.run()
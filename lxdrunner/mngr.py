@@ -1,38 +1,72 @@
 #!/usr/bin/env python3
 
+import base64
+import concurrent.futures
 import datetime
 import os
 import os.path
 import queue
+import re
 import tempfile
 import time
-import urllib.request
 
 import fastcore.net
 import schedule
-from ghapi.all import GhApi
 
-from . import dtypes, lxd, tls, util, web
+from . import (
+    dedup, dtypes, ghcache, httppool, jobstore, lxd, pkgindex, ratelimit, tls,
+    tokens, util, web, workflow
+)
 from .appconf import config as cfg
 from .applog import log
 
 
+# Checksums in actions/runner release notes
+SHA_RE = re.compile(r"<!-- BEGIN SHA ([\w-]+) -->([0-9a-f]{64})<!--")
+# Full runner packages, no trimmed variants
+ASSET_RE = re.compile(
+    r"^actions-runner-[a-z]+-[a-z0-9]+-[\d.]+\.(tar\.gz|zip)$"
+)
+
+
 class RunManager:
     " LXDRunner Management Class "
 
     def __init__(self):
-        self.ghapi = GhApi(token=cfg.pat)
+        # Keep-alive connections shared by all GitHub traffic
+        self.http = httppool.HTTPPool()
+        self.ghapi = ghcache.CachedGhApi(token=cfg.pat, http=self.http)
         self.lxd = lxd.LXDRunner(connect=False)
         self.runnermap = {item.labels: item for item in cfg.runnermap}
         self.queues = {item.labels: queue.Queue() for item in cfg.runnermap}
+        self.seen = dedup.SeenIndex(cfg.dedup_size, cfg.dedup_ttl)
+        # Jobs cancelled or taken by other runners while queued
+        self.cancelled = dedup.SeenIndex(cfg.dedup_size, cfg.dedup_ttl)
+        self.cancels = dict(queued=0, launching=0)
+        self.prewarms = dict(runs=0, instances=0)
+        # Workflow runs already prewarmed, apart from job dedup stats
+        self.prewarmed = dedup.SeenIndex(cfg.dedup_size, cfg.dedup_ttl)
+        self.discovery = dict(scanned=0, skipped=0, queued=0)
+        # Runners GitHub removed itself, ephemeral runners with job done
+        self.finished = dedup.SeenIndex(cfg.dedup_size, cfg.dedup_ttl)
+        self.deregistered = 0
+        self.ghpool = concurrent.futures.ThreadPoolExecutor(
+            cfg.cleanup_workers, thread_name_prefix="GitHub"
+        )
+        self.lxd.deleted_listeners.append(self.deregister)
+        self.lxd.deleted_listeners.append(self.launch_failed)
+        self.lxd.launch_listeners.append(self.register_jit)
         # For testing
         # self.activecfg = cfg.activecfg
 
         # Cache for various github resources
-        self.reg_tokens = {}
+        self.tokens = tokens.TokenService(self)
         self.orgs = []
         self.repos = []
+        # Packages of the latest release, and of pinned older releases
         self.pkgs = []
+        self.pinned = []
+        self.pkgindex = pkgindex.PackageIndex()
 
     @staticmethod
     def configure():
@@ -43,48 +77,86 @@ class RunManager:
 
     def get_repos(self):
         " Get and cache Github repos for user "
-        self.repos = self.ghapi.repos.list_for_authenticated_user()
+        self.repos = list(
+            util.paginate(self.ghapi.repos.list_for_authenticated_user)
+        )
         return self.repos
 
     def get_orgs(self):
         " Get and cache  Github orgs for user "
-        self.orgs = self.ghapi.orgs.list_for_authenticated_user()
+        self.orgs = list(
+            util.paginate(self.ghapi.orgs.list_for_authenticated_user)
+        )
         return self.orgs
 
     def get_runners(self, ghargs):
-        " Get registered runners for org or repo "
+        " Get registered runners for org or repo, all pages "
 
         if ghargs.get("org"):
             apifunc = self.ghapi.actions.list_self_hosted_runners_for_org
         else:
             apifunc = self.ghapi.actions.list_self_hosted_runners_for_repo
 
-        return apifunc(**ghargs)
+        return list(util.paginate(apifunc, key='runners', **ghargs))
 
-    def get_reg_token(self, ghargs):
-        " Request or return registration token from cache "
+    def delete_runner(self, ghargs, runner_id):
+        " Remove runner registration, already removed runners are ignored "
+        actions = self.ghapi.actions
+        try:
+            if ghargs.get("org"):
+                log.info("Remove runner %s %s", ghargs['org'], runner_id)
+                actions.delete_self_hosted_runner_from_org(
+                    org=ghargs['org'], runner_id=runner_id
+                )
+            else:
+                log.info(
+                    "Remove runner %s/%s %s", ghargs['owner'],
+                    ghargs['repo'], runner_id
+                )
+                actions.delete_self_hosted_runner_from_repo(
+                    owner=ghargs['owner'],
+                    repo=ghargs['repo'],
+                    runner_id=runner_id
+                )
+        except fastcore.net.ExceptionsHTTP[404]:
+            return False
+        return True
 
-        tkey = ghargs.get('target')
-        reg_token = self.reg_tokens.get(tkey)
+    def get_reg_token(self, ghargs):
+        " Return registration token, cached or requested if needed "
+        return self.tokens.get(ghargs)
 
-        def valid_mins(reg_token):
-            td = (
-                datetime.datetime.fromisoformat(reg_token.expires_at) -
-                datetime.datetime.now().astimezone()
+    def get_jitconfig(self, evt):
+        """ Register runner for event with a just in time config.
+        Returns (runner id, encoded config)
+        """
+        if evt.org:
+            path = "/orgs/{org}/actions/runners/generate-jitconfig"
+            route = dict(org=evt.org)
+        else:
+            path = "/repos/{owner}/{repo}/actions/runners/generate-jitconfig"
+            route = dict(owner=evt.owner, repo=evt.repo)
+        log.info("Getting JIT config %s: %s", evt.target, evt.instname)
+        res = self.ghapi(
+            path,
+            "POST",
+            route=route,
+            data=dict(
+                name=evt.instname,
+                runner_group_id=cfg.runner_group_id,
+                labels=util.runner_labels(evt.rc)
             )
-            return td.total_seconds() / 60
-
-        if not reg_token or valid_mins(reg_token) <= 30:
-            if ghargs.get("org"):
-                log.info("Getting GHA token org: %s", tkey)
-                apifunc = self.ghapi.actions.create_registration_token_for_org
-            else:
-                log.info("Getting GHA token repo: %s", tkey)
-                apifunc = self.ghapi.actions.create_registration_token_for_repo
+        )
+        return res.runner.id, res.encoded_jit_config
 
-            self.reg_tokens[tkey] = reg_token = apifunc(**ghargs)
+    def register_jit(self, evt):
+        " Get just in time config for event, runs in its launch task "
+        if cfg.jitconfig:
+            evt.runner_id, evt.jitconfig = self.get_jitconfig(evt)
 
-        return reg_token
+    def refresh_tokens(self):
+        " Refresh registration tokens in the background "
+        self.tokentask = util.threadit(self.tokens.refresh, name="Tokens")
 
     def get_queued_runs_for_repo(self, owner, repo, **kwargs):
         """ Get queued workflow runs for given repo
@@ -95,99 +167,244 @@ class RunManager:
         # actions.list_workflow_runs_for_repo(
         #  owner, repo, actor, branch, event, status, per_page, page)
         #
-        target = dict(owner=owner, repo=repo, status='queued')
-
-        wf_runs = self.ghapi.actions.list_workflow_runs_for_repo(
-            **target
-        ).workflow_runs
+        target = dict(owner=owner, repo=repo)
+        actions = self.ghapi.actions
+
+        wf_runs = list(
+            util.paginate(
+                actions.list_workflow_runs_for_repo,
+                key='workflow_runs',
+                status='queued',
+                **target
+            )
+        )
 
         for run in wf_runs:
-            run.jobs = self.ghapi.actions.list_jobs_for_workflow_run(
-                **target, run_id=run.id
-            ).jobs
+            run.jobs = list(
+                util.paginate(
+                    actions.list_jobs_for_workflow_run,
+                    key='jobs',
+                    run_id=run.id,
+                    **target
+                )
+            )
         return wf_runs
 
-    def get_queued_runs(self):
-        " Get queued workflow jobs from all repos "
-        self.get_repos()
+    @staticmethod
+    def recently_pushed(repo):
+        " Check if repo can have queued runs worth a scan "
+        if repo.get('archived') or repo.get('disabled'):
+            return False
+        if not cfg.discovery_max_age or not repo.get('pushed_at'):
+            return True
+        pushed = datetime.datetime.fromisoformat(
+            repo.pushed_at.replace("Z", "+00:00")
+        )
+        age = datetime.datetime.now(datetime.timezone.utc) - pushed
+        return age.total_seconds() < cfg.discovery_max_age * 3600
 
-        runs = []
-        for repo in self.repos:
-            runs += self.get_queued_runs_for_repo(repo.owner.login, repo.name)
-        return runs
+    def discover_repo(self, repo):
+        """ Queue jobs of queued workflow runs in repo as they are found.
+        Returns number of jobs queued, None if skipped to save rate limit.
+        """
+        if not self.ghapi.budget.allow(ratelimit.DISCOVERY):
+            return None
+        try:
+            wfruns = self.get_queued_runs_for_repo(
+                repo.owner.login, repo.name
+            )
+        except Exception as exc:
+            log.error("Discovery failed %s: %s", repo.full_name, exc)
+            return 0
+        events = list(self.pending_events(wfruns))
+        for evt in events:
+            self.queue_evt(evt)
+        return len(events)
 
-    def submit_pending_runs(self):
-        events = []
-        wfruns = self.get_queued_runs()
+    def pending_events(self, wfruns):
+        " Yield events for queued jobs not already tracked "
         for wfrun in wfruns:
             for job in wfrun.jobs:
+                if job.status != 'queued' or self.lxd.jobs.known(job.id):
+                    continue
                 org = ''
                 if wfrun.repository.owner.type == 'Organization':
                     org = wfrun.repository.owner.login
-                events.append(
-                    dict(
-                        wf_job_id=job.id,
-                        repo=wfrun.repository.name,
-                        owner=wfrun.repository.owner.login,
-                        org=org,
-                        labels=job.labels
-                    )
+                yield dict(
+                    wf_job_id=job.id,
+                    repo=wfrun.repository.name,
+                    owner=wfrun.repository.owner.login,
+                    org=org,
+                    labels=job.labels
                 )
-        log.warning("Submitted %s pending run events", len(events))
-        for evt in events:
-            self.queue_evt(evt)
+
+    def submit_pending_runs(self):
+        """ Scan repos for queued jobs missed while down.
+        Repos are scanned concurrently, stopping short of the API rate
+        limit. Jobs are queued per repo while the scan goes on.
+        """
+        self.get_repos()
+        repos = list(filter(self.recently_pushed, self.repos))
+        log.info("Discovery: scanning %s of %s repos", len(repos),
+                 len(self.repos))
+
+        queued = skipped = 0
+        with concurrent.futures.ThreadPoolExecutor(
+            cfg.discovery_workers, thread_name_prefix="Discovery"
+        ) as executor:
+            futures = [
+                executor.submit(self.discover_repo, repo) for repo in repos
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                count = future.result()
+                if count is None:
+                    skipped += 1
+                else:
+                    queued += count
+
+        if skipped:
+            log.warning("Discovery: %s repos skipped, rate limit low", skipped)
+        self.discovery['scanned'] += len(repos) - skipped
+        self.discovery['skipped'] += len(self.repos) - len(repos) + skipped
+        self.discovery['queued'] += queued
+        log.warning("Submitted %s pending run events", queued)
 
     def get_runner_pkg(self, rc):
-        " Get runner package for given runner config "
+        " Get runner package for given runner config, pinned or latest "
 
-        return next(
-            filter(
-                lambda pkg: (pkg.os, pkg.architecture) ==
-                (rc.runner_os, rc.runner_arch), self.pkgs
-            )
+        pkg = self.pkgindex.get(
+            rc.runner_os, rc.runner_arch, rc.runner_version
         )
+        if not pkg:
+            raise LookupError(
+                f"No runner package {rc.runner_os}-{rc.runner_arch} "
+                f"{rc.runner_version or 'latest'}"
+            )
+        return pkg
+
+    def pinned_versions(self):
+        " Set of (os, arch, version) pinned by runner configs "
+        return {
+            (rc.runner_os, rc.runner_arch, rc.runner_version)
+            for rc in self.runnermap.values() if rc.runner_version
+        }
 
     def get_packages(self):
-        " Get list of runner packages from actions/runner releases"
+        """ Get list of runner packages from actions/runner releases.
+        Packages of the latest release go to self.pkgs, those of older
+        releases pinned by runner_version to self.pinned.
+        """
 
-        def asset2pkg(asset):
+        def asset2pkg(asset, checksums, latest):
             " Convert release assets to obj like list_runner_applications "
             parts = asset.name.split('-')
             os, arch = parts[2:4]
             linkname = "-".join(parts[:4] + ["latest"])
+            version = parts[4].replace(".tar.gz", "").replace(".zip", "")
             return dtypes.RunnerPackage(
                 filename=asset.name,
-                linkname=linkname,
+                linkname=linkname if latest else asset.name,
                 os=os,
                 architecture=arch,
-                download_url=asset.browser_download_url
+                version=version,
+                download_url=asset.browser_download_url,
+                sha256=checksums.get(f"{os}-{arch}", "")
             )
 
+        def release2pkgs(rel, latest):
+            checksums = dict(SHA_RE.findall(rel.body or ""))
+            return [
+                asset2pkg(asset, checksums, latest) for asset in rel.assets
+                if ASSET_RE.match(asset.name)
+            ]
+
         rels = self.ghapi.repos.list_releases('actions', 'runner')
         rels = rels.filter(lambda rel: not rel.prerelease)
-        self.pkgs = list(map(asset2pkg, rels[0].assets))
+        self.pkgs = release2pkgs(rels[0], True)
+
+        pins = self.pinned_versions()
+        found = {(pkg.os, pkg.architecture, pkg.version) for pkg in self.pkgs}
+        self.pinned = []
+        for version in sorted({version for (_, _, version) in pins - found}):
+            try:
+                rel = self.ghapi.repos.get_release_by_tag(
+                    'actions', 'runner', f"v{version}"
+                )
+            except fastcore.net.ExceptionsHTTP[404]:
+                # Reported with the missing pins below
+                continue
+            for pkg in release2pkgs(rel, False):
+                key = (pkg.os, pkg.architecture, pkg.version)
+                if key in pins:
+                    self.pinned.append(pkg)
+                    found.add(key)
+        for pin in sorted(pins - found):
+            log.warning("Pinned runner package %s-%s %s not found", *pin)
         return self.pkgs
 
+    def download_pkg(self, pkg):
+        """ Download runner package unless a verified copy exists.
+        Returns False on failure
+        """
+        filepath = os.path.join(cfg.dirs.pkgdir, pkg.filename)
+        if os.path.exists(filepath):
+            if not pkg.sha256 or util.file_sha256(filepath) == pkg.sha256:
+                return True
+            log.warning("Checksum mismatch, downloading again: %s", filepath)
+            os.unlink(filepath)
+        log.info("Downloading: " + pkg.filename)
+        try:
+            self.http.download(pkg.download_url, filepath, pkg.sha256)
+        except Exception as exc:
+            log.error("Download failed %s: %s", pkg.filename, exc)
+            return False
+        return True
+
     def update_pkg_cache(self):
-        " Update runner package cache to latest version "
+        """ Update runner package cache to latest version.
+        Only packages for runner_os / runner_arch pairs in the runnermap
+        are downloaded, in parallel and verified against the release
+        checksums. The newest runner_versions_kept versions are kept, the
+        package index keeps working when GitHub is unreachable.
+        """
 
         log.info("Updating runner package cache")
 
-        self.get_packages()
+        try:
+            self.get_packages()
+        except Exception as exc:
+            log.error("Runner releases unavailable, using cached: %s", exc)
+            return
 
         if not cfg.dirs.pkgdir.exists():
             cfg.dirs.pkgdir.mkdir(exist_ok=True, parents=True)
 
-        pkgfiles = set()
+        wanted = {
+            (rc.runner_os, rc.runner_arch)
+            for rc in self.runnermap.values()
+        }
+        pkgs = [
+            pkg for pkg in [*self.pkgs, *self.pinned]
+            if (pkg.os, pkg.architecture) in wanted
+        ]
+        with concurrent.futures.ThreadPoolExecutor(
+            max(1, len(pkgs)), thread_name_prefix="Download"
+        ) as executor:
+            done = list(executor.map(self.download_pkg, pkgs))
+
+        # Partial downloads are resumed next time
+        pkgfiles = {f"{pkg.filename}.part" for pkg in pkgs}
+
+        for pkg, ok in zip(pkgs, done):
+            if not ok:
+                continue
+            latest = pkg in self.pkgs
+            self.pkgindex.add(pkg, latest=latest)
+            if not latest:
+                continue
 
-        for pkg in self.pkgs:
-            pkgfiles.update((pkg.filename, pkg.linkname))
-            filepath = os.path.join(cfg.dirs.pkgdir, pkg.filename)
             linkpath = os.path.join(cfg.dirs.pkgdir, pkg.linkname)
-
-            if not os.path.exists(filepath):
-                log.info("Downloading: " + pkg.filename)
-                urllib.request.urlretrieve(pkg.download_url, filepath)
+            pkgfiles.add(pkg.linkname)
 
             # Create a symlink to runner package making it available
             # under a persistent name. In the event pkg is updated
@@ -200,6 +417,11 @@ class RunManager:
             # Atomic replace existing symlink
             os.replace(temp_linkpath, linkpath)
 
+        self.pkgindex.retain(cfg.runner_versions_kept, self.pinned_versions())
+        pkgfiles |= self.pkgindex.files()
+        # Failed downloads keep serving the previous latest version
+        pkgfiles |= {pkg.linkname for pkg in self.pkgindex.latest_pkgs()}
+
         dirfiles = set(os.listdir(cfg.dirs.pkgdir))
         delfiles = dirfiles - pkgfiles
 
@@ -207,6 +429,49 @@ class RunManager:
             log.info(f"Deleting : {fname}")
             os.unlink(os.path.join(cfg.dirs.pkgdir, fname))
 
+        self.pkgindex.save()
+        self.pkgs = self.pkgindex.latest_pkgs()
+
+        self.build_images()
+        self.build_volumes()
+        self.build_templates()
+
+    def cache_images(self):
+        " Pull or refresh cached remote images in the background "
+        self.imagetask = util.threadit(
+            self.lxd.imagecache.refresh_all, name="ImageCache"
+        )
+
+    def build_templates(self):
+        " Build or refresh template instances in the background "
+        if not any(rc.template for rc in self.runnermap.values()):
+            return
+        self.templatetask = util.threadit(
+            self.lxd.templates.refresh,
+            args=(self.get_runner_pkg, ),
+            name="Templates"
+        )
+
+    def build_volumes(self):
+        " Create runner volumes for current packages in the background "
+        if not any(rc.runner_volume for rc in self.runnermap.values()):
+            return
+        self.volumetask = util.threadit(
+            self.lxd.volumes.refresh,
+            args=(self.get_runner_pkg, ),
+            name="RunnerVolumes"
+        )
+
+    def build_images(self):
+        " Build prebaked runner images in the background "
+        if not any(rc.prebake for rc in self.runnermap.values()):
+            return
+        self.buildtask = util.threadit(
+            self.lxd.images.build_all,
+            args=(self.get_runner_pkg, ),
+            name="ImageBuilder"
+        )
+
     def cleanup_runners(self, ghargs):
         " Delete offline runners for given org or repo "
 
@@ -217,29 +482,65 @@ class RunManager:
             return
 
         runners = [
-            run for run in runners.runners
+            run for run in runners
             if run.status == "offline" and util.has_prefix(run.name)
         ]
 
         for run in runners:
-            ghargs['runner_id'] = run.id
-            if ghargs.get("org"):
-                log.info(
-                    "Remove offline runner {org} {runner_id}".format(**ghargs)
-                )
-                self.ghapi.actions.delete_self_hosted_runner_from_org(**ghargs)
-            else:
-                log.info(
-                    "Remove offline runner {owner}/{repo} {runner_id}".format(
-                        **ghargs
-                    )
-                )
-                self.ghapi.actions.delete_self_hosted_runner_from_repo(
-                    **ghargs
-                )
+            self.delete_runner(ghargs, run.id)
+
+    def cleanup_target(self, ghargs):
+        " Cleanup one org or repo, returns False if deferred "
+        if not self.ghapi.budget.allow(ratelimit.CLEANUP):
+            return False
+        try:
+            self.cleanup_runners(ghargs)
+        except Exception as exc:
+            log.error("Cleanup failed %s: %s", ghargs, exc)
+        return True
+
+    def launch_failed(self, evt):
+        " Let redeliveries of a job through again if its runner never ran "
+        if not evt.provisioned and evt.wf_job_id:
+            self.seen.forget(str(evt.wf_job_id))
+
+    def deregister(self, evt):
+        """ Remove runner of a deleted instance from GitHub in the
+        background, unless GitHub removed it after its job completed
+        """
+        if evt.instname in self.finished:
+            return
+        self.ghpool.submit(self.deregister_runner, evt)
+
+    def deregister_runner(self, evt):
+        " Remove runner of event, found by name without a recorded id "
+        if not self.ghapi.budget.allow(ratelimit.CLEANUP):
+            # Periodic cleanup removes it later
+            return
+        if evt.org:
+            ghargs = dict(org=evt.org)
+        else:
+            ghargs = dict(owner=evt.owner, repo=evt.repo)
+        try:
+            runner_id = evt.runner_id or next(
+                (
+                    run.id for run in self.get_runners(ghargs)
+                    if run.name == evt.instname
+                ), None
+            )
+            if runner_id and self.delete_runner(ghargs, runner_id):
+                self.deregistered += 1
+        except Exception as exc:
+            log.error("Deregister failed %s: %s", evt.instname, exc)
 
     def cleanup(self):
-        " Run Github cleanup tasks "
+        """ Run Github cleanup tasks.
+        Targets left when the rate limit budget runs low wait for the
+        next run.
+        """
+        if not self.ghapi.budget.allow(ratelimit.CLEANUP):
+            log.warning("Cleanup deferred, rate limit low")
+            return
 
         self.get_orgs()
         self.get_repos()
@@ -255,23 +556,109 @@ class RunManager:
         for repo in repos:
             args.append(dict(owner=repo.owner.login, repo=repo.name))
 
-        for arg in args:
-            self.cleanup_runners(arg)
+        futures = [
+            self.ghpool.submit(self.cleanup_target, arg) for arg in args
+        ]
+        deferred = sum(
+            not future.result()
+            for future in concurrent.futures.as_completed(futures)
+        )
+        if deferred:
+            log.warning(
+                "Cleanup deferred for %s targets, rate limit low", deferred
+            )
 
     def queue_evt(self, evt):
-        " Queue GH webhook event "
+        " Queue GH webhook event, duplicate job ids are dropped "
+        job_id = evt.get('wf_job_id')
+        if job_id and self.seen.seen(str(job_id)):
+            log.info(f"Duplicate: job run id={job_id}")
+            return
+
         labels = frozenset(evt['labels'])
 
         if not labels in self.runnermap:
             log.warn(f"No matching config for labels {labels}")
             return
         evt['rc'] = self.runnermap.get(labels)
+        self.lxd.warmpool.forecast.record(labels)
 
         evt = dtypes.RunnerEvent(**evt)
+        if not cfg.jitconfig:
+            self.tokens.prefetch(
+                dict(
+                    owner=evt.owner,
+                    repo=evt.repo,
+                    org=evt.org,
+                    target=evt.target
+                )
+            )
         self.queues[labels].put((time.time(), evt))
+        self.lxd.jobs.record(evt, jobstore.QUEUED)
         log.info(
             f"Queueing: job run id={evt.wf_job_id} {evt.owner}/{evt.repo}"
         )
+        self.lxd.wakeup.set()
+
+    def cancel_evt(self, evt):
+        """ Drop queued or launching runner for a job that was cancelled
+        or picked up by a runner we did not launch for it. Completed jobs
+        of our runners mark them as removed by GitHub.
+        """
+        if util.has_prefix(evt.get('runner_name') or ""):
+            if evt.get('status') == "completed":
+                # Ephemeral runner, GitHub removes its registration
+                self.finished.seen(evt['runner_name'])
+            # One of ours took it, the runner launched for this job now
+            # serves another queued job with the same labels
+            return
+        job_id = str(evt['wf_job_id'])
+        if job_id in self.cancelled:
+            return
+        self.cancelled.seen(job_id)
+        marked = self.lxd.cancel(job_id)
+        self.cancels['launching'] += marked
+        log.info(f"Cancelled: job run id={job_id}")
+
+    def prewarm_evt(self, evt):
+        " Prewarm runners for a requested workflow run in the background "
+        if not cfg.prewarm_window:
+            return
+        if self.prewarmed.seen(evt['run_id']):
+            return
+        self.lxd.pool.submit(self.prewarm, evt)
+
+    def workflow_labels(self, evt):
+        " Return runs-on label sets of the workflow jobs "
+        if not self.ghapi.budget.allow(ratelimit.JOBS):
+            return []
+        content = self.ghapi.repos.get_content(
+            evt['owner'], evt['repo'], evt['path'], ref=evt['head_sha']
+        )
+        return workflow.runs_on(base64.b64decode(content.content))
+
+    def prewarm(self, evt):
+        " Launch speculative instances for jobs of a requested run "
+        try:
+            jobs = self.workflow_labels(evt)
+        except Exception as exc:
+            log.info("Prewarm: workflow %s unavailable: %s", evt['path'], exc)
+            return
+        counts = dict()
+        for labels in jobs:
+            if labels in self.runnermap:
+                counts[labels] = counts.get(labels, 0) + 1
+        if not counts or not self.pkgs:
+            return
+        self.prewarms['runs'] += 1
+        for labels, count in counts.items():
+            rc = self.runnermap[labels]
+            # Instances already in the pool serve the first jobs
+            count -= self.lxd.warmpool.size(rc)
+            if count > 0:
+                self.prewarms['instances'] += self.lxd.warmpool.speculate(
+                    rc, self.get_runner_pkg(rc), count
+                )
 
     def process_evt(self, evt: dtypes.RunnerEvent):
         " Process RunnerEvent"
@@ -279,27 +666,163 @@ class RunManager:
             f"Processing: check_run id={evt.wf_job_id} {evt.owner}/{evt.repo}"
         )
 
-        evt.token = self.get_reg_token(evt.dict()).token
+        # JIT configs are requested in the launch task, off this thread
+        if not cfg.jitconfig:
+            evt.token = self.get_reg_token(evt.dict()).token
         evt.pkg = self.get_runner_pkg(evt.rc)
 
+        self.lxd.jobs.record(evt, jobstore.LAUNCHING)
         self.lxd.launch(evt)
 
+    def resume_jobs(self):
+        """ Restore jobs recorded before a restart.
+        Queued jobs and launches that did not finish in the last
+        resume_max_age hours are queued again, provisioned runners that are
+        still running hold a worker slot.
+        """
+        jobs = self.lxd.jobs
+        jobs.open()
+        running = {inst.name for inst in self.lxd.get_workers()}
+        cutoff = time.time() - cfg.resume_max_age * 3600
+        requeued = tracked = expired = 0
+        for (state, instname, event, updated) in jobs.jobs(
+            jobstore.QUEUED, jobstore.LAUNCHING, jobstore.PROVISIONED
+        ):
+            rc = self.runnermap.get(frozenset(event['labels']))
+            if not rc:
+                log.warning("No matching config for job %s", event)
+                continue
+            evt = dtypes.RunnerEvent(**event, rc=rc, instname=instname)
+            if state == jobstore.PROVISIONED:
+                if instname in running and rc.worksem.acquire(blocking=False):
+                    evt.provisioned = True
+                    self.lxd.workers[instname] = evt
+                    tracked += 1
+                else:
+                    jobs.record(evt, jobstore.DELETED)
+                continue
+            if state == jobstore.LAUNCHING and instname in running:
+                # Half provisioned, ephemeral instance is deleted on stop
+                try:
+                    self.lxd.instance(instname).stop(force=True)
+                except Exception as exc:
+                    log.error("Stop failed %s: %s", instname, exc)
+            if updated < cutoff:
+                jobs.record(evt, jobstore.DELETED)
+                expired += 1
+                continue
+            self.queue_evt(event)
+            requeued += 1
+        log.warning(
+            "Resumed jobs: %s queued, %s running, %s expired", requeued,
+            tracked, expired
+        )
+
+    def recover(self):
+        " Remove offline runners and queue jobs missed while down "
+        self.cleanup()
+        self.submit_pending_runs()
+
+    def stats(self):
+        " Runtime counters "
+        return dict(
+            dedup=self.seen.stats(),
+            cancelled=dict(self.cancels),
+            prewarmed=dict(self.prewarms),
+            discovery=dict(self.discovery),
+            ghcache=self.ghapi.cache.stats(),
+            ratelimit=self.ghapi.budget.stats(),
+            tokens=self.tokens.stats(),
+            deregistered=self.deregistered,
+            http=self.http.stats(),
+            warm_target={
+                rc.name: self.lxd.warmpool.target(rc)
+                for rc in self.runnermap.values() if rc.autoscale
+            }
+        )
+
+    def log_stats(self):
+        " Log runtime counters "
+        pairs = util.flatten(self.stats())
+        log.warning("Stats: %s", " ".join(f"{k}={v}" for k, v in pairs))
+
+    def fill_pool(self, rc):
+        " Top up warm pool for given runner config "
+        if not rc.max_idle or not self.pkgs:
+            return
+        try:
+            self.lxd.warmpool.fill(rc, self.get_runner_pkg(rc))
+            if rc.autoscale:
+                self.lxd.warmpool.trim(rc)
+        except Exception as e:
+            log.error("Error filling warm pool")
+            log.exception(e)
+
+    def fill_pools(self):
+        " Top up warm pools for all runner configs "
+        for rc in self.runnermap.values():
+            self.fill_pool(rc)
+
+    def dispatch(self):
+        """ Start at most one queued event per label, round robin.
+        Labels without a free worker slot are skipped instead of blocking
+        the others. Returns True if any event was taken off a queue.
+        """
+        started = False
+        for labels, evtq in self.queues.items():
+            if evtq.empty():
+                continue
+            rc = self.runnermap[labels]
+            # Idle pool instances already hold a worker slot
+            instname = self.lxd.warmpool.claim(rc)
+            if not instname and not rc.worksem.acquire(blocking=False):
+                continue
+            try:
+                (ts, evt) = evtq.get_nowait()
+            except queue.Empty:
+                self.return_slot(rc, instname)
+                continue
+            started = True
+            if evt.wf_job_id in self.cancelled:
+                log.info(f"Skipping cancelled: job run id={evt.wf_job_id}")
+                self.cancels['queued'] += 1
+                self.lxd.jobs.record(evt, jobstore.DELETED)
+                self.return_slot(rc, instname)
+                continue
+            log.info(f"Processing Queue {labels}")
+            try:
+                if instname:
+                    evt.instname = instname
+                    evt.prewarmed = True
+                self.process_evt(evt)
+            except Exception as e:
+                log.error("Error processing queue")
+                log.exception(e)
+                # Not resumed after a restart, the launch would fail again
+                self.lxd.jobs.record(evt, jobstore.DELETED)
+                # GitHub keeps the job queued, a redelivery may retry it
+                self.seen.forget(str(evt.wf_job_id))
+                self.return_slot(rc, instname)
+                continue
+            if instname:
+                self.fill_pool(rc)
+        return started
+
+    def return_slot(self, rc, instname):
+        " Give back claimed pool instance or worker slot "
+        if instname:
+            self.lxd.warmpool.restore(rc, instname)
+        else:
+            self.lxd.release_slot(rc)
+
     def runqueue(self):
-        " Process event queue "
+        " Dispatch queued events when woken by new events or free slots "
         while True:
-            for labels, evtq in self.queues.items():
-                while not evtq.empty(
-                ) and self.runnermap[labels].worksem.acquire():
-                    print(f"Processing Queue {labels}")
-                    try:
-                        (ts, evt) = evtq.get()
-                        self.process_evt(evt)
-                    except queue.Empty as e:
-                        break
-                    except Exception as e:
-                        log.error("Error processing queue")
-                        log.exception(e)
-            time.sleep(1)
+            # Timeout is a safety net, wakeups normally come from events
+            self.lxd.wakeup.wait(timeout=30)
+            self.lxd.wakeup.clear()
+            while self.dispatch():
+                pass
 
     def start_queue_task(self):
         " Start queue runner task "
@@ -308,7 +831,9 @@ class RunManager:
     def start_web_task(self):
         " Start webhooks task "
         self.webtask = util.threadit(
-            web.startserver, args=(self.queue_evt, ), name="Web"
+            web.startserver,
+            args=(self.queue_evt, self.cancel_evt, self.prewarm_evt),
+            name="Web"
         )
 
     def start_schedule_task(self):
@@ -326,10 +851,43 @@ class RunManager:
 
         self.lxd.connect()
         self.lxd.start_tasks()
+        self.lxd.imagecache.load()
+        self.lxd.warmpool.forecast.load()
+        self.ghapi.cache.load()
+        self.tokens.load()
+        self.cache_images()
+        # Known packages are usable before GitHub answers
+        self.pkgindex.load()
+        self.pkgs = self.pkgindex.latest_pkgs()
+
+        if not self.pkgs:
+            # Nothing to launch with until the first download
+            self.update_pkg_cache()
+        else:
+            # Resumed jobs launch from the index meanwhile
+            self.pkgtask = util.threadit(
+                self.update_pkg_cache, name="Packages"
+            )
 
-        self.update_pkg_cache()
-        self.cleanup()
-        self.submit_pending_runs()
+        self.resume_jobs()
+
+        self.lxd.warmpool.reap()
+        self.fill_pools()
+        # GitHub API walk runs while local jobs are dispatched
+        self.recovertask = util.threadit(self.recover, name="Recover")
 
         schedule.every().day.do(self.update_pkg_cache)
         schedule.every(12).hours.do(self.cleanup)
+        schedule.every().day.do(self.lxd.jobs.prune)
+        schedule.every(10).minutes.do(self.log_stats)
+        schedule.every().minute.do(self.fill_pools)
+        schedule.every(5).minutes.do(self.lxd.warmpool.forecast.save)
+        schedule.every(10).minutes.do(self.ghapi.cache.save)
+        schedule.every().minute.do(self.refresh_tokens)
+        if cfg.prewarm_window:
+            schedule.every(10).seconds.do(self.lxd.warmpool.expire)
+        schedule.every().minute.do(self.lxd.placement.refresh)
+        schedule.every(cfg.image_refresh).hours.do(self.cache_images)
+        # Pick up base image changes between runner releases
+        schedule.every().hour.do(self.build_images)
+        schedule.every().hour.do(self.build_templates)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+
+from . import dtypes, util
+
+
+def version_key(version):
+    return tuple(int(part) for part in version.split(".") if part.isdigit())
+
+
+class PackageIndex:
+    """ Downloaded runner packages by (os, arch, version)
+
+    Tracks the latest version per os / arch and older versions kept for
+    pinned configs or rollback. Persisted as JSON under cfg.cache_home,
+    so packages are known at startup without asking GitHub.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        # (os, arch, version) -> RunnerPackage
+        self.entries = dict()
+        # (os, arch) -> latest version
+        self.latest = dict()
+
+    def add(self, pkg, latest=False):
+        with self.lock:
+            self.entries[(pkg.os, pkg.architecture, pkg.version)] = pkg
+            if latest:
+                self.latest[(pkg.os, pkg.architecture)] = pkg.version
+
+    def get(self, runner_os, arch, version=None):
+        " Package for given version or latest, None if unknown "
+        with self.lock:
+            latest = self.latest.get((runner_os, arch))
+            pkg = self.entries.get((runner_os, arch, version or latest))
+        if pkg and pkg.version != latest:
+            # Versioned file name never changes, no link needed
+            pkg = pkg.copy(update=dict(linkname=pkg.filename))
+        return pkg
+
+    def latest_pkgs(self):
+        with self.lock:
+            return [
+                self.entries[(*pair, version)]
+                for pair, version in self.latest.items()
+            ]
+
+    def files(self):
+        with self.lock:
+            return {pkg.filename for pkg in self.entries.values()}
+
+    def retain(self, keep, pinned=()):
+        """ Drop all but the newest keep versions per os / arch, latest
+        and pinned ( os, arch, version ) are always kept. Returns dropped
+        """
+        dropped = []
+        with self.lock:
+            pairs = dict()
+            for key in self.entries:
+                pairs.setdefault(key[:2], []).append(key)
+            for pair, keys in pairs.items():
+                keys.sort(key=lambda key: version_key(key[2]), reverse=True)
+                for key in keys[keep:]:
+                    if key in pinned or self.latest.get(pair) == key[2]:
+                        continue
+                    dropped.append(self.entries.pop(key))
+        return dropped
+
+    def load(self):
+        self.path = util.state_path(self.path, "packages.json")
+        data = util.load_state(self.path)
+        if data is None:
+            return
+        latest = {tuple(item[:2]): item[2] for item in data['latest']}
+        for item in data['packages']:
+            pkg = dtypes.RunnerPackage(**item)
+            self.add(
+                pkg, latest.get((pkg.os, pkg.architecture)) == pkg.version
+            )
+
+    def save(self):
+        " Write index atomically "
+        self.path = util.state_path(self.path, "packages.json")
+        with self.lock:
+            data = json.dumps(
+                dict(
+                    packages=[pkg.dict() for pkg in self.entries.values()],
+                    latest=[
+                        [*pair, version]
+                        for pair, version in self.latest.items()
+                    ]
+                )
+            )
+        util.save_state(self.path, data)
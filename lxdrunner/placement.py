@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import threading
+
+from . import util
+from .appconf import config as cfg
+from .applog import log
+
+# RunnerConf.runner_arch to LXD architecture names
+ARCHES = {"x64": "x86_64", "arm64": "aarch64", "arm": "armv7l"}
+
+# Score reduction for hosts that already have the runner image
+LOCALITY_BONUS = 0.5
+
+
+class Host:
+    """ LXD host or cluster member instances can be placed on.
+    Shared hosts are the main remote or members of its cluster, they see
+    the images, templates and storage volumes built on main.
+    """
+    def __init__(
+        self, remote, client, target=None, architectures=(), shared=False
+    ):
+        self.remote = remote
+        self.client = client
+        self.target = target
+        self.architectures = set(architectures)
+        self.shared = shared
+        self.online = True
+        self.cpus = 1
+        self.mem_used = 0.0
+        self.images = set()
+
+    @property
+    def name(self):
+        return self.target or self.remote
+
+    def __repr__(self):
+        return f"Host({self.name})"
+
+
+class Scheduler:
+    """ Choose the LXD host for each new runner instance
+
+    Hosts come from cfg.hosts, remotes that are LXD clusters expand to
+    their members. Placement skips hosts of the wrong architecture and
+    prefers the least loaded host, load being lxdrunner instances per CPU
+    plus memory in use from the resources API. Hosts that already have the
+    image get a bonus. Without discovered hosts everything stays on main.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.lock = threading.Lock()
+        self.hosts = []
+        # instance name -> Host
+        self.placed = dict()
+
+    def discover(self):
+        " Build host list from cfg.hosts "
+        hosts = []
+        for rname in cfg.hosts:
+            client = self.lxdr.clients[rname]
+            env = client.host_info["environment"]
+            shared = rname == "main"
+            if not env.get("server_clustered"):
+                hosts.append(
+                    Host(
+                        rname,
+                        client,
+                        architectures=env["architectures"],
+                        shared=shared
+                    )
+                )
+                continue
+            members = client.api.cluster.members.get(
+                params=dict(recursion=1)
+            ).json()["metadata"]
+            for member in members:
+                arch = member.get("architecture")
+                hosts.append(
+                    Host(
+                        rname,
+                        client,
+                        target=member["server_name"],
+                        architectures=[arch] if arch else env["architectures"],
+                        shared=shared
+                    )
+                )
+        with self.lock:
+            self.hosts = hosts
+        log.info("Placement: %s", ", ".join(host.name for host in hosts))
+        self.refresh()
+
+    def remotes(self):
+        " Hosts grouped by remote name "
+        groups = dict()
+        for host in self.hosts:
+            groups.setdefault(host.remote, []).append(host)
+        return groups
+
+    def refresh(self):
+        " Update resources, images and instances of all hosts "
+        for rname, hosts in self.remotes().items():
+            try:
+                self.refresh_remote(hosts)
+            except Exception as exc:
+                log.error("Placement refresh failed for %s: %s", rname, exc)
+                for host in hosts:
+                    host.online = False
+
+    def refresh_remote(self, hosts):
+        client = hosts[0].client
+        by_target = {host.target: host for host in hosts}
+
+        images = set()
+        for image in client.api.images.get(params=dict(recursion=1)
+                                           ).json()["metadata"]:
+            images.add(image["fingerprint"])
+            images.update(alias["name"] for alias in image.get("aliases", []))
+
+        if hosts[0].target:
+            members = client.api.cluster.members.get(
+                params=dict(recursion=1)
+            ).json()["metadata"]
+            status = {mem["server_name"]: mem["status"] for mem in members}
+        else:
+            status = {None: "Online"}
+
+        for host in hosts:
+            host.images = images
+            host.online = status.get(host.target) == "Online"
+            if not host.online:
+                continue
+            params = dict(target=host.target) if host.target else {}
+            res = client.api.resources.get(params=params).json()["metadata"]
+            host.cpus = res["cpu"]["total"]
+            host.mem_used = res["memory"]["used"] / res["memory"]["total"]
+
+        # Pick up instances launched before a restart
+        insts = client.api.instances.get(params=dict(recursion=1)
+                                         ).json()["metadata"]
+        with self.lock:
+            for inst in insts:
+                if not util.has_prefix(inst["name"]):
+                    continue
+                host = by_target.get(inst.get("location") or None)
+                if not host:
+                    host = by_target.get(None, hosts[0])
+                self.placed.setdefault(inst["name"], host)
+
+    def running(self, host):
+        return sum(1 for placed in self.placed.values() if placed is host)
+
+    def has_image(self, host, rc):
+        " Check if runner config image resolves locally on host "
+        lxdr = self.lxdr
+        if host.shared and (
+            lxdr.templates.source(rc) or lxdr.images.source(rc)
+            or lxdr.imagecache.local_alias(rc)
+        ):
+            return True
+        if ":" in rc.image:
+            return False
+        return rc.image in host.images
+
+    def eligible(self, host, rc):
+        if not host.online:
+            return False
+        arch = ARCHES[rc.runner_arch]
+        if host.architectures and arch not in host.architectures:
+            return False
+        # Local images only exist where they were imported
+        if not host.shared and ":" not in rc.image:
+            return rc.image in host.images
+        return True
+
+    def score(self, host, rc):
+        " Lower is better "
+        score = self.running(host) / max(host.cpus, 1) + host.mem_used
+        if self.has_image(host, rc):
+            score -= LOCALITY_BONUS
+        return score
+
+    def place(self, instname, rc):
+        """ Choose host for new instance, None if hosts are not discovered.
+        Raises if no host can run the runner config.
+        """
+        with self.lock:
+            if not self.hosts:
+                return None
+            hosts = [host for host in self.hosts if self.eligible(host, rc)]
+            if not hosts:
+                raise Exception(
+                    f"No LXD host for {rc.name} ( {rc.runner_arch} )"
+                )
+            host = min(hosts, key=lambda host: self.score(host, rc))
+            self.placed[instname] = host
+        log.info("Placing %s on %s", instname, host.name)
+        return host
+
+    def host_for(self, instname):
+        return self.placed.get(instname)
+
+    def client_for(self, instname):
+        " pylxd client of the host running instance "
+        host = self.placed.get(instname)
+        return host.client if host else self.lxdr.client
+
+    def release(self, instname):
+        " Forget placement of deleted instance "
+        with self.lock:
+            self.placed.pop(instname, None)
+
+    def status(self):
+        with self.lock:
+            return {host.name: self.running(host) for host in self.hosts}
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import deque
+
+import pylxd.exceptions
+
+from . import forecast, util
+from .appconf import config as cfg
+from .applog import log
+
+IDLE_KEY = "user.lxdrunner.state"
+
+
+class WarmPool:
+    """ Pool of provisioned instances waiting for a job
+
+    Idle instances are booted and have the runner package unpacked, only
+    registration is left to do when a job claims one. Each idle or pending
+    instance holds a slot of its RunnerConf.worksem, ownership of the slot
+    moves to the job when an instance is claimed.
+
+    Speculative instances are launched ahead of expected jobs. Unclaimed
+    ones are kept when the pool is below target and deleted otherwise
+    once cfg.prewarm_window expires.
+
+    With RunnerConf.autoscale the target follows forecast job arrivals,
+    idle instances beyond it are stopped.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.lock = threading.Lock()
+        self.idle = dict()
+        self.pending = dict()
+        self.members = dict()
+        # Speculative instance name -> expiry
+        self.expires = dict()
+        self.forecast = forecast.Forecast()
+
+    def _idle(self, rc):
+        return self.idle.setdefault(rc.labels, deque())
+
+    def _pending(self, rc):
+        return self.pending.setdefault(rc.labels, set())
+
+    def target(self, rc):
+        " Number of instances the pool should hold for given config "
+        if not rc.autoscale:
+            return rc.min_idle
+        return max(rc.min_idle, min(self.forecast.target(rc), rc.max_idle))
+
+    def size(self, rc):
+        " Idle and pending instance count for given config "
+        with self.lock:
+            return len(self._idle(rc)) + len(self._pending(rc))
+
+    def status(self):
+        with self.lock:
+            return {
+                labels: len(idle)
+                for labels, idle in self.idle.items()
+            }
+
+    def fill(self, rc, pkg):
+        " Launch instances in the background until pool target is reached "
+        with self.lock:
+            size = len(self._idle(rc)) + len(self._pending(rc))
+            wanted = min(self.target(rc), rc.max_idle) - size
+            names = self._reserve(rc, wanted)
+
+        if names:
+            log.info("Warm pool: launching %s for %s", len(names), rc.name)
+        self._submit(names, rc, pkg)
+        return len(names)
+
+    def speculate(self, rc, pkg, count):
+        """ Launch instances for jobs expected soon, beyond pool target.
+        Limited by free worker slots, returns number launched.
+        """
+        expiry = time.monotonic() + cfg.prewarm_window
+        with self.lock:
+            names = self._reserve(rc, count)
+            for instname in names:
+                self.expires[instname] = expiry
+
+        if names:
+            log.info("Warm pool: prewarming %s for %s", len(names), rc.name)
+        self._submit(names, rc, pkg)
+        return len(names)
+
+    def _reserve(self, rc, wanted):
+        " Take worker slots and names for new pool instances, holds lock "
+        names = []
+        for num in range(wanted):
+            if not rc.worksem.acquire(blocking=False):
+                break
+            instname = util.make_name()
+            self._pending(rc).add(instname)
+            self.members[instname] = rc
+            names.append(instname)
+        return names
+
+    def _submit(self, names, rc, pkg):
+        for instname in names:
+            self.lxdr.pool.submit(self._prepare, instname, rc, pkg)
+
+    def _prepare(self, instname, rc, pkg):
+        " Launch and provision idle instance "
+        if "ThreadPool" in threading.current_thread().name:
+            threading.current_thread().setName(instname)
+
+        try:
+            self.lxdr.prepare_instance(
+                instname, rc, pkg, config={IDLE_KEY: "idle"}
+            )
+        except Exception as exc:
+            log.exception(exc)
+            self.lxdr._cleanup_instance(instname)
+            if self._forget(instname):
+                self.lxdr.release_slot(rc)
+            return False
+
+        with self.lock:
+            if instname not in self._pending(rc):
+                # Deleted while provisioning, slot already released
+                return False
+            self._pending(rc).discard(instname)
+            self._idle(rc).append(instname)
+        log.info("Warm pool: %s ready for %s", instname, rc.name)
+        # Queued jobs can claim it
+        self.lxdr.wakeup.set()
+        return True
+
+    def claim(self, rc):
+        " Take an idle instance for given config, or None if pool is empty "
+        with self.lock:
+            idle = self._idle(rc)
+            if idle:
+                instname = idle.popleft()
+                del self.members[instname]
+                self.expires.pop(instname, None)
+                return instname
+        return None
+
+    def restore(self, rc, instname):
+        " Return claimed instance to the pool when its job failed to start "
+        with self.lock:
+            self.members[instname] = rc
+            self._idle(rc).appendleft(instname)
+
+    def _forget(self, instname):
+        " Remove instance from pool, return its config "
+        with self.lock:
+            self.expires.pop(instname, None)
+            rc = self.members.pop(instname, None)
+            if rc:
+                self._pending(rc).discard(instname)
+                if instname in self._idle(rc):
+                    self._idle(rc).remove(instname)
+        return rc
+
+    def discard(self, instname):
+        """ Forget pooled instance that was deleted.
+        Returns True if instance belonged to the pool
+        """
+        rc = self._forget(instname)
+        if not rc:
+            return False
+        log.info("Warm pool: removing %s", instname)
+        self.lxdr.release_slot(rc)
+        return True
+
+    def expire(self):
+        """ Handle speculative instances no job claimed in time.
+        Kept as regular pool instances while the pool is below target.
+        """
+        now = time.monotonic()
+        stop = []
+        with self.lock:
+            for instname, expiry in list(self.expires.items()):
+                rc = self.members.get(instname)
+                if expiry > now or instname not in self._idle(rc):
+                    continue
+                del self.expires[instname]
+                if len(self._idle(rc)) + len(self._pending(rc)) <= min(
+                    self.target(rc), rc.max_idle
+                ):
+                    continue
+                # Stays a member holding its slot until the deleted event
+                self._idle(rc).remove(instname)
+                stop.append(instname)
+
+        for instname in stop:
+            log.info("Warm pool: prewarmed %s expired", instname)
+        self._stop(stop)
+        return len(stop)
+
+    def trim(self, rc):
+        " Stop idle instances beyond forecast target, returns number stopped "
+        target = self.target(rc)
+        with self.lock:
+            idle = self._idle(rc)
+            excess = len(idle) + len(self._pending(rc)) - target
+            # Newest first, older instances are claimed first
+            stop = [idle.pop() for num in range(min(excess, len(idle)))]
+
+        if stop:
+            log.info("Warm pool: stopping %s idle for %s", len(stop), rc.name)
+        self._stop(stop)
+        return len(stop)
+
+    def _stop(self, names):
+        """ Stop instances taken off idle, the deleted event releases
+        their slots. Returned to idle if stopping fails.
+        """
+        for instname in names:
+            try:
+                self.lxdr.instance(instname).stop(wait=True)
+            except pylxd.exceptions.LXDAPIException as exc:
+                log.error("Stop failed %s: %s", instname, exc)
+                with self.lock:
+                    rc = self.members.get(instname)
+                    if rc:
+                        self._idle(rc).append(instname)
+
+    def reap(self):
+        " Delete idle instances left behind by a previous run "
+        for inst in self.lxdr.get_workers():
+            if inst.config.get(IDLE_KEY) != "idle":
+                continue
+            log.warning("Warm pool: deleting stale instance %s", inst.name)
+            try:
+                inst.stop(wait=True)
+            except pylxd.exceptions.LXDAPIException:
+                pass
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import hashlib
+import secrets
+import threading
+
+import pylxd.exceptions
+
+from . import util
+from .appconf import config as cfg
+from .applog import log
+
+PROP_KEY = "lxdrunner.key"
+
+
+class ImageBuilder:
+    """ Build runner images with provisioning already applied
+
+    Each RunnerConf with prebake enabled gets a local image published from
+    a provisioned instance. Image aliases are keyed by base image
+    fingerprint, runner version, instance type and setup script so a change
+    to any of them produces a new image.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.lock = threading.Lock()
+        self.baked = dict()
+
+    def image_alias(self, rc, pkg):
+        " Alias of baked image for runner config and package "
+        digest = hashlib.sha256()
+        for part in (
+            self.lxdr.image_fingerprint(rc), pkg.version, rc.type,
+            rc.setup_script.read_bytes()
+        ):
+            digest.update(part if isinstance(part, bytes) else part.encode())
+        return f"{cfg.prefix}-baked-{digest.hexdigest()[:16]}"
+
+    def source(self, rc):
+        " Return local image alias for runner config, None if not built "
+        if not rc.prebake:
+            return None
+        return self.baked.get(rc.labels)
+
+    def exists(self, alias):
+        try:
+            self.lxdr.client.images.get_by_alias(alias)
+        except pylxd.exceptions.NotFound:
+            return False
+        return True
+
+    def build(self, rc, pkg):
+        " Build and publish baked image for runner config if missing "
+
+        alias = self.image_alias(rc, pkg)
+        if self.exists(alias):
+            self.baked[rc.labels] = alias
+            return alias
+
+        log.warning("Building image %s for %s", alias, rc.name)
+        instname = f"{cfg.prefix}-build-{secrets.token_hex(3)}"
+
+        try:
+            inst = self.lxdr.build_instance(instname, rc, pkg)
+
+            properties = {
+                PROP_KEY: util.conf_key(rc),
+                "lxdrunner.image": rc.image,
+                "lxdrunner.runner": pkg.version,
+                "description": f"LXDRunner {rc.name} {pkg.version}",
+            }
+            response = self.lxdr.client.api.images.post(
+                json=dict(
+                    public=False,
+                    source=dict(type=inst.type, name=inst.name),
+                    properties=properties,
+                    aliases=[dict(name=alias)]
+                )
+            )
+            self.lxdr.client.operations.wait_for_operation(
+                response.json()["operation"]
+            )
+        finally:
+            try:
+                self.lxdr.client.instances.get(instname).delete(wait=True)
+            except pylxd.exceptions.LXDAPIException:
+                pass
+
+        self.baked[rc.labels] = alias
+        log.warning("Image %s built for %s", alias, rc.name)
+        self.prune(rc, alias)
+        return alias
+
+    def prune(self, rc, keep):
+        " Delete previous baked images for runner config "
+        for image in self.lxdr.client.images.all():
+            if image.properties.get(PROP_KEY) != util.conf_key(rc):
+                continue
+            if keep in [alias['name'] for alias in image.aliases]:
+                continue
+            log.info("Deleting old baked image %s", image.fingerprint)
+            image.delete(wait=True)
+
+    def build_all(self, pkg_for):
+        " Build images for all runner configs with prebake enabled "
+        if not self.lock.acquire(blocking=False):
+            log.info("Image build already in progress")
+            return
+        try:
+            self.lxdr.build_configs(
+                "prebake", pkg_for, self.build, "Image build"
+            )
+        finally:
+            self.lock.release()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+# Call priorities, lower is more important
+TOKENS = 0
+JOBS = 1
+DISCOVERY = 2
+CLEANUP = 3
+
+NAMES = {TOKENS: "tokens", JOBS: "jobs", DISCOVERY: "discovery",
+         CLEANUP: "cleanup"}
+
+# Share of the hourly limit kept back from lower priorities
+RESERVE = {TOKENS: 0.0, JOBS: 0.02, DISCOVERY: 0.1, CLEANUP: 0.2}
+
+
+class RateBudget:
+    """ GitHub API rate limit budget
+
+    Remaining requests and reset time are taken from the X-RateLimit
+    headers of every response. Lower priority work is deferred while the
+    remaining budget is within the share reserved for higher priorities,
+    so sweeps can't use up the requests needed for registration tokens.
+    """
+    def __init__(self, limit=5000):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.remaining = limit
+        self.reset = 0.0
+        self.deferred = dict.fromkeys(NAMES.values(), 0)
+
+    def update(self, headers):
+        " Track budget from response headers "
+        headers = {name.lower(): val for name, val in headers.items()}
+        if 'x-ratelimit-remaining' not in headers:
+            return
+        with self.lock:
+            self.remaining = int(headers['x-ratelimit-remaining'])
+            self.limit = int(headers.get('x-ratelimit-limit', self.limit))
+            self.reset = float(headers.get('x-ratelimit-reset', self.reset))
+
+    def available(self):
+        " Remaining requests, the full limit once the reset time passed "
+        with self.lock:
+            if self.reset and time.time() >= self.reset:
+                return self.limit
+            return self.remaining
+
+    def allow(self, priority):
+        " Check if call of given priority may run, counts deferrals "
+        if self.available() > self.limit * RESERVE[priority]:
+            return True
+        with self.lock:
+            self.deferred[NAMES[priority]] += 1
+        return False
+
+    def stats(self):
+        remaining = self.available()
+        with self.lock:
+            return dict(
+                remaining=remaining,
+                limit=self.limit,
+                reset_in=max(0, int(self.reset - time.time())),
+                deferred=dict(self.deferred)
+            )
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+import pylxd.exceptions
+
+from .applog import log
+
+# LXD status code for running instances
+RUNNING = 103
+
+MIN_DELAY = 0.05
+MAX_DELAY = 2.0
+
+
+def is_ready(inst, path):
+    """ Check if instance agent responds.
+    VMs report no processes until lxd-agent is up, containers are
+    usable as soon as init is running. Creating path confirms the file
+    API works.
+    """
+    try:
+        state = inst.state()
+        if state.status_code != RUNNING or not state.processes > 0:
+            return False
+        inst.files.mk_dir(path, mode="0755")
+    except pylxd.exceptions.LXDAPIException as exc:
+        # Provisioned images already have path
+        return "exists" in str(exc)
+    except Exception:
+        return False
+    return True
+
+
+class Readiness:
+    """ Wait for instances to become ready
+
+    Polls with a short, growing interval and is woken early by LXD
+    lifecycle events for the instance, so launch continues right after
+    the agent becomes reachable.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.seen = dict()
+        # Callables notified of instance events, e.g. async launcher
+        self.listeners = []
+
+    def notify(self, instname):
+        " Wake waiters on instance event "
+        with self.cond:
+            if instname in self.seen:
+                self.seen[instname] += 1
+                self.cond.notify_all()
+        for listener in self.listeners:
+            listener(instname)
+
+    def wait(self, inst, path, timeout):
+        " Wait until instance is ready, return False on timeout "
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = MIN_DELAY
+
+        with self.cond:
+            self.seen[inst.name] = 0
+        try:
+            while True:
+                if is_ready(inst, path):
+                    log.info(
+                        "Instance %s ready in %.2fs", inst.name,
+                        time.monotonic() - start
+                    )
+                    return True
+                with self.cond:
+                    seen = self.seen[inst.name]
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait_for(
+                        lambda: self.seen[inst.name] != seen,
+                        timeout=min(delay, remaining)
+                    )
+                    if self.seen[inst.name] != seen:
+                        # Event arrived, probe right away
+                        delay = MIN_DELAY
+                    else:
+                        delay = min(delay * 2, MAX_DELAY)
+        finally:
+            with self.cond:
+                self.seen.pop(inst.name, None)
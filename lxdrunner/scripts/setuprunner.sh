@@ -10,6 +10,8 @@ SETUPFILE="$PKGDIR/setupvars.conf"
 
 RUNNERUSER=runner
 RUNNERHOME="/home/$RUNNERUSER"
+# Extracted runner tree attached as a volume by lxdrunner
+RUNNERVOL="$PKGDIR/actions-runner"
 
 CHECK_ARGS="GHA_TOKEN GHA_URL GHA_NAME"
 
@@ -18,18 +20,29 @@ fail() {
     exit 1
 }
 
+# Setup phase: prepare | register | all ( default )
+PHASE="${1:-all}"
+
 [ -f $SETUPFILE ] && source $SETUPFILE
 
-# Ensure required vars are set
-ERRS=""
-for var in $CHECK_ARGS ; do
-    eval val=\$$var
-    if [ -z "$val" ] ; then
-        ERRS="${ERRS}${var} is not set\n"
-    fi
-done
+# Just in time config, runner is already registered
+GHA_JITCONFIG="${GHA_JITCONFIG:-}"
+if [ -n "$GHA_JITCONFIG" ] ; then
+    CHECK_ARGS="GHA_JITCONFIG GHA_NAME"
+fi
 
-[ -n "$ERRS" ] && fail "$ERRS"
+# Ensure required vars are set
+check_vars(){
+    ERRS=""
+    for var in $CHECK_ARGS ; do
+        eval val=\$$var
+        if [ -z "$val" ] ; then
+            ERRS="${ERRS}${var} is not set\n"
+        fi
+    done
+
+    [ -z "$ERRS" ] || fail "$ERRS"
+}
 
 # User handling
 
@@ -38,7 +51,13 @@ setup_user(){
     # Avoid adduser race condition with cloud-init. Wait till done.
     which cloud-init && cloud-init status -w
 
-    adduser runner --disabled-password --gecos ""
+    # Runner volumes are populated owned by the runner uid
+    UIDARGS=""
+    if [ -d "$RUNNERVOL" ] ; then
+        UIDARGS="--uid $(stat -c %u "$RUNNERVOL")"
+    fi
+
+    adduser runner $UIDARGS --disabled-password --gecos ""
     [ "$?" -eq "0" ] || fail "Add user failed"
     adduser runner sudo
     [ "$?" -eq "0" ] || fail "Add group failed"
@@ -49,9 +68,16 @@ setup_user(){
 
 unpack(){
     [ -d "$RUNNERHOME" ] || fail "Home $RUNNERHOME doesnt exist"
+
+    if [ -x "$RUNNERVOL/config.sh" ] ; then
+        echo "Using runner volume $RUNNERVOL"
+        return
+    fi
+
     [ -f "$PKGFILE" ] || fail "Package $PKGFILE doesnt exist"
 
     sudo -u $RUNNERUSER tar -xvf $PKGFILE  -C $RUNNERHOME >/dev/null || fail "Unpack failed"
+    rm -f $PKGFILE
 }
 
 delaypoweroff(){
@@ -68,7 +94,11 @@ background(){
 }
 
 start_runner(){
-  sudo -u $RUNNERUSER ./run.sh
+  if [ -n "$GHA_JITCONFIG" ] ; then
+    sudo -u $RUNNERUSER ./run.sh --jitconfig "$GHA_JITCONFIG"
+  else
+    sudo -u $RUNNERUSER ./run.sh
+  fi
   delaypoweroff
 }
 
@@ -82,9 +112,16 @@ dereg_runner(){
 }
 
 begin_runner(){
-    cd $RUNNERHOME
+    if [ -x "$RUNNERVOL/config.sh" ] ; then
+        cd $RUNNERVOL
+    else
+        cd $RUNNERHOME
+    fi
 
-    if reg_runner ; then
+    if [ -n "$GHA_JITCONFIG" ] ; then
+        echo "Using JIT config. Starting up."
+        background start_runner
+    elif reg_runner ; then
         echo "Runner registered. Starting up."
         background start_runner
     else
@@ -93,9 +130,24 @@ begin_runner(){
     fi
 }
 
-
-setup_user
-unpack
-begin_runner
+# prepare: user and package only, used for warm pool instances
+# register: register and start runner in a prepared instance
+
+case "$PHASE" in
+    prepare)
+        setup_user
+        unpack
+        ;;
+    register)
+        check_vars
+        begin_runner
+        ;;
+    *)
+        check_vars
+        setup_user
+        unpack
+        begin_runner
+        ;;
+esac
 
 exit
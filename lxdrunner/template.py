@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import hashlib
+import secrets
+import threading
+
+import pylxd.exceptions
+
+from . import util
+from .appconf import config as cfg
+from .applog import log
+
+BASE_KEY = "user.lxdrunner.base"
+RUNNER_KEY = "user.lxdrunner.runner"
+SCRIPT_KEY = "user.lxdrunner.script"
+
+
+class Templates:
+    """ Provisioned, stopped template instances to copy runners from
+
+    On ZFS/btrfs pools an instance copy is a cheap snapshot clone, far
+    faster than unpacking an image and running the provisioner. Templates
+    record the base image, runner version and setup script they were built
+    from and are rebuilt when any of them changes.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.lock = threading.Lock()
+        self.current = dict()
+
+    @staticmethod
+    def prefix(rc):
+        return f"{cfg.prefix}-template-{util.conf_key(rc)}-"
+
+    def state(self, rc, pkg):
+        " Config describing what a template for rc and pkg is built from "
+        return {
+            BASE_KEY: self.lxdr.image_fingerprint(rc),
+            RUNNER_KEY: pkg.version,
+            SCRIPT_KEY: hashlib.sha256(rc.setup_script.read_bytes()
+                                       ).hexdigest()[:16],
+        }
+
+    def source(self, rc):
+        " Return copy source for runner config, None if no template "
+        if not rc.template:
+            return None
+        name = self.current.get(rc.labels)
+        if not name:
+            return None
+        return dict(
+            type="copy", source=name, instance_only=rc.template_instance_only
+        )
+
+    def find(self, rc):
+        " Return existing template instances for runner config "
+        return [
+            inst for inst in self.lxdr.client.instances.all()
+            if inst.name.startswith(self.prefix(rc))
+        ]
+
+    def ensure(self, rc, pkg):
+        " Build template for runner config if missing or outdated "
+
+        wanted = self.state(rc, pkg)
+        templates = self.find(rc)
+        for inst in templates:
+            if all(inst.config.get(key) == val for key, val in wanted.items()):
+                self.current[rc.labels] = inst.name
+                break
+        else:
+            self.current[rc.labels] = self.build(rc, pkg, wanted)
+
+        for inst in templates:
+            if inst.name == self.current[rc.labels]:
+                continue
+            log.info("Deleting old template %s", inst.name)
+            try:
+                inst.delete(wait=True)
+            except pylxd.exceptions.LXDAPIException as exc:
+                # Copy in progress, retried on next refresh
+                log.error("Delete failed %s: %s", inst.name, exc)
+        return self.current[rc.labels]
+
+    def build(self, rc, pkg, state):
+        " Launch, provision and stop a new template instance "
+        instname = self.prefix(rc) + secrets.token_hex(3)
+        log.warning("Building template %s for %s", instname, rc.name)
+        self.lxdr.build_instance(instname, rc, pkg, config=state)
+        log.warning("Template %s ready", instname)
+        return instname
+
+    def refresh(self, pkg_for):
+        " Build or refresh templates for all runner configs using them "
+        if not self.lock.acquire(blocking=False):
+            log.info("Template refresh already in progress")
+            return
+        try:
+            self.lxdr.build_configs(
+                "template", pkg_for, self.ensure, "Template build"
+            )
+        finally:
+            self.lock.release()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import base64
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from fastcore.xtras import dict2obj
+
+from . import util
+from .appconf import config as cfg
+from .applog import log
+
+# Tokens with fewer minutes left are not handed out
+MIN_VALID = 30
+# Tokens are refreshed in the background with fewer minutes left
+REFRESH_MINS = 40
+# Targets without jobs for this many seconds are no longer refreshed
+ACTIVE_TTL = 86400
+
+
+def valid_mins(reg_token):
+    td = (
+        datetime.datetime.fromisoformat(reg_token.expires_at) -
+        datetime.datetime.now().astimezone()
+    )
+    return td.total_seconds() / 60
+
+
+class TokenService:
+    """ Registration tokens per org or repo target
+
+    Tokens of targets that had jobs recently are refreshed in the
+    background before they get close to expiry, and fetched as soon as a
+    job is queued for a new target, so launches don't wait on GitHub.
+    Only one request per target is in flight, concurrent callers wait for
+    its result. Tokens are kept encrypted under cfg.cache_home with a key
+    derived from the GitHub PAT.
+    """
+    def __init__(self, manager, path=None):
+        self.manager = manager
+        self.path = path
+        self.lock = threading.Lock()
+        # Held by the refresh in progress
+        self.refreshing = threading.Lock()
+        # target -> token
+        self.tokens = dict()
+        # target -> Future of request in flight
+        self.inflight = dict()
+        # target -> (ghargs, last used)
+        self.targets = dict()
+        self.counts = dict(fetched=0, joined=0, waited=0)
+        # Tokens changed since last save
+        self.dirty = False
+
+    @staticmethod
+    def fernet():
+        digest = hashlib.sha256(b"lxdrunner-tokens:" + cfg.pat.encode())
+        return Fernet(base64.urlsafe_b64encode(digest.digest()))
+
+    def _use(self, ghargs):
+        target = ghargs.get('target')
+        with self.lock:
+            self.targets[target] = (
+                dict(owner=ghargs.get('owner'), repo=ghargs.get('repo'),
+                     org=ghargs.get('org'), target=target),
+                time.time()
+            )
+            token = self.tokens.get(target)
+        return target, token
+
+    def get(self, ghargs):
+        " Return cached token, or request one and wait for it "
+        target, token = self._use(ghargs)
+        if token and valid_mins(token) > MIN_VALID:
+            return token
+        with self.lock:
+            self.counts['waited'] += 1
+        return self.fetch(ghargs)
+
+    def prefetch(self, ghargs):
+        " Request token in the background unless a valid one is cached "
+        target, token = self._use(ghargs)
+        if target in self.inflight:
+            return
+        if not token or valid_mins(token) <= REFRESH_MINS:
+            util.threadit(self._fetch_quiet, args=(ghargs, ), name="Token")
+
+    def fetch(self, ghargs):
+        " Request token, joins a request already in flight for target "
+        target = ghargs.get('target')
+        with self.lock:
+            flight = self.inflight.get(target)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[target] = concurrent.futures.Future()
+            else:
+                self.counts['joined'] += 1
+        if not leader:
+            return flight.result()
+
+        actions = self.manager.ghapi.actions
+        try:
+            if ghargs.get("org"):
+                log.info("Getting GHA token org: %s", target)
+                token = actions.create_registration_token_for_org(
+                    org=ghargs['org']
+                )
+            else:
+                log.info("Getting GHA token repo: %s", target)
+                token = actions.create_registration_token_for_repo(
+                    owner=ghargs['owner'], repo=ghargs['repo']
+                )
+        except Exception as exc:
+            with self.lock:
+                del self.inflight[target]
+            flight.set_exception(exc)
+            raise
+
+        # Cached before the flight ends, so no caller finds neither
+        with self.lock:
+            self.tokens[target] = token
+            self.counts['fetched'] += 1
+            self.dirty = True
+            del self.inflight[target]
+        flight.set_result(token)
+        return token
+
+    def _fetch_quiet(self, ghargs):
+        try:
+            self.fetch(ghargs)
+        except Exception as exc:
+            log.error("Token request failed %s: %s", ghargs['target'], exc)
+
+    def refresh(self):
+        " Refresh tokens of active targets close to expiry, then save "
+        if not self.refreshing.acquire(blocking=False):
+            log.info("Token refresh already in progress")
+            return 0
+        try:
+            return self._refresh()
+        finally:
+            self.refreshing.release()
+
+    def _refresh(self):
+        cutoff = time.time() - ACTIVE_TTL
+        with self.lock:
+            for target, (ghargs, used) in list(self.targets.items()):
+                if used < cutoff:
+                    del self.targets[target]
+                    self.tokens.pop(target, None)
+            due = [
+                ghargs for target, (ghargs, used) in self.targets.items()
+                if target not in self.tokens
+                or valid_mins(self.tokens[target]) <= REFRESH_MINS
+            ]
+        for ghargs in due:
+            self._fetch_quiet(ghargs)
+        if self.dirty:
+            self.save()
+        return len(due)
+
+    def stats(self):
+        with self.lock:
+            return dict(targets=len(self.targets), **self.counts)
+
+    def decrypt(self, blob):
+        try:
+            return json.loads(self.fernet().decrypt(blob))
+        except InvalidToken:
+            raise ValueError("PAT changed or file corrupt")
+
+    def load(self):
+        self.path = util.state_path(self.path, "tokens.bin")
+        data = util.load_state(self.path, self.decrypt)
+        if data is None:
+            return
+        now = time.time()
+        with self.lock:
+            for target, item in data.items():
+                token = dict2obj(item['token'])
+                if valid_mins(token) > MIN_VALID:
+                    self.tokens[target] = token
+                self.targets[target] = (item['ghargs'], now)
+
+    def save(self):
+        " Write tokens encrypted and atomically "
+        self.path = util.state_path(self.path, "tokens.bin")
+        with self.lock:
+            self.dirty = False
+            data = {
+                target: dict(
+                    token=dict(token=token.token, expires_at=token.expires_at),
+                    ghargs=self.targets[target][0]
+                )
+                for target, token in self.tokens.items()
+                if target in self.targets
+            }
+        util.save_state(
+            self.path,
+            self.fernet().encrypt(json.dumps(data).encode())
+        )
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
+import hashlib
+import itertools
+import json
+import os
 import secrets
+import tempfile
 import threading
 
 from .appconf import config as cfg
+from .applog import log
 
 #
 # Helper Functions
@@ -20,12 +26,84 @@ def make_name():
     return "{}-{}".format(cfg.prefix, secrets.token_hex(3))
 
 
+def conf_key(rc):
+    " Stable short key for a runner config, derived from its labels "
+    return hashlib.sha256(",".join(sorted(rc.labels)).encode('utf8')
+                          ).hexdigest()[:12]
+
+
+def file_sha256(path):
+    " Hex SHA-256 digest of file contents "
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def state_path(path, name):
+    " Path of a state file, name under cfg.cache_home unless path is set "
+    return path or cfg.cache_home / name
+
+
+def load_state(path, decode=json.loads):
+    """ Return decoded contents of a state file, None if missing or
+    unreadable ( decode raising ValueError )
+    """
+    try:
+        with open(path, "rb") as fp:
+            return decode(fp.read())
+    except FileNotFoundError:
+        return None
+    except ValueError as exc:
+        log.error("State %s unreadable, starting over: %s", path, exc)
+        return None
+
+
+def save_state(path, data):
+    " Replace state file with data, str or bytes, atomically "
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as fp:
+        fp.write(data)
+    os.replace(temp, path)
+
+
 def threadit(func, **kwargs):
     thread = threading.Thread(target=func, daemon=True, **kwargs)
     thread.start()
     return thread
 
 
+def flatten(data, prefix=""):
+    " Yield (dotted.key, value) pairs of nested dicts "
+    for key, val in data.items():
+        if isinstance(val, dict):
+            yield from flatten(val, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", val
+
+
+def paginate(oper, *args, key=None, per_page=100, **kwargs):
+    """ Yield items from all pages of a GitHub list operation.
+    key selects the list in wrapped responses like workflow_runs.
+    """
+    for page in itertools.count(1):
+        res = oper(*args, per_page=per_page, page=page, **kwargs)
+        items = res[key] if key else res
+        yield from items
+        if len(items) < per_page:
+            break
+
+
+def runner_labels(rc):
+    " All labels of a runner, including the defaults config.sh adds "
+    os_label = dict(linux="Linux", win="Windows", osx="macOS")
+    return sorted(
+        set(rc.labels) |
+        {"self-hosted", os_label[rc.runner_os], rc.runner_arch.upper()}
+    )
+
+
 def env_str(data):
 
     sdata = ""
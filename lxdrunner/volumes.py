@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import pathlib
+import secrets
+import threading
+
+import pylxd.exceptions
+
+from .appconf import config as cfg
+from .applog import log
+
+DEVICE = "lxdrunner-pkg"
+MOUNTPATH = "/opt/runner/actions-runner"
+BASE_KEY = "user.lxdrunner.base"
+READY_KEY = "user.lxdrunner.ready"
+OWNER_KEY = "user.lxdrunner.owner"
+# Owner of the extracted tree, setuprunner.sh creates the runner user
+# with the uid of an attached volume so clones need no chown
+RUNNER_UID = 1500
+
+
+class RunnerVolumes:
+    """ Custom storage volumes holding an extracted runner tree
+
+    One base volume is kept per runner package version. Each instance gets
+    a copy-on-write clone of the base volume attached at MOUNTPATH, the
+    runner writes its registration and logs into its own tree so a shared
+    read-only mount is not usable. Clones are deleted with their instance
+    and base volumes of old versions once no clone references them.
+    """
+    def __init__(self, lxdr):
+        self.lxdr = lxdr
+        self.lock = threading.Lock()
+
+    @property
+    def pool(self):
+        return self.lxdr.client.storage_pools.get(cfg.storage_pool)
+
+    @staticmethod
+    def base_name(pkg):
+        return f"{cfg.prefix}-runner-{pkg.os}-{pkg.architecture}-{pkg.version}"
+
+    @staticmethod
+    def clone_name(instname):
+        return f"{instname}-runner"
+
+    def get(self, name):
+        try:
+            return self.pool.volumes.get("custom", name)
+        except pylxd.exceptions.NotFound:
+            return None
+
+    def is_ready(self, pkg):
+        " Check base volume for package exists and is populated "
+        vol = self.get(self.base_name(pkg))
+        return bool(
+            vol and vol.config.get(READY_KEY) == "true"
+            and vol.config.get(OWNER_KEY) == str(RUNNER_UID)
+        )
+
+    def ensure(self, rc, pkg):
+        " Create and populate base volume for package if missing "
+        name = self.base_name(pkg)
+        with self.lock:
+            if self.is_ready(pkg):
+                return name
+            if not self.get(name):
+                log.warning("Creating runner volume %s", name)
+                self.pool.volumes.create(dict(name=name, config={}), wait=True)
+            self.populate(rc, pkg, name)
+            vol = self.get(name)
+            vol.config[READY_KEY] = "true"
+            vol.config[OWNER_KEY] = str(RUNNER_UID)
+            vol.save(wait=True)
+        log.warning("Runner volume %s ready", name)
+        return name
+
+    def populate(self, rc, pkg, name):
+        """ Extract runner package into volume using a helper instance.
+        The tree is owned by RUNNER_UID once here instead of per launch.
+        """
+        instname = f"{cfg.prefix}-volume-{secrets.token_hex(3)}"
+        pkg_src = os.path.join(str(cfg.dirs.pkgdir), pkg.filename)
+        pkg_dst = "/root/actions-runner.tgz"
+        devices = {
+            DEVICE:
+            dict(
+                type="disk", pool=cfg.storage_pool, source=name, path=MOUNTPATH
+            )
+        }
+        try:
+            inst = self.lxdr.launch_instance(instname, rc, devices=devices)
+            if not self.lxdr.wait_agent(inst, pathlib.Path("/opt/runner")):
+                raise Exception(f"Volume helper start timeout {instname}")
+            self.lxdr.pushfile(pkg_src, inst, pkg_dst, mode="0600")
+            owner = f"{RUNNER_UID}:{RUNNER_UID}"
+            for command in (
+                ["tar", "-xzf", pkg_dst, "-C", MOUNTPATH],
+                ["chown", "-R", owner, MOUNTPATH],
+            ):
+                (exitcode, stdout, stderr) = inst.execute(command)
+                if exitcode:
+                    log.error("===STDERR====\n%s", stderr)
+                    raise Exception(f"Volume populate exit code: {exitcode}")
+        finally:
+            try:
+                self.lxdr.client.instances.get(instname).stop(wait=True)
+            except pylxd.exceptions.LXDAPIException:
+                pass
+
+    def devices(self, rc, pkg, instname):
+        """ Clone base volume for a new instance.
+        Returns instance devices, empty when runner volumes are not in use
+        """
+        if not rc.runner_volume or not pkg or not self.is_ready(pkg):
+            return {}
+        base = self.base_name(pkg)
+        clone = self.clone_name(instname)
+        self.pool.volumes.create(
+            dict(
+                name=clone,
+                config={BASE_KEY: base},
+                source=dict(type="copy", name=base, pool=cfg.storage_pool)
+            ),
+            wait=True
+        )
+        return {
+            DEVICE:
+            dict(
+                type="disk",
+                pool=cfg.storage_pool,
+                source=clone,
+                path=MOUNTPATH
+            )
+        }
+
+    def release(self, instname):
+        " Delete volume clone of deleted instance "
+        vol = self.get(self.clone_name(instname))
+        if vol and vol.config.get(BASE_KEY):
+            log.info("Deleting runner volume %s", vol.name)
+            vol.delete()
+
+    def collect(self, keep):
+        " Delete base volumes not in keep that no clone references "
+        vols = [self.get(vol.name) for vol in self.pool.volumes.all()]
+        vols = [vol for vol in vols if vol and vol.type == "custom"]
+
+        inuse = set(keep)
+        inuse.update(vol.config.get(BASE_KEY) for vol in vols)
+        prefix = f"{cfg.prefix}-runner-"
+        for vol in vols:
+            if not vol.name.startswith(prefix) or vol.name in inuse:
+                continue
+            if vol.config.get(BASE_KEY):
+                continue
+            log.warning("Deleting old runner volume %s", vol.name)
+            try:
+                vol.delete()
+            except pylxd.exceptions.LXDAPIException as exc:
+                log.error("Delete failed %s: %s", vol.name, exc)
+
+    def refresh(self, pkg_for):
+        " Create volumes for current packages and remove old ones "
+        keep = set(
+            self.lxdr.build_configs(
+                "runner_volume", pkg_for, self.ensure, "Runner volume"
+            )
+        )
+        if keep:
+            self.collect(keep)
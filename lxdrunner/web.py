@@ -47,10 +47,14 @@ def githubhook():
 
     data = request.json
 
+    if ghevt == "workflow_run":
+        return workflow_run(data)
+
     job = data.get("workflow_job", {})
-    # Event should be workflow_job, status == queued, self-hosted
+    # Event should be workflow_job, self-hosted
     if (
-        ghevt != "workflow_job" or job.get("status") != "queued"
+        ghevt != "workflow_job"
+        or job.get("status") not in ("queued", "in_progress", "completed")
         or "self-hosted" not in job.get("labels")
     ):
 
@@ -65,12 +69,40 @@ def githubhook():
         labels=job.get("labels")
     )
     log.info(f"Accepted event: {ghevt} , action={data['action']}")
-    current_app.queue_evt(gh)
+    if job.get("status") == "queued":
+        current_app.queue_evt(gh)
+    else:
+        # Job no longer waiting for a runner
+        gh['runner_name'] = job.get("runner_name")
+        gh['status'] = job.get("status")
+        current_app.cancel_evt(gh)
+
+    return "OK"
+
 
+def workflow_run(data):
+    " Requested workflow runs announce jobs that will be queued shortly "
+    run = data.get("workflow_run", {})
+    if data.get("action") != "requested" or not run.get("path"):
+        log.debug(f"Skipping event: workflow_run, action={data.get('action')}")
+        return "Skipping Event"
+
+    repo = data.get("repository", {})
+    current_app.prewarm_evt(
+        dict(
+            run_id=run.get("id"),
+            repo=repo.get("name"),
+            owner=repo.get("owner", {}).get("login"),
+            path=run.get("path"),
+            head_sha=run.get("head_sha")
+        )
+    )
     return "OK"
 
 
-def startserver(queue_evt):
+def startserver(queue_evt, cancel_evt, prewarm_evt):
     app.queue_evt = queue_evt
+    app.cancel_evt = cancel_evt
+    app.prewarm_evt = prewarm_evt
     tls = 'adhoc' if cfg.web_tls else None
     app.run(host=str(cfg.web_host), port=cfg.web_port, ssl_context=tls)
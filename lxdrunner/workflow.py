@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+from ruamel.yaml import YAML
+
+
+def runs_on(text):
+    """ Return runs-on label sets of jobs in a workflow definition.
+    Jobs depending on other jobs are left out, they are queued too late
+    to benefit from a prewarmed runner. Labels using expressions can't be
+    resolved and are skipped.
+    """
+    try:
+        data = YAML(typ="safe").load(text)
+    except Exception:
+        return []
+    if not isinstance(data, dict) or not isinstance(data.get("jobs"), dict):
+        return []
+
+    out = []
+    for job in data["jobs"].values():
+        if not isinstance(job, dict) or job.get("needs"):
+            continue
+        labels = job.get("runs-on")
+        if isinstance(labels, dict):
+            labels = labels.get("labels")
+        if isinstance(labels, str):
+            labels = [labels]
+        if not isinstance(labels, list) or not labels:
+            continue
+        if any("${{" in str(label) for label in labels):
+            continue
+        out.append(frozenset(map(str, labels)))
+    return out
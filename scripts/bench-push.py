@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for LXDRunner.pushfile
+
+Runs N parallel pushes of a package sized file against a fake LXD endpoint
+on a unix socket and reports peak Python heap and process RSS.
+Run from the repo root with a development install.
+
+    python3 scripts/bench-push.py -n 10 -s 150
+    python3 scripts/bench-push.py -n 10 -s 150 --read   # old fp.read() path
+"""
+
+import argparse
+import http.server
+import json
+import pathlib
+import resource
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import pylxd
+
+from lxdrunner import lxd
+from lxdrunner.appconf import config as cfg
+
+BLOCK = 64 * 1024
+
+host_info = {
+    "api_extensions": ["instances", "projects"],
+    "auth": "trusted",
+    "environment": {
+        "server_version": "4.0",
+        "certificate": ""
+    },
+}
+
+
+class FakeLXDHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, metadata):
+        body = json.dumps(
+            dict(
+                type="sync",
+                status="Success",
+                status_code=200,
+                metadata=metadata
+            )
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith("/1.0/instances/"):
+            name = path.split("/")[3]
+            return self.reply(dict(name=name, type="container", config={}))
+        return self.reply(host_info)
+
+    def do_POST(self):
+        # Drain file push body without keeping it
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(BLOCK, remaining)))
+        self.reply({})
+
+
+class FakeLXD(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def legacy_pushfile(src, instance, dst, **exargs):
+    " Push file reading it into memory first "
+    with open(src, "rb") as fp:
+        instance.files.put(dst, fp.read(), **exargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("-n", dest="workers", type=int, default=10)
+    parser.add_argument("-s", dest="size", type=int, default=150, help="MB")
+    parser.add_argument("-c", dest="config", default="tests/config.yml")
+    parser.add_argument(
+        "--read", action="store_true", help="Read file into memory"
+    )
+    args = parser.parse_args()
+
+    cfg.load(args.config)
+    runner = lxd.LXDRunner(connect=False)
+    push = legacy_pushfile if args.read else runner.pushfile
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+        sock = tmpdir / "lxd.socket"
+        pkg = tmpdir / "actions-runner.tgz"
+        with pkg.open("wb") as fp:
+            fp.truncate(args.size * 1024 * 1024)
+
+        server = FakeLXD(str(sock), FakeLXDHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        endpoint = "http+unix://{}".format(
+            urllib.parse.quote(str(sock), safe="")
+        )
+        client = pylxd.Client(endpoint=endpoint)
+        instances = [
+            client.instances.get(f"bench-{num}") for num in range(args.workers)
+        ]
+
+        tracemalloc.start()
+        start = time.monotonic()
+        with ThreadPoolExecutor(args.workers) as pool:
+            futures = [
+                pool.submit(push, pkg, inst, "/opt/runner/actions-runner.tgz")
+                for inst in instances
+            ]
+            for futr in futures:
+                futr.result()
+        elapsed = time.monotonic() - start
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        server.shutdown()
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Mode:        {'read' if args.read else 'stream'}")
+    print(f"Pushes:      {args.workers} x {args.size} MB in {elapsed:.2f}s")
+    print(f"Peak heap:   {peak / 1024 / 1024:.1f} MB")
+    print(f"Max RSS:     {maxrss:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
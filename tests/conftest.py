@@ -1,4 +1,7 @@
 import os
+import unittest.mock as mock
+
+import pytest
 
 
 def pytest_configure(config):
@@ -6,3 +9,12 @@ def pytest_configure(config):
     os.environ['LXDRCFG'] = "tests/config.yml"
     from lxdrunner.appconf import config as cfg
     cfg.load("tests/config.yml")
+
+
+@pytest.fixture
+def lxdm():
+    " LXDRunner without connection and with mocked LXD client "
+    import lxdrunner.lxd
+    lxd = lxdrunner.lxd.LXDRunner(connect=False)
+    with mock.patch.object(lxd, 'client'):
+        yield lxd
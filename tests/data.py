@@ -52,4 +52,12 @@ pkg1 = dtypes.RunnerPackage(
 )
 pkg1_expected_linkname = "actions-runner-linux-arm-latest"
 
-pkgs = (pkg0, pkg1)
+pkg2 = dtypes.RunnerPackage(
+    os='linux',
+    architecture='x64',
+    download_url='https://localhost/actions-runner-linux-x64-2.277.1.tar.gz',
+    filename='actions-runner-linux-x64-2.277.1.tar.gz',
+    linkname='actions-runner-linux-x64-latest'
+)
+
+pkgs = (pkg0, pkg1, pkg2)
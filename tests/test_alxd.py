@@ -0,0 +1,151 @@
+import asyncio
+import unittest.mock as mock
+
+import pytest
+
+import lxdrunner.alxd as alxd
+from lxdrunner import pool, ready
+from lxdrunner.appconf import RunnerConf
+from lxdrunner.dtypes import RunnerEvent
+
+#
+# Test Data
+#
+
+rc = RunnerConf(
+    name="Test Async Conf",
+    labels=['self-hosted', 'async'],
+    image="ubuntu/latest",
+    runner_os='linux',
+    runner_arch='x64',
+    type='container'
+)
+
+evt = RunnerEvent(
+    owner='owner', repo='repo', org='testorg', rc=rc, instname="lxdr-async"
+)
+
+running = dict(status_code=ready.RUNNING, processes=1)
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def launcher(lxdm):
+    launcher = lxdm.aio
+    launcher.client = mock.AsyncMock()
+    launcher.client.state.return_value = running
+    launcher.client.execute.return_value = (0, "", "")
+    return launcher
+
+
+def test_socket_path(monkeypatch):
+    assert alxd.socket_path("http+unix://%2Ftmp%2Flxd.sock") == "/tmp/lxd.sock"
+    monkeypatch.setenv("LXD_DIR", "/srv/lxd")
+    assert alxd.socket_path(None) == "/srv/lxd/unix.socket"
+
+
+def test_listener_registered(launcher):
+    assert launcher.notify in launcher.lxdr.readiness.listeners
+
+
+def test_wait_ready(launcher):
+    client = launcher.client
+    assert asyncio.run(
+        launcher.wait_ready(client, "lxdr-async", "container", "/opt")
+    )
+    launcher.client.mk_dir.assert_awaited_with("lxdr-async", "/opt")
+    assert "lxdr-async" not in launcher.waiters
+
+
+def test_wait_ready_timeout(launcher):
+    launcher.client.state.return_value = dict(status_code=102)
+    with mock.patch.object(alxd.cfg, "ready_timeout_container", 0.1):
+        assert not asyncio.run(
+            launcher.wait_ready(
+                launcher.client, "lxdr-async", "container", "/opt"
+            )
+        )
+
+
+def test_launch_provisioned(launcher):
+    lxdr = launcher.lxdr
+    lxdr.instance_source = mock.Mock(
+        return_value=(dict(type="image", alias="baked"), True)
+    )
+    assert asyncio.run(launcher.launch(evt)) is True
+    config = launcher.client.create_instance.await_args.args[0]
+    assert config["name"] == "lxdr-async"
+    assert config["source"] == dict(type="image", alias="baked")
+    launcher.client.set_state.assert_awaited_with("lxdr-async", "start")
+    cmd = launcher.client.execute.await_args.args[1]
+    assert cmd[-1] == "register", "Provisioned instances only register"
+    assert lxdr.workers["lxdr-async"] == evt
+
+
+def test_launch_prewarmed(launcher):
+    warm_evt = evt.copy(update=dict(prewarmed=True))
+    assert asyncio.run(launcher.launch(warm_evt)) is True
+    assert not launcher.client.create_instance.called
+    launcher.client.update_config.assert_awaited_with(
+        "lxdr-async", {pool.IDLE_KEY: "claimed"}
+    )
+
+
+def test_launch_failed_cleanup(launcher):
+    launcher.lxdr.instance_source = mock.Mock(
+        return_value=(dict(type="image", alias="baked"), True)
+    )
+    launcher.client.execute.return_value = (1, "out", "err")
+    assert asyncio.run(launcher.launch(evt)) is False
+    launcher.client.set_state.assert_awaited_with(
+        "lxdr-async", "stop", force=True
+    )
+    launcher.client.request.assert_awaited_with(
+        "DELETE", "/1.0/instances/lxdr-async"
+    )
+
+
+def test_launch_create_failed(launcher):
+    lxdr = launcher.lxdr
+    lxdr.release_volume = mock.Mock()
+    lxdr.placement.release = mock.Mock()
+    launcher.client.create_instance.side_effect = alxd.AsyncLXDError(
+        500, "create failed"
+    )
+    launcher.client.set_state.side_effect = alxd.AsyncLXDError(
+        404, "not found"
+    )
+    assert asyncio.run(launcher.launch(evt)) is False
+    lxdr.release_volume.assert_called_with("lxdr-async")
+    lxdr.placement.release.assert_called_with("lxdr-async")
+    assert "lxdr-async" not in lxdr.workers
+
+
+def test_launch_listeners(launcher):
+    launcher.lxdr.instance_source = mock.Mock(
+        return_value=(dict(type="image", alias="baked"), True)
+    )
+
+    def register(evt):
+        evt.jitconfig = "ENCODED"
+
+    launcher.lxdr.launch_listeners.append(register)
+    jit_evt = evt.copy()
+    assert asyncio.run(launcher.launch(jit_evt)) is True
+    environment = launcher.client.execute.await_args.kwargs['environment']
+    assert environment['GHA_JITCONFIG'] == "ENCODED"
+
+
+def test_launch_prewarmed_unverified(launcher):
+    lxdr = launcher.lxdr
+    lxdr.verify_launch = mock.Mock(return_value=False)
+    lxdr.forget_worker = mock.Mock()
+    warm_evt = evt.copy(update=dict(prewarmed=True))
+    assert asyncio.run(launcher.launch(warm_evt)) is False
+    launcher.client.request.assert_awaited_with(
+        "DELETE", "/1.0/instances/lxdr-async"
+    )
+    assert not lxdr.forget_worker.called, "Slot freed by deleted event"
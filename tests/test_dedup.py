@@ -0,0 +1,54 @@
+import unittest.mock as mock
+
+from lxdrunner import dedup
+
+#
+# Tests
+#
+
+
+def test_seen():
+    index = dedup.SeenIndex()
+    assert not index.seen("1")
+    assert index.seen("1"), "Second delivery is a duplicate"
+    assert not index.seen("2")
+    assert index.stats() == dict(size=2, hits=1, misses=2, hit_rate=0.333)
+
+    index.forget("1")
+    assert not index.seen("1")
+
+
+def test_bounded():
+    index = dedup.SeenIndex(maxsize=3)
+    for job_id in "abcd":
+        index.seen(job_id)
+    assert list(index.entries) == ["b", "c", "d"], "Oldest id evicted"
+
+
+@mock.patch("lxdrunner.dedup.time.monotonic")
+def test_expiry(m_time):
+    m_time.return_value = 100.0
+    index = dedup.SeenIndex(ttl=10)
+    index.seen("a")
+    m_time.return_value = 105.0
+    index.seen("b")
+    m_time.return_value = 111.0
+    assert not index.seen("a"), "Expired id is new again"
+    assert list(index.entries) == ["b", "a"]
+    m_time.return_value = 116.0
+    index.seen("c")
+    assert list(index.entries) == ["a", "c"], "Expired ids evicted"
+
+
+@mock.patch("lxdrunner.dedup.time.monotonic")
+def test_hit_refreshes_expiry(m_time):
+    m_time.return_value = 100.0
+    index = dedup.SeenIndex(ttl=10)
+    index.seen("a")
+    index.seen("b")
+    m_time.return_value = 105.0
+    assert index.seen("a")
+    assert list(index.entries) == ["b", "a"], "Refreshed id moved to end"
+    m_time.return_value = 112.0
+    assert index.seen("a"), "Expiry counts from last delivery"
+    assert "b" not in index
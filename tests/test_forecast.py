@@ -0,0 +1,67 @@
+import unittest.mock as mock
+
+from lxdrunner import forecast
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+LABELS = frozenset(['self-hosted', 'linux'])
+# Midnight UTC, 2021-01-04
+DAY = 1609718400
+
+
+def make_rc(**kwargs):
+    return RunnerConf(
+        name="Forecast Conf",
+        labels=LABELS,
+        image="ubuntu/latest",
+        runner_os='linux',
+        runner_arch='x64',
+        type='container',
+        **kwargs
+    )
+
+
+#
+# Tests
+#
+
+
+def test_recent_rate():
+    fc = forecast.Forecast()
+    assert fc.rate(LABELS, DAY) == 0.0
+    for num in range(60):
+        fc.record(LABELS, DAY + num)
+    assert fc.rate(LABELS, DAY + 60) > 0.05
+    assert fc.rate(LABELS, DAY + 3 * 3600) < 0.001, "Rate decays"
+    assert fc.rate(frozenset(['other']), DAY + 60) == 0.0
+
+
+@mock.patch("lxdrunner.forecast.hour_of_day", lambda ts: int(ts // 3600) % 24)
+def test_seasonal_rate():
+    fc = forecast.Forecast()
+    # 360 jobs at 09:00 every day
+    for day in range(5):
+        start = DAY + day * 86400 + 9 * 3600
+        for num in range(360):
+            fc.record(LABELS, start + num * 10)
+    tomorrow = DAY + 5 * 86400
+
+    assert fc.rate(LABELS, tomorrow + 3 * 3600) < 0.001, "Quiet at night"
+    # Looks ahead to the burst, no recent arrivals
+    assert fc.rate(LABELS, tomorrow + 8 * 3600 + 3000) > 0.07
+    with mock.patch.object(forecast.cfg, "forecast_lead", 60):
+        assert fc.target(make_rc(), tomorrow + 9 * 3600) >= 5
+
+
+def test_save_load(tmp_path):
+    fc = forecast.Forecast(tmp_path / "forecast.json")
+    fc.load()
+    fc.record(LABELS, DAY)
+    fc.save()
+
+    restored = forecast.Forecast(tmp_path / "forecast.json")
+    restored.load()
+    assert restored.rate(LABELS, DAY) == fc.rate(LABELS, DAY)
@@ -0,0 +1,134 @@
+import json
+import unittest.mock as mock
+import urllib.error
+
+import pytest
+import requests
+
+from lxdrunner import ghcache
+
+#
+# Test Data
+#
+
+REPOS = [dict(name="testrepo", owner=dict(login="testowner"))]
+
+
+def response(status=200, body=None, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps(body).encode() if body is not None else b""
+    resp.headers.update(headers or {})
+    return resp
+
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def api(tmp_path):
+    cache = ghcache.ResponseCache(tmp_path / "ghcache.json")
+    http = mock.Mock()
+    yield ghcache.CachedGhApi(token="FAKE", cache=cache, http=http), http
+
+
+def test_conditional_request(api):
+    api, http = api
+    http.request.return_value = response(200, REPOS, {"ETag": '"abc"'})
+    assert api.repos.list_for_authenticated_user()[0].name == "testrepo"
+    assert "If-None-Match" not in http.request.call_args.kwargs['headers']
+    (verb, url) = http.request.call_args.args
+    assert url == "https://api.github.com/user/repos"
+    assert "json" not in http.request.call_args.kwargs, "GET with a body"
+
+    http.request.return_value = response(304)
+    repos = api.repos.list_for_authenticated_user()
+    assert repos[0].owner.login == "testowner", "Served from cache"
+    headers = http.request.call_args.kwargs['headers']
+    assert headers['If-None-Match'] == '"abc"'
+    assert api.cache.stats() == dict(
+        size=1, hits=1, misses=1, hit_rate=0.5, saved=1
+    )
+
+    # Other query, not cached
+    with pytest.raises(urllib.error.HTTPError):
+        api.repos.list_for_authenticated_user(page=2)
+
+
+def test_post_not_cached(api):
+    api, http = api
+    http.request.return_value = response(201, dict(token="T"), {"ETag": "a"})
+    api.actions.create_registration_token_for_repo("testowner", "testrepo")
+    (verb, url) = http.request.call_args.args
+    assert verb == "POST"
+    assert url.endswith("/repos/testowner/testrepo/actions/runners/"
+                        "registration-token")
+    assert not api.cache.entries
+
+
+def test_post_body(api):
+    api, http = api
+    http.request.return_value = response(201, dict(id=1))
+    api("/orgs/{org}/things", "POST", route=dict(org="o"), data=dict(a=1))
+    assert http.request.call_args.kwargs['json'] == dict(a=1)
+
+    http.request.return_value = response(204)
+    api("/orgs/{org}/things/1", "DELETE", route=dict(org="o"), data={})
+    assert "json" not in http.request.call_args.kwargs, "DELETE with {}"
+
+
+def test_concurrent_headers(api):
+    api, http = api
+    responses = {
+        "/a": response(200, dict(name="a"), {"ETag": "etag-a"}),
+        "/b": response(200, dict(name="b"), {"ETag": "etag-b"}),
+    }
+    http.request.side_effect = lambda verb, url, **kw: responses[url[-2:]]
+    update = api.budget.update
+
+    def interleave(headers):
+        # Another thread's request completes in between
+        api.budget.update = update
+        api("/b")
+        update(headers)
+
+    api.budget.update = interleave
+    api("/a")
+    etags = {
+        json.loads(key)[0][-2:]: entry['etag']
+        for key, entry in api.cache.entries.items()
+    }
+    assert etags == {"/a": "etag-a", "/b": "etag-b"}
+
+
+def test_errors(api):
+    api, http = api
+    http.request.return_value = response(404, dict(message="Not Found"))
+    with pytest.raises(ghcache.ExceptionsHTTP[404]):
+        api.repos.get("testowner", "missing")
+
+
+def test_persist(api, tmp_path):
+    api, http = api
+    http.request.return_value = response(
+        200, REPOS, {"Last-Modified": "Mon, 04 Jan 2021"}
+    )
+    api.repos.list_for_authenticated_user()
+    api.cache.save()
+
+    cache = ghcache.ResponseCache(tmp_path / "ghcache.json")
+    cache.load()
+    assert cache.entries == api.cache.entries
+    (key, ) = cache.entries
+    assert cache.validators(key) == {"If-Modified-Since": "Mon, 04 Jan 2021"}
+
+
+def test_budget(api):
+    api, http = api
+    http.request.return_value = response(
+        200, REPOS, {"X-RateLimit-Remaining": "42"}
+    )
+    api.repos.list_for_authenticated_user()
+    assert api.budget.available() == 42
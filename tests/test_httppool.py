@@ -0,0 +1,63 @@
+import hashlib
+import unittest.mock as mock
+
+import pytest
+
+from lxdrunner import httppool
+
+#
+# Tests
+#
+
+
+def test_pool_size():
+    with mock.patch.object(httppool.cfg, "http_pool_size", 0):
+        pool = httppool.HTTPPool()
+    assert pool.size == httppool.cfg.max_workers
+    assert pool.adapter._pool_maxsize == pool.size
+    assert pool.stats() == dict(
+        requests=0, connections=0, reused=0, reuse_rate=0.0
+    )
+
+
+def test_stats():
+    pool = httppool.HTTPPool(size=4)
+    host = pool.adapter.poolmanager.connection_from_host(
+        "api.github.com", 443, "https"
+    )
+    host.num_requests, host.num_connections = 10, 2
+    assert pool.stats() == dict(
+        requests=10, connections=2, reused=8, reuse_rate=0.8
+    )
+
+
+def test_download(tmp_path):
+    pool = httppool.HTTPPool(size=1)
+    resp = mock.MagicMock()
+    resp.__enter__.return_value.iter_content.return_value = [b"ab", b"c"]
+    pool.session.request = mock.Mock(return_value=resp)
+    path = tmp_path / "runner.tar.gz"
+    assert pool.download("https://localhost/runner.tar.gz", path) == 3
+    assert path.read_bytes() == b"abc"
+    assert not (tmp_path / "runner.tar.gz.part").exists()
+
+
+def test_download_resume(tmp_path):
+    pool = httppool.HTTPPool(size=1)
+    resp = mock.MagicMock()
+    resp.__enter__.return_value.status_code = 206
+    resp.__enter__.return_value.iter_content.return_value = [b"c"]
+    pool.session.request = mock.Mock(return_value=resp)
+    path = tmp_path / "runner.tar.gz"
+    (tmp_path / "runner.tar.gz.part").write_bytes(b"ab")
+
+    sha = hashlib.sha256(b"abc").hexdigest()
+    pool.download("https://localhost/runner.tar.gz", path, sha)
+    assert pool.session.request.call_args.kwargs['headers'] == {
+        "Range": "bytes=2-"
+    }
+    assert path.read_bytes() == b"abc"
+
+    with pytest.raises(ValueError):
+        pool.download("https://localhost/runner.tar.gz", path, "0" * 64)
+    assert not (tmp_path / "runner.tar.gz.part").exists()
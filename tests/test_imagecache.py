@@ -0,0 +1,63 @@
+import unittest.mock as mock
+
+import pylxd.exceptions
+
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+rc = RunnerConf(
+    name="Test Cache Conf",
+    labels=['self-hosted', 'cache'],
+    image="images:debian/11/cloud",
+    runner_os='linux',
+    runner_arch='x64',
+    type='virtual-machine'
+)
+
+localrc = rc.copy(update=dict(image="debian/11"))
+
+#
+# Tests
+#
+
+
+def test_alias(lxdm):
+    alias = lxdm.imagecache.alias(rc.image, rc.type)
+    assert alias == "lxdrunner-cache-images-debian-11-cloud-vm"
+    assert lxdm.imagecache.alias(rc.image, "container") != alias
+
+
+@mock.patch('lxdrunner.imagecache.util.threadit')
+def test_source_miss_then_hit(m_thread, lxdm):
+    cache = lxdm.imagecache
+    assert cache.source(rc) is None
+    assert m_thread.called, "Miss should pull in background"
+    assert cache.stats() == dict(hits=0, misses=1)
+
+    cache.pulling.clear()
+    cache.pull(rc.image, rc.type)
+    assert lxdm.client.images.get_by_alias.called
+    source = cache.source(rc)
+    assert source == dict(type="image", alias=cache.alias(rc.image, rc.type))
+    assert cache.stats() == dict(hits=1, misses=1)
+    assert lxdm.image_source(rc) == source
+
+
+def test_source_local_image(lxdm):
+    assert lxdm.imagecache.source(localrc) is None
+    assert lxdm.imagecache.stats() == dict(hits=0, misses=0)
+
+
+def test_pull_new_image(lxdm):
+    lxdm.client.images.get_by_alias.side_effect = pylxd.exceptions.NotFound(
+        "missing"
+    )
+    lxdm.imagecache.pull(rc.image, rc.type)
+    request = lxdm.client.api.images.post.call_args.kwargs['json']
+    assert request['auto_update'] is True
+    assert request['source']['alias'] == "debian/11/cloud"
+    assert request['source']['image_type'] == "virtual-machine"
+    assert lxdm.imagecache.local_alias(rc)
@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+from lxdrunner import jobstore
+from lxdrunner.appconf import RunnerConf
+from lxdrunner.dtypes import RunnerEvent
+
+#
+# Test Data
+#
+
+rc = RunnerConf(
+    name="Test Job Conf",
+    labels=['self-hosted', 'jobs'],
+    image="ubuntu/latest",
+    runner_os='linux',
+    runner_arch='x64',
+    type='container'
+)
+
+
+def make_evt(job_id):
+    return RunnerEvent(
+        owner='owner', repo='repo', org='', rc=rc, wf_job_id=job_id
+    )
+
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = jobstore.JobStore(tmp_path / "jobs.db")
+    store.open()
+    yield store
+
+
+def test_record_closed():
+    store = jobstore.JobStore()
+    store.record(make_evt("1"), jobstore.QUEUED)
+    assert store.writes.empty(), "Closed store should not queue writes"
+    assert not store.known("1")
+
+
+def test_wal_mode(store):
+    conn = sqlite3.connect(store.path)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_state_transitions(store):
+    evt = make_evt("1")
+    store.record(evt, jobstore.QUEUED)
+    store.record(make_evt("2"), jobstore.QUEUED)
+    store.flush()
+    jobs = store.jobs(jobstore.QUEUED)
+    assert [event['wf_job_id'] for (_, _, event, _) in jobs] == ["1", "2"]
+    assert jobs[0][2]['labels'] == sorted(rc.labels)
+
+    store.record(evt, jobstore.LAUNCHING)
+    store.record(evt, jobstore.PROVISIONED)
+    store.flush()
+    (row, ) = store.jobs(jobstore.PROVISIONED)
+    assert row[:3] == (jobstore.PROVISIONED, evt.instname, jobs[0][2])
+    assert store.known("1")
+
+    store.record(evt, jobstore.DELETED)
+    store.flush()
+    assert not store.known("1")
+    store.prune(age=-1)
+    assert store.jobs(jobstore.DELETED) == []
+    assert len(store.jobs(jobstore.QUEUED)) == 1
+
+
+def test_event_updated(store):
+    evt = make_evt("1")
+    store.record(evt, jobstore.QUEUED)
+    evt.runner_id = 1234
+    store.record(evt, jobstore.PROVISIONED)
+    store.flush()
+    (row, ) = store.jobs(jobstore.PROVISIONED)
+    assert row[2]['runner_id'] == 1234, "Runner id not recorded"
+
+
+def test_batched_writes(store):
+    for num in range(jobstore.BATCH_SIZE * 2):
+        store.record(make_evt(str(num)), jobstore.QUEUED)
+    store.flush()
+    assert len(store.jobs(jobstore.QUEUED)) == jobstore.BATCH_SIZE * 2
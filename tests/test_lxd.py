@@ -1,3 +1,4 @@
+import json
 import unittest.mock as mock
 
 import pytest
@@ -35,17 +36,13 @@ goodrc = RunnerConf(
 evt = RunnerEvent(owner='owner', repo='repo', org='testorg', rc=goodrc)
 
 
-@pytest.fixture
-def lxdm():
-    lxd = lxdrunner.lxd.LXDRunner(connect=False)
-    with mock.patch.object(lxd, 'client'):
-        yield lxd
-
-
 def test_push_file(lxdm):
     instance = mock.Mock()
     lxdm.pushfile("/dev/null", instance, "/root/file", mode="0600")
-    instance.files.put.assert_called_with("/root/file", b'', mode="0600")
+    (dst, fp) = instance.files.put.call_args.args
+    assert dst == "/root/file"
+    assert fp.name == "/dev/null", "File object should be streamed"
+    assert instance.files.put.call_args.kwargs == dict(mode="0600")
 
 
 @mock.patch("lxdrunner.lxd.pylxd.Client")
@@ -114,6 +111,49 @@ def test__launch(lxdm):
     assert lxdm._cleanup_instance.called, "Cleanup should have been called"
 
 
+def test__launch_listeners(lxdm):
+    lxdm.start_gha_runner = mock.Mock()
+    listener = mock.Mock()
+    lxdm.launch_listeners.append(listener)
+    assert lxdm._launch(evt) is True
+    listener.assert_called_with(evt)
+
+    listener.side_effect = Exception("GitHub unavailable")
+    lxdm.start_gha_runner.reset_mock()
+    lxdm._cleanup_instance = mock.Mock()
+    assert lxdm._launch(evt) is False, "Launch should have failed"
+    assert not lxdm.start_gha_runner.called
+    assert lxdm._cleanup_instance.called, "Cleanup should have been called"
+
+
+def test__launch_start_timeout(lxdm):
+    lxdm.launch_instance = mock.Mock()
+    lxdm.wait_agent = mock.Mock(return_value=False)
+    lxdm._cleanup_instance = mock.Mock()
+    lxdm.jobs.record = mock.Mock()
+    assert lxdm._launch(evt) is False, "Launch should have failed"
+    assert lxdm._cleanup_instance.called, "Cleanup should have been called"
+    assert not lxdm.jobs.record.called, "Failed launch recorded"
+
+
+def test_build_instance_failed(lxdm):
+    lxdm.provision_runner = mock.Mock(side_effect=Exception("Failed"))
+    with pytest.raises(Exception):
+        lxdm.build_instance("lxdrunner-build-abc", goodrc, None)
+    lxdm.client.instances.get.assert_called_with("lxdrunner-build-abc")
+    assert lxdm.client.instances.get.return_value.delete.called
+
+
+def test_build_configs(lxdm):
+    pkg_for = mock.Mock(side_effect=[Exception("No package"), "pkg"])
+    build = mock.Mock(return_value="built")
+    rcs = [goodrc.copy(), goodrc.copy()]
+    with mock.patch.object(cfg, 'runnermap', rcs):
+        results = lxdm.build_configs("type", pkg_for, build, "Test")
+    assert results == ["built"], "Failed config should be skipped"
+    build.assert_called_once_with(rcs[1], "pkg")
+
+
 def test__cleanup_instance(lxdm):
     assert lxdm._cleanup_instance(
         "randomname"
@@ -145,3 +185,72 @@ def test_cleanup_instance(lxdm):
     )
     res = lxdm._cleanup_instance("fake-instance")
     assert res == False, "Cleanup should fail due to exception."
+
+
+def test__launch_prewarmed(lxdm):
+    lxdm.register_runner = mock.Mock()
+    lxdm.launch_instance = mock.Mock()
+    warm_evt = evt.copy(update=dict(prewarmed=True))
+    assert lxdm._launch(warm_evt) is True, "Launch should succeed"
+    assert lxdm.register_runner.called
+    assert not lxdm.launch_instance.called, "Pool instance already exists"
+
+
+def test__launch_prewarmed_unverified(lxdm):
+    lxdm.verify_launch = mock.Mock(return_value=False)
+    lxdm._cleanup_instance = mock.Mock()
+    lxdm.forget_worker = mock.Mock()
+    warm_evt = evt.copy(update=dict(prewarmed=True))
+    assert lxdm._launch(warm_evt) is False
+    lxdm._cleanup_instance.assert_called_with(warm_evt.instname)
+    assert not lxdm.forget_worker.called, "Slot freed by deleted event"
+
+
+class FakeMessage:
+    is_text = True
+
+    def __init__(self, action, source):
+        self.data = json.dumps(
+            dict(metadata=dict(action=action, source=source))
+        )
+
+
+def test_verify_launch_cached(lxdm):
+    assert lxdm.verify_launch(evt)
+    lxdm.client.reset_mock()
+    assert lxdm.verify_launch(evt)
+    assert not lxdm.client.images.get_by_alias.called, "Should be cached"
+    assert not lxdm.client.profiles.exists.called, "Should be cached"
+
+    lxdm.process_event(FakeMessage("profile-updated", "/1.0/profiles/default"))
+    assert lxdm.verify_launch(evt)
+    assert lxdm.client.profiles.exists.called, "Cache should be invalidated"
+
+
+def test_verify_launch_ttl(lxdm):
+    assert lxdm.verify_launch(evt)
+    lxdm.verified[evt.rc.labels] -= cfg.verify_ttl
+    lxdm.client.reset_mock()
+    assert lxdm.verify_launch(evt)
+    assert lxdm.client.profiles.exists.called, "Cache entry should expire"
+
+
+def test_process_event_deleted(lxdm):
+    lxdm.workers[evt.instname] = evt
+    evt.rc.worksem.acquire()
+    lxdm.process_event(
+        FakeMessage("instance-deleted", f"/1.0/instances/{evt.instname}")
+    )
+    assert evt.instname not in lxdm.workers
+
+
+def test__launch_cancelled(lxdm):
+    lxdm.launch_instance = mock.Mock()
+    lxdm.client.instances.get.side_effect = pylxd.exceptions.NotFound(
+        mock.Mock()
+    )
+    cancelled = evt.copy(update=dict(cancelled=True))
+    cancelled.rc.worksem.acquire()
+    assert lxdm._launch(cancelled) is False
+    assert not lxdm.launch_instance.called, "Cancelled job launched"
+    assert cancelled.instname not in lxdm.workers, "Worker not released"
@@ -1,12 +1,17 @@
+import base64
+import datetime
 import unittest.mock as mock
 import pytest
 import dataclasses
 import os
 from pathlib import Path
 
+import fastcore.net
+
 from lxdrunner.appconf import config as cfg
 
 import lxdrunner.mngr
+from lxdrunner import dtypes, jobstore, pkgindex, ratelimit
 
 #
 # Test Data
@@ -14,6 +19,7 @@ import lxdrunner.mngr
 
 from . import data
 from fastcore.foundation import L
+from fastcore.xtras import dict2obj
 
 
 @dataclasses.dataclass
@@ -26,6 +32,8 @@ class GHReleaseAsset:
 class GHRelease:
     prerelease: bool
     assets: list
+    body: str = ""
+    tag_name: str = "v2.277.1"
 
 
 asset = GHReleaseAsset(
@@ -48,7 +56,8 @@ ghrels = L(
 def mngr():
     " Return RunManager() object with mocked GHAPI "
     mn = lxdrunner.mngr.RunManager()
-    with mock.patch.object(mn, 'ghapi'):
+    with mock.patch.object(mn, 'ghapi'), \
+            mock.patch.object(mn.tokens, 'prefetch'):
         yield mn
 
 
@@ -61,13 +70,13 @@ def test_get_reg_token_doesnt_exist(mngr):
 
 
 def test_get_reg_token_valid(mngr):
-    mngr.reg_tokens = {data.org_args['org']: data.valid_token}
+    mngr.tokens.tokens = {data.org_args['org']: data.valid_token}
     mngr.get_reg_token(data.org_args)
     assert not mngr.ghapi.actions.create_registration_token_for_org.called
 
 
 def test_get_reg_token_expired(mngr):
-    mngr.reg_tokens = {data.org_args['org']: data.expired_token}
+    mngr.tokens.tokens = {data.org_args['org']: data.expired_token}
     mngr.get_reg_token(data.org_args)
     assert mngr.ghapi.actions.create_registration_token_for_org.called
 
@@ -90,28 +99,96 @@ def test_get_packages(mngr):
     assert mngr.pkgs[0].filename == asset.name
     assert mngr.pkgs[0].download_url == asset.browser_download_url
     assert mngr.pkgs[0].linkname[:-6] in asset.name, "pkg.linkname incorrect"
-
-
-def touchfile(url, fname):
+    assert mngr.pkgs[0].version == "2.277.1", "pkg.version incorrect"
+
+
+def test_get_packages_checksums(mngr):
+    sha = "ab" * 32
+    trimmed = GHReleaseAsset(
+        name='actions-runner-osx-x64-2.277.1-noexternals.tar.gz',
+        browser_download_url="https://localhost/trimmed.tar.gz"
+    )
+    body = f"<!-- BEGIN SHA osx-x64 -->{sha}<!-- END SHA osx-x64 -->"
+    mngr.ghapi.repos.list_releases.return_value = L(
+        GHRelease(prerelease=False, assets=[asset, trimmed], body=body)
+    )
+    (pkg, ) = mngr.get_packages()
+    assert pkg.filename == asset.name, "Trimmed package not skipped"
+    assert pkg.sha256 == sha
+
+
+def test_get_packages_pinned(mngr):
+    old = GHReleaseAsset(
+        name='actions-runner-linux-x64-2.276.0.tar.gz',
+        browser_download_url="https://localhost/old.tar.gz"
+    )
+    mngr.ghapi.repos.list_releases.return_value = L(
+        GHRelease(prerelease=False, assets=[asset])
+    )
+    # Older than the releases listed on the first page
+    mngr.ghapi.repos.get_release_by_tag.return_value = GHRelease(
+        prerelease=False, assets=[old], tag_name="v2.276.0"
+    )
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    with mock.patch.object(rc, 'runner_version', "2.276.0"):
+        mngr.get_packages()
+    mngr.ghapi.repos.get_release_by_tag.assert_called_with(
+        'actions', 'runner', "v2.276.0"
+    )
+    (pkg, ) = mngr.pinned
+    assert pkg.version == "2.276.0"
+    assert pkg.linkname == old.name, "Pinned package uses link"
+
+
+@mock.patch("lxdrunner.mngr.log")
+def test_get_packages_pin_missing(m_log, mngr):
+    mngr.ghapi.repos.list_releases.return_value = L(
+        GHRelease(prerelease=False, assets=[asset])
+    )
+    mngr.ghapi.repos.get_release_by_tag.side_effect = (
+        fastcore.net.ExceptionsHTTP[404]("url", {}, None)
+    )
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    with mock.patch.object(rc, 'runner_version', "1.0.0"):
+        mngr.get_packages()
+    assert mngr.pinned == []
+    m_log.warning.assert_called_with(
+        "Pinned runner package %s-%s %s not found", "linux", "x64", "1.0.0"
+    )
+
+
+def test_get_runner_pkg_pinned(mngr):
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    mngr.pkgindex.add(data.pkg2, latest=True)
+    assert mngr.get_runner_pkg(rc) == data.pkg2
+    with mock.patch.object(rc, 'runner_version', "2.276.0"):
+        with pytest.raises(LookupError):
+            mngr.get_runner_pkg(rc)
+
+
+def touchfile(url, fname, sha256=None):
     Path(fname).touch()
 
 
 @mock.patch.object(cfg.dirs, 'pkgdir')
-@mock.patch('urllib.request.urlretrieve', side_effect=touchfile)
+@mock.patch('lxdrunner.httppool.HTTPPool.download', side_effect=touchfile)
 def test_update_pkg_cache(m_url, m_pkgdir, mngr, tmp_path):
     os.chdir(tmp_path)
-    pkgdir = cfg.dirs.pkgdir = tmp_path
+    pkgdir = cfg.dirs.pkgdir = tmp_path / "pkgs"
+    mngr.pkgindex.path = tmp_path / "packages.json"
     print("ARGS", type(tmp_path), cfg.dirs.pkgdir)
 
     # Inject list of packages
     mngr.get_packages = mock.Mock()
     mngr.pkgs = data.pkgs
 
-    pkg_cnt = len(data.pkgs)
+    # Only linux x64 is in the runnermap
+    pkg_cnt = 1
 
     mngr.update_pkg_cache()
     # Files will be downloaded
     assert m_url.call_count == pkg_cnt, "Download count != pkg count"
+    assert m_url.call_args.args[0] == data.pkg2.download_url
     # pkgs * 2 files created
     assert len(
         list(pkgdir.iterdir())
@@ -127,3 +204,337 @@ def test_update_pkg_cache(m_url, m_pkgdir, mngr, tmp_path):
     # Files exist, no downloaded
     assert m_url.call_count == 0, "No files should be downloaded"
     assert not fp.exists(), "extra_file should not exist"
+
+
+def job_evt(labels, job_id):
+    return dict(
+        wf_job_id=job_id,
+        repo="testrepo",
+        owner="testowner",
+        org="",
+        labels=labels
+    )
+
+
+def test_dispatch_round_robin(mngr):
+    mngr.process_evt = mock.Mock()
+    busy = frozenset(['self-hosted'])
+    free = frozenset(['self-hosted', 'vm'])
+    rc = mngr.runnermap[busy]
+
+    # Saturate one label
+    held = 0
+    while rc.worksem.acquire(blocking=False):
+        held += 1
+    try:
+        mngr.queue_evt(job_evt(busy, "1"))
+        mngr.queue_evt(job_evt(free, "2"))
+        assert mngr.lxd.wakeup.is_set(), "Queueing should wake dispatcher"
+
+        assert mngr.dispatch()
+        (evt, ) = mngr.process_evt.call_args.args
+        assert evt.wf_job_id == "2", "Free label should not wait on busy"
+        assert not mngr.queues[busy].empty()
+        assert not mngr.dispatch(), "Nothing else can start"
+
+        mngr.lxd.wakeup.clear()
+        mngr.lxd.release_slot(rc)
+        held -= 1
+        assert mngr.lxd.wakeup.is_set(), "Free slot should wake dispatcher"
+        assert mngr.dispatch()
+        assert mngr.queues[busy].empty()
+    finally:
+        for num in range(held + 1):
+            rc.worksem.release()
+        mngr.runnermap[free].worksem.release()
+
+
+def test_resume_jobs(mngr, tmp_path):
+    store = mngr.lxd.jobs = jobstore.JobStore(tmp_path / "jobs.db")
+    store.open()
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    queued, running, gone, stale = [
+        dtypes.RunnerEvent(
+            owner="testowner", repo="testrepo", org="", rc=rc, wf_job_id=num
+        ) for num in ("1", "2", "3", "4")
+    ]
+    store.record(queued, jobstore.QUEUED)
+    store.record(running, jobstore.PROVISIONED)
+    store.record(gone, jobstore.PROVISIONED)
+    store.record(stale, jobstore.QUEUED)
+    store.flush()
+    with store.conn:
+        store.conn.execute("UPDATE jobs SET updated=0 WHERE job_id='4'")
+
+    fake_inst = mock.Mock()
+    fake_inst.name = running.instname
+    mngr.lxd.get_workers = mock.Mock(return_value=[fake_inst])
+    try:
+        mngr.resume_jobs()
+        store.flush()
+        (ts, evt) = mngr.queues[rc.labels].get_nowait()
+        assert evt.wf_job_id == "1"
+        assert running.instname in mngr.lxd.workers, "Runner not tracked"
+        assert store.known("2")
+        assert not store.known("3"), "Missing instance should be deleted"
+        assert mngr.queues[rc.labels].empty(), "Stale job queued"
+        assert not store.known("4"), "Stale job should be deleted"
+    finally:
+        rc.worksem.release()
+
+
+def test_queue_evt_dedup(mngr):
+    labels = frozenset(['self-hosted'])
+    mngr.queue_evt(job_evt(labels, 42))
+    mngr.queue_evt(job_evt(labels, 42))
+    assert mngr.queues[labels].qsize() == 1, "Duplicate job queued"
+    assert mngr.stats()['dedup']['hits'] == 1
+    mngr.queues[labels].get_nowait()
+
+
+def test_dispatch_failed(mngr, tmp_path):
+    store = mngr.lxd.jobs = jobstore.JobStore(tmp_path / "jobs.db")
+    store.open()
+    mngr.process_evt = mock.Mock(side_effect=LookupError("No package"))
+    labels = frozenset(['self-hosted'])
+    mngr.queue_evt(job_evt(labels, 9))
+    assert mngr.dispatch()
+    store.flush()
+    assert not store.known("9"), "Failed job would be resumed"
+    mngr.queue_evt(job_evt(labels, 9))
+    assert mngr.queues[labels].qsize() == 1, "Redelivery dropped"
+    mngr.queues[labels].get_nowait()
+    assert mngr.runnermap[labels].worksem.acquire(blocking=False)
+    mngr.runnermap[labels].worksem.release()
+
+
+def test_launch_failed_forgets_seen(mngr):
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    labels = rc.labels
+    mngr.queue_evt(job_evt(labels, 10))
+    (ts, evt) = mngr.queues[labels].get_nowait()
+    assert mngr.launch_failed in mngr.lxd.deleted_listeners
+    mngr.launch_failed(evt.copy(update=dict(provisioned=True)))
+    mngr.queue_evt(job_evt(labels, 10))
+    assert mngr.queues[labels].empty(), "Job of running runner queued"
+
+    mngr.launch_failed(evt)
+    mngr.queue_evt(job_evt(labels, 10))
+    assert mngr.queues[labels].qsize() == 1, "Redelivery dropped"
+    mngr.queues[labels].get_nowait()
+
+
+def test_cancel_evt_queued(mngr):
+    mngr.process_evt = mock.Mock()
+    labels = frozenset(['self-hosted'])
+    mngr.queue_evt(job_evt(labels, 7))
+    mngr.cancel_evt(dict(wf_job_id=7, runner_name="lxdrunner-abcdef"))
+    assert "7" not in mngr.cancelled, "Taken by one of our runners"
+
+    mngr.cancel_evt(dict(wf_job_id=7, runner_name="other-runner"))
+    assert mngr.dispatch()
+    assert not mngr.process_evt.called, "Cancelled job launched"
+    assert mngr.queues[labels].empty()
+    assert mngr.stats()['cancelled'] == dict(queued=1, launching=0)
+    assert mngr.runnermap[labels].worksem.acquire(blocking=False)
+    mngr.runnermap[labels].worksem.release()
+
+
+def test_cancel_evt_launching(mngr):
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    evt = dtypes.RunnerEvent(
+        owner="testowner", repo="testrepo", org="", rc=rc, wf_job_id="8"
+    )
+    mngr.lxd.workers[evt.instname] = evt
+    mngr.cancel_evt(dict(wf_job_id=8, runner_name=None))
+    assert evt.cancelled
+    assert mngr.stats()['cancelled']['launching'] == 1
+
+
+def test_prewarm(mngr):
+    workflow = (
+        b"jobs:\n"
+        b"  a:\n    runs-on: [self-hosted]\n"
+        b"  b:\n    runs-on: [self-hosted]\n"
+    )
+    content = mock.Mock(content=base64.b64encode(workflow))
+    mngr.ghapi.repos.get_content.return_value = content
+    mngr.pkgs = [data.pkg0]
+    mngr.get_runner_pkg = mock.Mock(return_value=data.pkg0)
+    mngr.lxd.warmpool.speculate = mock.Mock(return_value=2)
+    mngr.lxd.pool = mock.Mock()
+    evt = dict(run_id=1, owner="o", repo="r", path="ci.yml", head_sha="abc")
+
+    with mock.patch.object(cfg, "prewarm_window", 60):
+        mngr.prewarm_evt(evt)
+        mngr.prewarm_evt(evt)
+    assert mngr.lxd.pool.submit.call_count == 1, "Duplicate run prewarmed"
+    assert mngr.stats()['dedup']['misses'] == 0, "Runs counted as jobs"
+
+    mngr.prewarm(evt)
+    (rc, pkg, count) = mngr.lxd.warmpool.speculate.call_args.args
+    assert rc.labels == frozenset(['self-hosted'])
+    assert count == 2
+    assert mngr.stats()['prewarmed'] == dict(runs=1, instances=2)
+
+
+def test_submit_pending_runs(mngr):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    owner = dict(login="testowner", type="User")
+
+    def repo(name, age, **kwargs):
+        pushed = (now - datetime.timedelta(hours=age)).isoformat()
+        return dict2obj(
+            dict(name=name, full_name=name, owner=owner, pushed_at=pushed,
+                 **kwargs)
+        )
+
+    mngr.ghapi.budget = ratelimit.RateBudget()
+    mngr.ghapi.repos.list_for_authenticated_user.return_value = [
+        repo("recent", 1), repo("stale", 1000), repo("old", 1, archived=True)
+    ]
+    run = dict2obj(dict(id=1, repository=dict(name="recent", owner=owner)))
+    actions = mngr.ghapi.actions
+    actions.list_workflow_runs_for_repo.return_value = dict(
+        workflow_runs=[run]
+    )
+    actions.list_jobs_for_workflow_run.return_value = dict(
+        jobs=[
+            dict2obj(dict(id=11, status="queued", labels=["self-hosted"])),
+            dict2obj(dict(id=12, status="in_progress", labels=["vm"]))
+        ]
+    )
+
+    mngr.submit_pending_runs()
+    labels = frozenset(['self-hosted'])
+    (ts, evt) = mngr.queues[labels].get_nowait()
+    assert evt.wf_job_id == "11"
+    assert actions.list_workflow_runs_for_repo.call_count == 1
+    assert mngr.stats()['discovery'] == dict(scanned=1, skipped=2, queued=1)
+
+    # Out of API budget
+    mngr.ghapi.budget.update({"X-RateLimit-Remaining": "10"})
+    mngr.submit_pending_runs()
+    assert actions.list_workflow_runs_for_repo.call_count == 1
+    assert mngr.stats()['discovery']['skipped'] == 5
+
+
+def test_cleanup_deferred(mngr):
+    mngr.ghapi.budget = ratelimit.RateBudget()
+    mngr.ghapi.budget.update({"X-RateLimit-Remaining": "900"})
+    mngr.cleanup()
+    assert not mngr.ghapi.orgs.list_for_authenticated_user.called
+    assert mngr.ghapi.budget.stats()['deferred']['cleanup'] == 1
+
+
+def test_process_evt_jitconfig(mngr):
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    evt = dtypes.RunnerEvent(
+        owner="testowner", repo="testrepo", org="", rc=rc, wf_job_id="9"
+    )
+    mngr.ghapi.return_value = dict2obj(
+        dict(runner=dict(id=77), encoded_jit_config="ENCODED")
+    )
+    mngr.pkgs = [data.pkg0]
+    mngr.get_runner_pkg = mock.Mock(return_value=data.pkg0)
+    mngr.lxd.launch = mock.Mock()
+
+    with mock.patch.object(cfg, "jitconfig", True):
+        mngr.process_evt(evt)
+        assert not mngr.ghapi.called, "Dispatch waited on GitHub"
+        mngr.lxd.prepare_launch(evt)
+    (path, verb), kwargs = mngr.ghapi.call_args
+    assert path.endswith("/generate-jitconfig")
+    assert kwargs['route'] == dict(owner="testowner", repo="testrepo")
+    assert kwargs['data']['name'] == evt.instname
+    assert not mngr.ghapi.actions.create_registration_token_for_repo.called
+    assert (evt.runner_id, evt.jitconfig) == (77, "ENCODED")
+
+    env = mngr.lxd.script_env(evt, evt.instname)
+    assert env['GHA_JITCONFIG'] == "ENCODED"
+    assert "GHA_TOKEN" not in env
+
+
+def test_deregister(mngr):
+    rc = mngr.runnermap[frozenset(['self-hosted'])]
+    mngr.ghapi.budget = ratelimit.RateBudget()
+    mngr.ghpool = mock.Mock()
+    mngr.ghpool.submit.side_effect = lambda func, *args: func(*args)
+    actions = mngr.ghapi.actions
+    jit, named, done = [
+        dtypes.RunnerEvent(
+            owner="testowner", repo="testrepo", org="", rc=rc, runner_id=num
+        ) for num in (5, 0, 0)
+    ]
+    actions.list_self_hosted_runners_for_repo.return_value = dict(
+        runners=[dict2obj(dict(id=6, name=named.instname))]
+    )
+
+    for evt in (jit, named, done):
+        mngr.lxd.workers[evt.instname] = evt
+        rc.worksem.acquire()
+    mngr.cancel_evt(
+        dict(wf_job_id=1, runner_name=done.instname, status="completed")
+    )
+    for evt in (jit, named, done):
+        mngr.lxd.forget_worker(evt.instname)
+
+    deleted = actions.delete_self_hosted_runner_from_repo.call_args_list
+    assert [call.kwargs['runner_id'] for call in deleted] == [5, 6]
+    assert actions.list_self_hosted_runners_for_repo.call_count == 1
+    assert mngr.stats()['deregistered'] == 2
+
+
+def test_cleanup(mngr):
+    mngr.ghapi.budget = ratelimit.RateBudget()
+    owner = dict(login="testowner", type="User")
+    mngr.ghapi.orgs.list_for_authenticated_user.return_value = [
+        dict2obj(dict(login="testorg"))
+    ]
+    mngr.ghapi.repos.list_for_authenticated_user.return_value = [
+        dict2obj(dict(name="testrepo", owner=owner))
+    ]
+    runners = [
+        dict(id=1, name="lxdrunner-a", status="offline"),
+        dict(id=2, name="lxdrunner-b", status="online"),
+        dict(id=3, name="other", status="offline")
+    ]
+    actions = mngr.ghapi.actions
+    for func in (
+        actions.list_self_hosted_runners_for_org,
+        actions.list_self_hosted_runners_for_repo
+    ):
+        func.return_value = dict(runners=dict2obj(runners))
+
+    mngr.cleanup()
+    actions.delete_self_hosted_runner_from_org.assert_called_once_with(
+        org="testorg", runner_id=1
+    )
+    actions.delete_self_hosted_runner_from_repo.assert_called_once_with(
+        owner="testowner", repo="testrepo", runner_id=1
+    )
+
+
+@mock.patch("lxdrunner.mngr.schedule")
+@mock.patch("lxdrunner.mngr.util.threadit")
+def test_startup_pkg_update_background(m_thread, m_sched, mngr):
+    mngr.lxd = mock.Mock()
+    mngr.tokens.load = mock.Mock()
+    mngr.cache_images = mock.Mock()
+    mngr.fill_pools = mock.Mock()
+    mngr.update_pkg_cache = mock.Mock()
+    mngr.resume_jobs = mock.Mock()
+    mngr.pkgindex.load = mock.Mock()
+    mngr.pkgindex.add(data.pkg2, latest=True)
+
+    mngr.startup_init()
+    assert mngr.resume_jobs.called
+    assert not mngr.update_pkg_cache.called, "Startup waits on GitHub"
+    targets = [call.args[0] for call in m_thread.call_args_list]
+    assert mngr.update_pkg_cache in targets
+
+    # Empty index, nothing to launch with before the download
+    mngr.pkgindex = pkgindex.PackageIndex()
+    mngr.pkgindex.load = mock.Mock()
+    mngr.startup_init()
+    assert mngr.update_pkg_cache.called
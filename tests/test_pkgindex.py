@@ -0,0 +1,82 @@
+from lxdrunner import pkgindex
+
+#
+# Test Data
+#
+
+from . import data
+
+
+def pkg_version(pkg, version="2.277.1"):
+    return pkg.copy(
+        update=dict(
+            version=version,
+            filename=pkg.filename.replace("2.277.1", version)
+        )
+    )
+
+
+pkg0 = pkg_version(data.pkg0)
+pkg2 = pkg_version(data.pkg2)
+
+
+#
+# Tests
+#
+
+
+def test_version_key():
+    assert pkgindex.version_key("2.277.1") < pkgindex.version_key("2.277.10")
+    assert pkgindex.version_key("2.300.0") > pkgindex.version_key("2.277.1")
+
+
+def test_get_latest_and_pinned():
+    index = pkgindex.PackageIndex()
+    old = pkg_version(pkg0, "2.276.0")
+    index.add(old)
+    index.add(pkg0, latest=True)
+
+    assert index.get('osx', 'x64') == pkg0
+    pkg = index.get('osx', 'x64', "2.276.0")
+    assert pkg.version == "2.276.0"
+    assert pkg.linkname == pkg.filename, "Pinned package uses link"
+    assert index.get('osx', 'x64', "1.0.0") is None
+    assert index.get('linux', 'arm') is None
+    assert index.latest_pkgs() == [pkg0]
+
+
+def test_retain():
+    index = pkgindex.PackageIndex()
+    versions = ["2.274.0", "2.275.0", "2.276.0"]
+    for version in versions:
+        index.add(pkg_version(pkg0, version))
+    index.add(pkg0, latest=True)
+
+    dropped = index.retain(2, pinned={('osx', 'x64', "2.274.0")})
+    assert [pkg.version for pkg in dropped] == ["2.275.0"]
+    assert index.files() == {
+        pkg0.filename,
+        pkg_version(pkg0, "2.276.0").filename,
+        pkg_version(pkg0, "2.274.0").filename,
+    }
+
+
+def test_save_load(tmp_path):
+    path = tmp_path / "packages.json"
+    index = pkgindex.PackageIndex(path)
+    index.add(pkg_version(pkg2, "2.276.0"))
+    index.add(pkg2, latest=True)
+    index.save()
+
+    loaded = pkgindex.PackageIndex(path)
+    loaded.load()
+    assert loaded.latest_pkgs() == [pkg2]
+    assert loaded.files() == index.files()
+
+
+def test_load_corrupt(tmp_path):
+    path = tmp_path / "packages.json"
+    path.write_text("{")
+    index = pkgindex.PackageIndex(path)
+    index.load()
+    assert index.latest_pkgs() == []
@@ -0,0 +1,123 @@
+import unittest.mock as mock
+
+import pytest
+
+from lxdrunner import placement
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+
+def make_rc(**kwargs):
+    args = dict(
+        name="Test Placement Conf",
+        labels=['self-hosted', 'place'],
+        image="ubuntu/latest",
+        runner_os='linux',
+        runner_arch='x64',
+        type='container'
+    )
+    args.update(kwargs)
+    return RunnerConf(**args)
+
+
+def make_host(name, arch="x86_64", shared=False, cpus=4, mem_used=0.0):
+    host = placement.Host(name, mock.Mock(), architectures=[arch])
+    host.shared = shared
+    host.cpus = cpus
+    host.mem_used = mem_used
+    host.images = {"ubuntu/latest"}
+    return host
+
+
+def json_response(metadata):
+    response = mock.Mock()
+    response.json.return_value = dict(metadata=metadata)
+    return response
+
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def sched(lxdm):
+    return lxdm.placement
+
+
+def test_place_undiscovered(sched):
+    assert sched.place("lxdrunner-a", make_rc()) is None
+    assert sched.client_for("lxdrunner-a") is sched.lxdr.client
+
+
+def test_place_least_loaded(sched):
+    busy = make_host("busy", mem_used=0.9)
+    idle = make_host("idle", mem_used=0.1)
+    sched.hosts = [busy, idle]
+    assert sched.place("lxdrunner-a", make_rc()) is idle
+    assert sched.client_for("lxdrunner-a") is idle.client
+
+    # Running instances count against a host
+    for num in range(8):
+        sched.placed[f"lxdrunner-{num}"] = idle
+    assert sched.place("lxdrunner-b", make_rc()) is busy
+
+    sched.release("lxdrunner-b")
+    assert sched.host_for("lxdrunner-b") is None
+
+
+def test_place_architecture(sched):
+    sched.hosts = [make_host("amd"), make_host("arm", arch="aarch64")]
+    host = sched.place("lxdrunner-a", make_rc(runner_arch='arm64'))
+    assert host.name == "arm"
+
+    with pytest.raises(Exception):
+        sched.place("lxdrunner-b", make_rc(runner_arch='arm'))
+
+
+def test_place_image_locality(sched):
+    loaded = make_host("loaded", shared=True, mem_used=0.3)
+    empty = make_host("empty")
+    empty.images = set()
+    rc = make_rc(image="images:ubuntu/focal")
+    sched.lxdr.imagecache.cached[(rc.image, rc.type)] = "lxdrunner-cache"
+    sched.hosts = [loaded, empty]
+    assert sched.place("lxdrunner-a", rc) is loaded, "Cached image on main"
+
+    # Local aliases can only be used where they exist
+    assert sched.place("lxdrunner-b", make_rc(image="other")) is loaded
+
+
+def test_discover_cluster(sched):
+    client = mock.Mock()
+    client.host_info = dict(
+        environment=dict(server_clustered=True, architectures=["x86_64"])
+    )
+    members = [
+        dict(server_name="node1", architecture="x86_64", status="Online"),
+        dict(server_name="node2", architecture="aarch64", status="Offline"),
+    ]
+    client.api.cluster.members.get.return_value = json_response(members)
+    client.api.images.get.return_value = json_response([])
+    client.api.resources.get.return_value = json_response(
+        dict(cpu=dict(total=8), memory=dict(used=1, total=4))
+    )
+    client.api.instances.get.return_value = json_response(
+        [dict(name="lxdrunner-abc", location="node1")]
+    )
+    sched.lxdr.clients = dict(main=client)
+
+    sched.discover()
+    node1, node2 = sched.hosts
+    assert (node1.target, node1.shared, node1.online) == ("node1", True, True)
+    assert (node1.cpus, node1.mem_used) == (8, 0.25)
+    assert not node2.online, "Offline members are skipped"
+    assert sched.host_for("lxdrunner-abc") is node1
+
+    host = sched.place("lxdrunner-new", make_rc())
+    assert host is node1
+    sched.lxdr.launch_instance("lxdrunner-new", make_rc(), host=host)
+    assert client.instances.create.call_args.kwargs["target"] == "node1"
@@ -0,0 +1,136 @@
+import unittest.mock as mock
+
+import pytest
+
+import lxdrunner.lxd
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+
+def make_rc(**kwargs):
+    return RunnerConf(
+        name="Test Pool Conf",
+        labels=['self-hosted', 'pool'],
+        image="ubuntu/latest",
+        runner_os='linux',
+        runner_arch='x64',
+        type='container',
+        **kwargs
+    )
+
+
+class InlinePool:
+    " Executor stand-in running tasks immediately "
+    def submit(self, func, *args):
+        func(*args)
+
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def lxdm(lxdm):
+    lxdm.pool = InlinePool()
+    lxdm.launch_instance = mock.Mock()
+    lxdm.provision_runner = mock.Mock()
+    lxdm._cleanup_instance = mock.Mock()
+    return lxdm
+
+
+def test_idle_limits():
+    assert make_rc(min_idle=2).max_idle == 2
+    with pytest.raises(ValueError):
+        make_rc(min_idle=2, max_idle=1)
+    with pytest.raises(ValueError):
+        make_rc(min_idle=2, max_workers=1)
+
+
+def test_fill_and_claim(lxdm):
+    rc = make_rc(min_idle=2, max_workers=3)
+    wp = lxdm.warmpool
+    assert wp.fill(rc, None) == 2
+    assert wp.size(rc) == 2
+    assert wp.fill(rc, None) == 0, "Pool is full"
+
+    # Idle instances hold worker slots
+    assert rc.worksem.acquire(blocking=False)
+    assert not rc.worksem.acquire(blocking=False)
+    rc.worksem.release()
+
+    instname = wp.claim(rc)
+    assert instname
+    assert wp.size(rc) == 1
+    assert wp.discard(instname) is False, "Claimed instance left pool"
+
+
+def test_fill_bounded_by_worksem(lxdm):
+    rc = make_rc(min_idle=2, max_workers=2)
+    rc.worksem.acquire()
+    assert lxdm.warmpool.fill(rc, None) == 1
+
+
+def test_prepare_failure_releases_slot(lxdm):
+    rc = make_rc(min_idle=1, max_workers=1)
+    lxdm.provision_runner.side_effect = Exception("Provision failed")
+    assert lxdm.warmpool.fill(rc, None) == 1
+    assert lxdm._cleanup_instance.called
+    assert lxdm.warmpool.size(rc) == 0
+    assert rc.worksem.acquire(blocking=False), "Slot not released"
+
+
+def test_discard_idle(lxdm):
+    rc = make_rc(min_idle=1, max_workers=1)
+    lxdm.warmpool.fill(rc, None)
+    (instname, ) = lxdm.warmpool.members
+    assert lxdm.warmpool.discard(instname) is True
+    assert lxdm.warmpool.claim(rc) is None
+    assert rc.worksem.acquire(blocking=False), "Slot not released"
+
+
+def test_restore(lxdm):
+    rc = make_rc(min_idle=1, max_workers=1)
+    lxdm.warmpool.fill(rc, None)
+    instname = lxdm.warmpool.claim(rc)
+    lxdm.warmpool.restore(rc, instname)
+    assert lxdm.warmpool.claim(rc) == instname
+
+
+@mock.patch("lxdrunner.pool.time.monotonic")
+def test_speculate_expire(m_time, lxdm):
+    m_time.return_value = 100.0
+    rc = make_rc(min_idle=1, max_workers=4)
+    wp = lxdm.warmpool
+    wp.fill(rc, None)
+    with mock.patch.object(lxdrunner.pool.cfg, "prewarm_window", 30):
+        assert wp.speculate(rc, None, 2) == 2
+    assert wp.size(rc) == 3
+    assert wp.expire() == 0, "Window not expired"
+
+    # One claimed by a job, the pool keeps its target
+    wp.claim(rc)
+    m_time.return_value = 131.0
+    lxdm.instance = mock.Mock()
+    assert wp.expire() == 1
+    assert lxdm.instance.return_value.stop.called
+    assert not wp.expires
+    assert wp.claim(rc), "Instance within target reused"
+
+
+def test_autoscale(lxdm):
+    rc = make_rc(min_idle=1, max_idle=3, max_workers=4, autoscale=True)
+    wp = lxdm.warmpool
+    wp.forecast.target = mock.Mock(return_value=10)
+    assert wp.target(rc) == 3, "Bounded by max_idle"
+    assert wp.fill(rc, None) == 3
+
+    wp.forecast.target.return_value = 0
+    assert wp.target(rc) == 1, "Bounded by min_idle"
+    lxdm.instance = mock.Mock()
+    assert wp.trim(rc) == 2
+    assert wp.size(rc) == 1
+    assert wp.trim(rc) == 0
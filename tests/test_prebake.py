@@ -0,0 +1,68 @@
+import unittest.mock as mock
+
+import pytest
+
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+from . import data
+
+rc = RunnerConf(
+    name="Test Prebake Conf",
+    labels=['self-hosted', 'baked'],
+    image="ubuntu/latest",
+    runner_os='linux',
+    runner_arch='x64',
+    type='container',
+    prebake=True
+)
+
+pkg = data.pkg1.copy(update=dict(version="2.277.1"))
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def lxdm(lxdm):
+    lxdm.provision_runner = mock.Mock()
+    lxdm.client.images.get_by_alias.return_value.fingerprint = "abc123"
+    return lxdm
+
+
+def test_image_alias(lxdm):
+    images = lxdm.images
+    alias = images.image_alias(rc, pkg)
+    assert alias == images.image_alias(rc, pkg), "Alias should be stable"
+    newpkg = pkg.copy(update=dict(version="2.278.0"))
+    assert alias != images.image_alias(rc, newpkg), "Version not in key"
+    lxdm.client.images.get_by_alias.return_value.fingerprint = "def456"
+    assert alias != images.image_alias(rc, pkg), "Base image not in key"
+
+
+def test_build_existing(lxdm):
+    alias = lxdm.images.build(rc, pkg)
+    assert not lxdm.client.instances.create.called, "Image already exists"
+    assert lxdm.images.source(rc) == alias
+    assert lxdm.instance_source(rc) == (dict(type="image", alias=alias), True)
+
+
+def test_build(lxdm):
+    lxdm.images.exists = mock.Mock(return_value=False)
+    lxdm.client.images.all.return_value = []
+    alias = lxdm.images.build(rc, pkg)
+    assert lxdm.client.instances.create.called
+    assert lxdm.provision_runner.called
+    assert lxdm.client.api.images.post.called
+    assert lxdm.images.source(rc) == alias
+
+
+def test_source_not_built(lxdm):
+    assert lxdm.images.source(rc) is None
+    source, provisioned = lxdm.instance_source(rc)
+    assert provisioned is False
+    assert source['alias'] == rc.image
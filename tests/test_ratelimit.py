@@ -0,0 +1,43 @@
+import unittest.mock as mock
+
+from lxdrunner import ratelimit
+
+#
+# Test Data
+#
+
+HEADERS = {
+    "X-RateLimit-Limit": "5000",
+    "X-RateLimit-Remaining": "300",
+    "X-RateLimit-Reset": "1000"
+}
+
+#
+# Tests
+#
+
+
+@mock.patch("lxdrunner.ratelimit.time.time", return_value=400.0)
+def test_priorities(m_time):
+    budget = ratelimit.RateBudget()
+    assert budget.allow(ratelimit.CLEANUP)
+    budget.update(HEADERS)
+    assert budget.allow(ratelimit.TOKENS)
+    assert budget.allow(ratelimit.JOBS)
+    assert not budget.allow(ratelimit.DISCOVERY)
+    assert not budget.allow(ratelimit.CLEANUP)
+    assert budget.stats() == dict(
+        remaining=300,
+        limit=5000,
+        reset_in=600,
+        deferred=dict(tokens=0, jobs=0, discovery=1, cleanup=1)
+    )
+
+    m_time.return_value = 1000.0
+    assert budget.allow(ratelimit.CLEANUP), "Budget refilled after reset"
+
+
+def test_update_ignores_missing():
+    budget = ratelimit.RateBudget()
+    budget.update({"ETag": "abc"})
+    assert budget.available() == 5000
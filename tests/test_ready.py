@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest.mock as mock
+
+import pylxd.exceptions
+
+import lxdrunner.ready as ready
+
+#
+# Test Data
+#
+
+
+def make_inst(status_code=ready.RUNNING, processes=1):
+    inst = mock.Mock()
+    inst.name = "lxdrunner-ready"
+    inst.state.return_value.status_code = status_code
+    inst.state.return_value.processes = processes
+    return inst
+
+
+#
+# Tests
+#
+
+
+def test_is_ready():
+    assert ready.is_ready(make_inst(), "/opt/runner")
+    assert not ready.is_ready(make_inst(processes=-1), "/opt/runner")
+    assert not ready.is_ready(make_inst(status_code=102), "/opt/runner")
+
+    inst = make_inst()
+    inst.files.mk_dir.side_effect = Exception("Agent not reachable")
+    assert not ready.is_ready(inst, "/opt/runner")
+
+
+def test_is_ready_dir_exists():
+    inst = make_inst()
+    response = mock.Mock()
+    response.json.return_value = {"error": "file exists"}
+    inst.files.mk_dir.side_effect = pylxd.exceptions.LXDAPIException(response)
+    assert ready.is_ready(inst, "/opt/runner")
+
+
+def test_wait_timeout():
+    waiter = ready.Readiness()
+    assert waiter.wait(make_inst(processes=-1), "/opt/runner", 0.2) is False
+    assert not waiter.seen, "Waiter not cleaned up"
+
+
+def test_wait_woken_by_event():
+    waiter = ready.Readiness()
+    inst = make_inst(processes=-1)
+
+    def agent_up():
+        time.sleep(0.4)
+        inst.state.return_value.processes = 5
+        waiter.notify(inst.name)
+
+    # Long enough for backoff to exceed the remaining wait
+    with mock.patch.object(ready, 'MAX_DELAY', 10):
+        thread = threading.Thread(target=agent_up)
+        thread.start()
+        start = time.monotonic()
+        assert waiter.wait(inst, "/opt/runner", 5) is True
+        thread.join()
+    assert time.monotonic() - start < 0.6, "Event should wake waiter"
@@ -0,0 +1,77 @@
+import unittest.mock as mock
+
+import pytest
+
+import lxdrunner.template as template
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+from . import data
+
+rc = RunnerConf(
+    name="Test Template Conf",
+    labels=['self-hosted', 'template'],
+    image="ubuntu/latest",
+    runner_os='linux',
+    runner_arch='x64',
+    type='container',
+    template=True
+)
+
+pkg = data.pkg1.copy(update=dict(version="2.277.1"))
+
+
+class FakeInstance:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.delete = mock.Mock()
+
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def lxdm(lxdm):
+    lxdm.provision_runner = mock.Mock()
+    lxdm.client.images.get_by_alias.return_value.fingerprint = "abc123"
+    return lxdm
+
+
+def test_ensure_current(lxdm):
+    tmpls = lxdm.templates
+    current = FakeInstance(tmpls.prefix(rc) + "aaa", tmpls.state(rc, pkg))
+    lxdm.client.instances.all.return_value = [current]
+
+    assert tmpls.ensure(rc, pkg) == current.name
+    assert not lxdm.client.instances.create.called, "Template is current"
+    assert lxdm.instance_source(rc) == (
+        dict(type="copy", source=current.name, instance_only=True), True
+    )
+
+
+def test_ensure_outdated(lxdm):
+    tmpls = lxdm.templates
+    state = tmpls.state(rc, pkg)
+    state[template.RUNNER_KEY] = "2.0.0"
+    old = FakeInstance(tmpls.prefix(rc) + "aaa", state)
+    lxdm.client.instances.all.return_value = [old]
+
+    name = tmpls.ensure(rc, pkg)
+    assert name != old.name
+    assert name.startswith(tmpls.prefix(rc))
+    assert lxdm.client.instances.create.called
+    assert lxdm.provision_runner.called
+    assert old.delete.called, "Outdated template should be deleted"
+
+
+def test_source_no_template(lxdm):
+    assert lxdm.templates.source(rc) is None
+    norc = rc.copy(update=dict(template=False))
+    lxdm.templates.current[norc.labels] = "lxdrunner-template-x"
+    assert lxdm.templates.source(norc) is None
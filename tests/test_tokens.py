@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest.mock as mock
+
+import pytest
+
+from lxdrunner import tokens
+
+#
+# Test Data
+#
+
+from . import data
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def service(tmp_path):
+    manager = mock.Mock()
+    svc = tokens.TokenService(manager, tmp_path / "tokens.bin")
+    yield svc, manager.ghapi.actions
+
+
+def test_single_flight(service):
+    svc, actions = service
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_request(**kwargs):
+        started.set()
+        release.wait(5)
+        return data.valid_token
+
+    actions.create_registration_token_for_org.side_effect = slow_request
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(svc.get(data.org_args)))
+        for num in range(3)
+    ]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    for num in range(500):
+        if svc.stats()['joined'] == 2:
+            break
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == [data.valid_token] * 3
+    assert actions.create_registration_token_for_org.call_count == 1
+    assert svc.stats() == dict(targets=1, fetched=1, joined=2, waited=3)
+    assert svc.get(data.org_args) is data.valid_token, "Served from cache"
+
+
+def test_cached_before_flight_ends(service):
+    svc, actions = service
+    actions.create_registration_token_for_org.return_value = data.valid_token
+    target = data.org_args['target']
+
+    class Inflight(dict):
+        def __delitem__(self, key):
+            assert key in svc.tokens, "Gap without token or request"
+            super().__delitem__(key)
+
+    svc.inflight = Inflight()
+    assert svc.fetch(data.org_args) is data.valid_token
+    assert target not in svc.inflight
+
+
+def test_refresh(service):
+    svc, actions = service
+    actions.create_registration_token_for_repo.return_value = data.valid_token
+    svc.tokens[data.repo_args['target']] = data.expired_token
+    svc._use(data.repo_args)
+    assert svc.refresh() == 1
+    actions.create_registration_token_for_repo.assert_called_with(
+        owner="testowner", repo="testrepo"
+    )
+    assert svc.refresh() == 0, "Fresh token kept"
+
+
+def test_refresh_in_progress(service):
+    svc, actions = service
+    svc.tokens[data.repo_args['target']] = data.expired_token
+    svc._use(data.repo_args)
+    with svc.refreshing:
+        assert svc.refresh() == 0
+    assert not actions.mock_calls, "Overlapping refresh skipped"
+
+
+def test_persist_encrypted(service, tmp_path):
+    svc, actions = service
+    svc.tokens[data.org_args['target']] = data.valid_token
+    svc._use(data.org_args)
+    svc.save()
+    assert b"FAKE_TOKEN" not in (tmp_path / "tokens.bin").read_bytes()
+
+    restored = tokens.TokenService(mock.Mock(), tmp_path / "tokens.bin")
+    restored.load()
+    assert restored.get(data.org_args).token == "FAKE_TOKEN"
+    assert not restored.manager.ghapi.actions.mock_calls
@@ -1,4 +1,5 @@
 import secrets
+import unittest.mock as mock
 
 from lxdrunner.appconf import config as cfg
 import lxdrunner.util
@@ -25,6 +26,33 @@ class TestUtils:
         goodname = f"{cfg.prefix}-123456789"
         assert lxdrunner.util.has_prefix(goodname)
 
+    def test_paginate(self):
+        pages = [dict(jobs=[1, 2]), dict(jobs=[3])]
+        oper = mock.Mock(side_effect=pages)
+        items = lxdrunner.util.paginate(oper, key="jobs", per_page=2)
+        assert list(items) == [1, 2, 3]
+        assert oper.call_args.kwargs == dict(per_page=2, page=2)
+
+    def test_state(self, tmp_path):
+        path = tmp_path / "state.json"
+        assert lxdrunner.util.load_state(path) is None
+        lxdrunner.util.save_state(path, '{"a": 1}')
+        assert lxdrunner.util.load_state(path) == dict(a=1)
+        lxdrunner.util.save_state(path, b"{")
+        assert lxdrunner.util.load_state(path) is None, "Unreadable state"
+        assert list(tmp_path.iterdir()) == [path], "Temp file left"
+
+    def test_state_path(self):
+        path = lxdrunner.util.state_path(None, "state.json")
+        assert path == cfg.cache_home / "state.json"
+        assert lxdrunner.util.state_path("/tmp/x", "state.json") == "/tmp/x"
+
+    def test_runner_labels(self):
+        rc = cfg.runnermap[0]
+        labels = lxdrunner.util.runner_labels(rc)
+        assert {"self-hosted", "Linux", "X64"} <= set(labels)
+        assert set(rc.labels) <= set(labels)
+
     def test_env_str(self):
         env = {"KEY": "VALUE"}
         assert lxdrunner.util.env_str(env) == "KEY=VALUE\n"
@@ -39,3 +67,9 @@ class TestUtils:
         assert source['protocol'] in ("simplestreams", "lxd")
         assert source['server'] == cfg.remotes["ubuntu"].addr
         assert source['alias'] == 'focal'
+
+    def test_flatten(self):
+        data = dict(a=1, b=dict(c=2, d=dict(e=3)))
+        assert list(lxdrunner.util.flatten(data)) == [
+            ("a", 1), ("b.c", 2), ("b.d.e", 3)
+        ]
@@ -0,0 +1,116 @@
+import unittest.mock as mock
+
+import pytest
+import pylxd.exceptions
+
+import lxdrunner.lxd
+import lxdrunner.volumes as volumes
+from lxdrunner.appconf import RunnerConf
+
+#
+# Test Data
+#
+
+from . import data
+
+rc = RunnerConf(
+    name="Test Volume Conf",
+    labels=['self-hosted', 'volume'],
+    image="ubuntu/latest",
+    runner_os='linux',
+    runner_arch='x64',
+    type='container',
+    runner_volume=True
+)
+
+pkg = data.pkg1.copy(update=dict(version="2.277.1"))
+
+
+class FakeVolume:
+    def __init__(self, name, config=None):
+        self.name = name
+        self.type = "custom"
+        self.config = config or {}
+        self.delete = mock.Mock()
+
+
+#
+# Tests
+#
+
+
+@pytest.fixture
+def pool(lxdm):
+    return lxdm.client.storage_pools.get.return_value
+
+
+def test_devices(lxdm, pool):
+    base = volumes.RunnerVolumes.base_name(pkg)
+    pool.volumes.get.return_value = FakeVolume(
+        base, {
+            volumes.READY_KEY: "true",
+            volumes.OWNER_KEY: str(volumes.RUNNER_UID)
+        }
+    )
+    devices = lxdm.volumes.devices(rc, pkg, "lxdrunner-abc")
+    assert devices[volumes.DEVICE]['source'] == "lxdrunner-abc-runner"
+    definition = pool.volumes.create.call_args.args[0]
+    assert definition['source'] == dict(
+        type="copy", name=base, pool="default"
+    )
+
+
+def test_devices_not_ready(lxdm, pool):
+    pool.volumes.get.side_effect = pylxd.exceptions.NotFound("missing")
+    assert lxdm.volumes.devices(rc, pkg, "lxdrunner-abc") == {}
+    assert not pool.volumes.create.called
+
+    norc = rc.copy(update=dict(runner_volume=False))
+    assert lxdm.volumes.devices(norc, pkg, "lxdrunner-abc") == {}
+
+
+def test_is_ready_owner(lxdm, pool):
+    base = volumes.RunnerVolumes.base_name(pkg)
+    # Populated before ownership was set, extracted again
+    pool.volumes.get.return_value = FakeVolume(
+        base, {volumes.READY_KEY: "true"}
+    )
+    assert not lxdm.volumes.is_ready(pkg)
+
+
+def test_populate_owner(lxdm):
+    inst = lxdm.client.instances.create.return_value
+    inst.execute.return_value = (0, "", "")
+    lxdm.wait_agent = mock.Mock(return_value=True)
+    lxdm.pushfile = mock.Mock()
+    lxdm.volumes.populate(rc, pkg, "lxdrunner-runner-test")
+    commands = [call.args[0] for call in inst.execute.call_args_list]
+    assert commands[-1] == [
+        "chown", "-R", f"{volumes.RUNNER_UID}:{volumes.RUNNER_UID}",
+        volumes.MOUNTPATH
+    ]
+
+
+def test_collect(lxdm, pool):
+    current = FakeVolume("lxdrunner-runner-linux-x64-2.0.0")
+    inuse = FakeVolume("lxdrunner-runner-linux-x64-1.0.0")
+    old = FakeVolume("lxdrunner-runner-linux-x64-0.9.0")
+    clone = FakeVolume(
+        "lxdrunner-abc-runner", {volumes.BASE_KEY: inuse.name}
+    )
+    other = FakeVolume("unrelated")
+    vols = {vol.name: vol for vol in (current, inuse, old, clone, other)}
+    pool.volumes.all.return_value = list(vols.values())
+    pool.volumes.get.side_effect = lambda _type, name: vols[name]
+
+    lxdm.volumes.collect({current.name})
+    assert old.delete.called, "Unreferenced volume should be deleted"
+    for vol in (current, inuse, clone, other):
+        assert not vol.delete.called, f"{vol.name} should be kept"
+
+
+def test_has_runner_volume():
+    inst = mock.Mock(devices={volumes.DEVICE: {}})
+    assert lxdrunner.lxd.LXDRunner.has_runner_volume(inst)
+    inst.devices = {}
+    assert not lxdrunner.lxd.LXDRunner.has_runner_volume(inst)
@@ -12,6 +12,7 @@ from lxdrunner.web import app
 import lxdrunner.web
 
 app.queue_evt = mock.MagicMock()
+app.cancel_evt = mock.MagicMock()
 
 headers = {'X-Hub-Signature-256': 'failedsig'}
 basedict = {'X-GitHub-Event': 'some-event'}
@@ -96,3 +97,40 @@ def test_githubhook(m_validate, passhdrs):
     with app.test_request_context(headers=passhdrs, json=wf_job):
         res = web.githubhook()
         assert res == "OK", "Event not enqueued"
+
+
+@mock.patch('lxdrunner.web.validate_webhook', return_value=True)
+def test_githubhook_cancel(m_validate, passhdrs):
+    job = json.loads(json.dumps(wf_job))
+    job['action'] = 'in_progress'
+    job['workflow_job'].update(
+        status='in_progress', labels=['self-hosted'], runner_name='other'
+    )
+    app.queue_evt.reset_mock()
+
+    with app.test_request_context(headers=passhdrs, json=job):
+        assert web.githubhook() == "OK"
+    assert not app.queue_evt.called, "In progress job should not be queued"
+    (evt, ) = app.cancel_evt.call_args.args
+    assert evt['runner_name'] == 'other'
+    assert evt['wf_job_id'] == job['workflow_job']['id']
+
+
+@mock.patch('lxdrunner.web.validate_webhook', return_value=True)
+def test_githubhook_workflow_run(m_validate, passhdrs):
+    passhdrs['X-GitHub-Event'] = 'workflow_run'
+    app.prewarm_evt = mock.MagicMock()
+    run = dict(
+        action='requested',
+        workflow_run=dict(id=5, path='.github/workflows/ci.yml', head_sha='a'),
+        repository=dict(name='repo', owner=dict(login='owner'))
+    )
+    with app.test_request_context(headers=passhdrs, json=run):
+        assert web.githubhook() == "OK"
+    (evt, ) = app.prewarm_evt.call_args.args
+    assert evt['path'] == '.github/workflows/ci.yml'
+    assert evt['owner'] == 'owner'
+
+    run['action'] = 'completed'
+    with app.test_request_context(headers=passhdrs, json=run):
+        assert web.githubhook() == "Skipping Event"
@@ -0,0 +1,41 @@
+from lxdrunner import workflow
+
+#
+# Test Data
+#
+
+definition = """
+name: CI
+on: [push]
+jobs:
+  build:
+    runs-on: [self-hosted, linux]
+  lint:
+    runs-on: ubuntu-latest
+  group:
+    runs-on:
+      group: runners
+      labels: [self-hosted, vm]
+  deploy:
+    needs: build
+    runs-on: [self-hosted, linux]
+  matrix:
+    runs-on: ${{ matrix.os }}
+"""
+
+#
+# Tests
+#
+
+
+def test_runs_on():
+    assert workflow.runs_on(definition) == [
+        frozenset(['self-hosted', 'linux']),
+        frozenset(['ubuntu-latest']),
+        frozenset(['self-hosted', 'vm']),
+    ]
+
+
+def test_runs_on_invalid():
+    assert workflow.runs_on("jobs: [") == []
+    assert workflow.runs_on("name: no jobs") == []